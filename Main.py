@@ -1,9 +1,13 @@
+import atexit
 import logging.config
 import os
+import queue
+import random
 import sys
 import uuid
 import time
 from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 from rich.logging import RichHandler
 from dotenv import load_dotenv
@@ -12,17 +16,26 @@ from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
 
-from backend.data_management.pool_handler import init_data_pool, close_data_pool
+from backend.data_management.pool_handler import start_data_services, stop_data_services
+from backend.data_management.pool_manager import DATA_POOL, USER_POOL, pool_manager
+from backend.data_management.replica_router import read_your_writes_middleware, replica_router
 from backend.routes import api, user
-from backend.user_management.pool_handler import init_user_pool, close_user_pool
+from backend.routes.metrics import metrics_registry, metrics_router, route_label, start_metrics_writer, stop_metrics_writer
+from backend.user_management.password_hashing import password_hasher
+from backend.user_management.pool_handler import start_user_services, stop_user_services
 
 
 # -- Logging Configuration --
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of successful requests that are logged, failures are always logged
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "1.0"))
+# Seconds the log thread waits for more records once the queue ran empty, so it wakes up once per batch, not per record
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.05"))
 
 def get_logging_config(env: str = "development"):
     log_dir = "logs"
@@ -75,15 +88,56 @@ def get_logging_config(env: str = "development"):
 
     return config
 
+class DeferredQueueHandler(QueueHandler):
+    # Only resolves the message arguments on the calling thread, formatting and tracebacks are left to the listener
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class BatchingQueueListener(QueueListener):
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            if not block:
+                raise
+        time.sleep(LOG_FLUSH_INTERVAL)
+        return self.queue.get()
+
+log_listeners: list[QueueListener] = []
+
 def setup_logging(env: str = "development"):
+    # The running listeners write out their records before the configuration replaces their handlers
+    stop_logging()
     config = get_logging_config(env)
     logging.config.dictConfig(config)
 
+    # The configured handlers write from background threads, the loggers only put records on a queue.
+    # Loggers with the same handlers share a queue, so every record still only reaches the handlers of its logger.
+    queue_handlers = {}
+    for name in config["loggers"]:
+        log = logging.getLogger(name)
+        handlers = tuple(log.handlers)
+        if handlers not in queue_handlers:
+            log_queue = queue.SimpleQueue()
+            queue_handlers[handlers] = DeferredQueueHandler(log_queue)
+            listener = BatchingQueueListener(log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            log_listeners.append(listener)
+        log.handlers = [queue_handlers[handlers]]
+
+def stop_logging():
+    # Writes out the queued records, runs at exit since the server still logs after the lifespan ended
+    while log_listeners:
+        log_listeners.pop().stop()
+
 
 # -- Application Setup --
 
 APP_ENV = os.getenv("APP_ENV", "development")
 setup_logging(APP_ENV)
+atexit.register(stop_logging)
 
 logger = logging.getLogger("api_logger")
 
@@ -91,8 +145,12 @@ logger = logging.getLogger("api_logger")
 async def lifespan(app: FastAPI):
     logger.info("Application Startup: Initializing database pools...")
     try:
-        await init_data_pool()
-        await init_user_pool()
+        await pool_manager.open(DATA_POOL)
+        await pool_manager.open(USER_POOL)
+        await replica_router.start()
+        await start_data_services()
+        await start_user_services()
+        await start_metrics_writer()
         logger.info("Application Startup: Database pools initialized successfully.")
     except Exception as e:
         logger.critical("Application Startup Failed: Could not initialize database pools.", exc_info=True)
@@ -101,8 +159,13 @@ async def lifespan(app: FastAPI):
     
     logger.info("Application Shutdown: Closing database connections...")
     try:
-        await close_user_pool()
-        await close_data_pool()
+        await stop_metrics_writer()
+        await stop_user_services()
+        await stop_data_services()
+        await replica_router.stop()
+        await pool_manager.close(USER_POOL)
+        await pool_manager.close(DATA_POOL)
+        password_hasher.shutdown()
         logger.info("Application Shutdown: Database connections closed successfully.")
     except Exception as e:
         logger.error("Application Shutdown Error: Could not close database pools cleanly.", exc_info=True)
@@ -129,13 +192,26 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Routers
 app.include_router(api.api_router)
 app.include_router(user.user_router)
+app.include_router(metrics_router)
 
 load_dotenv('.env.deployment')
 SECRET_KEY = os.getenv("SECRET_KEY")
+# Added before the session middleware so it runs inside it and can update the session
+app.add_middleware(BaseHTTPMiddleware, dispatch=read_your_writes_middleware)
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 templates = Jinja2Templates(directory="templates")
 
 
+def request_log_payload(request: Request) -> dict:
+    # Structured request data, only built for requests that are actually logged
+    return {
+        "method": request.method,
+        "url": str(request.url),
+        "headers": {k: v for k, v in request.headers.items() if k.lower() not in ["authorization", "cookie"]},
+        "client_ip": request.client.host if request.client else "unknown",
+    }
+
+
 @app.middleware("http")
 async def professional_logging_middleware(request: Request, call_next):
     # Bypass logging for static files
@@ -145,62 +221,64 @@ async def professional_logging_middleware(request: Request, call_next):
     start_time = time.time()
     request_id = str(uuid.uuid4())
     correlation_id = request.headers.get("X-Correlation-ID", request_id)
-
-    # Prepare a dictionary with structured request data
-    log_dict = {
-        "request_id": request_id,
-        "correlation_id": correlation_id,
-        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
-        "http": {
-            "request": {
-                "method": request.method,
-                "url": str(request.url),
-                "headers": {k: v for k, v in request.headers.items() if k.lower() not in ["authorization", "cookie"]},
-                "client_ip": request.client.host if request.client else "unknown",
-            }
-        },
-        "event": {"kind": "event", "category": "web", "type": "start"},
-    }
-
-    logger.info(f"Request started: {request.method} {request.url}", extra=log_dict)
+    # Successful requests are logged for a sample only, the decision is made up front so start and end stay paired
+    sampled = LOG_SUCCESS_SAMPLE_RATE >= 1 or random.random() < LOG_SUCCESS_SAMPLE_RATE
+    request_data = None
+
+    def log(level: int, message: str, event: dict, response_data: dict | None = None, exc_info: bool = False):
+        # Every record gets its own dict, the queue listener formats them after the request moved on
+        nonlocal request_data
+        if not logger.isEnabledFor(level):
+            return
+        if request_data is None:
+            request_data = request_log_payload(request)
+        http = {"request": request_data}
+        if response_data is not None:
+            http["response"] = response_data
+        logger.log(level, "%s: %s %s", message, request.method, request_data["url"], exc_info=exc_info, stacklevel=2, extra={
+            "request_id": request_id,
+            "correlation_id": correlation_id,
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "http": http,
+            "event": {"kind": "event", "category": "web", **event},
+        })
+
+    if sampled:
+        log(logging.INFO, "Request started", {"type": "start"})
 
     response = None
     try:
         response = await call_next(request)
         process_time = time.time() - start_time
         status_code = response.status_code
-
-        log_dict["http"]["response"] = {
-            "status_code": status_code,
-            "headers": {k: v for k, v in response.headers.items()},
-        }
-        log_dict["event"]["duration"] = process_time
-        log_dict["event"]["outcome"] = "success" if status_code < 400 else "failure"
-        log_dict["event"]["type"] = "end"
-
-        if status_code >= 500:
-            logger.error(f"Request finished with error: {request.method} {request.url}", extra=log_dict)
-        elif status_code >= 400:
-            logger.warning(f"Request finished with client error: {request.method} {request.url}", extra=log_dict)
-        else:
-            logger.info(f"Request finished successfully: {request.method} {request.url}", extra=log_dict)
+        # Every request is counted, independent of the log sampling
+        metrics_registry.observe_request(request.method, route_label(request.scope), status_code, process_time)
+
+        if status_code >= 400 or sampled:
+            if status_code >= 500:
+                level, message = logging.ERROR, "Request finished with error"
+            elif status_code >= 400:
+                level, message = logging.WARNING, "Request finished with client error"
+            else:
+                level, message = logging.INFO, "Request finished successfully"
+            log(level, message, {
+                "type": "end",
+                "duration": process_time,
+                "outcome": "success" if status_code < 400 else "failure",
+            }, {
+                "status_code": status_code,
+                "headers": dict(response.headers.items()),
+            })
 
         response.headers["X-Process-Time"] = str(process_time)
         response.headers["X-Request-ID"] = correlation_id
 
     except Exception as e:
         process_time = time.time() - start_time
-        
+        metrics_registry.observe_request(request.method, route_label(request.scope), 500, process_time)
+
         # Log the exception with a full traceback
-        log_dict["event"]["outcome"] = "failure"
-        log_dict["event"]["duration"] = process_time
-        log_dict["event"]["type"] = "end"
-        
-        logger.critical(
-            f"Unhandled exception: {request.method} {request.url}",
-            exc_info=True, # This adds the traceback
-            extra=log_dict
-        )
+        log(logging.CRITICAL, "Unhandled exception", {"type": "end", "duration": process_time, "outcome": "failure"}, exc_info=True)
 
         # Re-raise to be handled by FastAPI's default handler,
         # which will then be caught by our custom exception handler below if it's a StarletteHTTPException
@@ -223,6 +301,7 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     final_description = f"{description} ({exc.detail})"
 
     return templates.TemplateResponse(
+        request,
         "error.html", 
         {
             "request": request, 
@@ -230,7 +309,8 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
             "TITLE": title, 
             "DESCRIPTION": final_description
         },
-        status_code=status_code 
+        status_code=status_code,
+        headers=exc.headers
     )
 
 
@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+from typing import Iterable
+
+from backend.data_management.pool_manager import reading_replica
+from backend.data_management.tile_storage import TILE_SIZE
+
+# Ranges spanning more tiles than this are read from the database directly instead of through the cache
+MAX_CACHED_RANGE_TILES = 64
+
+TileKey = tuple[str, str, int, int]
+
+
+class TileCache:
+    # LRU of TILE_SIZE x TILE_SIZE blocks of cell values, keyed by (schema, table, tile_row, tile_col)
+
+    def __init__(self, max_tiles: int):
+        self.max_tiles = max_tiles
+        self.tiles: OrderedDict[TileKey, dict[tuple[int, int], str]] = OrderedDict()
+        self.table_tiles: dict[tuple[str, str], set[TileKey]] = {}
+        self.generations: dict[tuple[str, str], int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tiles > 0
+
+    def generation(self, schema: str, table_name: str) -> int:
+        return self.generations.get((schema, table_name), 0)
+
+    def get(self, key: TileKey) -> dict[tuple[int, int], str] | None:
+        tile = self.tiles.get(key)
+        if tile is None:
+            self.misses += 1
+            return None
+        self.tiles.move_to_end(key)
+        self.hits += 1
+        return tile
+
+    def put(self, key: TileKey, tile: dict[tuple[int, int], str], generation: int):
+        # Tiles read before an invalidation of their table or from a replica may be stale and are not stored
+        if generation != self.generation(key[0], key[1]) or reading_replica.get():
+            return
+        self.tiles[key] = tile
+        self.tiles.move_to_end(key)
+        self.table_tiles.setdefault((key[0], key[1]), set()).add(key)
+        while len(self.tiles) > self.max_tiles:
+            evicted, _ = self.tiles.popitem(last=False)
+            self._forget(evicted)
+            self.evictions += 1
+
+    def _forget(self, key: TileKey):
+        keys = self.table_tiles.get((key[0], key[1]))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.table_tiles[key[0], key[1]]
+
+    def invalidate_cells(self, schema: str, table_name: str, cells: Iterable[tuple[int, int]]):
+        self.generations[schema, table_name] = self.generation(schema, table_name) + 1
+        for key in {(schema, table_name, row // TILE_SIZE, col // TILE_SIZE) for row, col in cells}:
+            if self.tiles.pop(key, None) is not None:
+                self._forget(key)
+                self.invalidations += 1
+
+    def invalidate_table(self, schema: str, table_name: str):
+        self.generations[schema, table_name] = self.generation(schema, table_name) + 1
+        for key in self.table_tiles.pop((schema, table_name), set()):
+            del self.tiles[key]
+            self.invalidations += 1
+
+    def clear(self):
+        for schema, table_name in list(self.generations):
+            self.generations[schema, table_name] += 1
+        self.invalidations += len(self.tiles)
+        self.tiles.clear()
+        self.table_tiles.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "tiles": len(self.tiles),
+            "max_tiles": self.max_tiles,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+cell_cache = TileCache(int(os.getenv("CELL_CACHE_TILES", "4096")))
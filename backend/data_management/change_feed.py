@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Callable
+
+import asyncpg
+from asyncpg import Connection
+
+logger = logging.getLogger("api_logger")
+
+CHANNEL = "flowtables_cells"
+
+# NOTIFY payloads are limited to 8000 bytes, larger change sets invalidate the whole table instead
+MAX_PAYLOAD_BYTES = 7900
+
+RECONNECT_DELAY = 5
+
+# Identifies notifications sent by this process
+PROCESS_ID = uuid.uuid4().hex
+
+# Called with (schema, table, cells, local), cells are (row, col, value) triples or None when the whole table changed,
+# schema is None when notifications may have been missed and every table has to be considered changed
+ChangeSubscriber = Callable[[str | None, str | None, list[tuple[int, int, str | None]] | None, bool], None]
+_subscribers: list[ChangeSubscriber] = []
+
+
+def subscribe(subscriber: ChangeSubscriber):
+    _subscribers.append(subscriber)
+
+
+def unsubscribe(subscriber: ChangeSubscriber):
+    if subscriber in _subscribers:
+        _subscribers.remove(subscriber)
+
+
+def _dispatch(schema: str | None, table_name: str | None, cells: list[tuple[int, int, str | None]] | None, local: bool):
+    for subscriber in _subscribers:
+        try:
+            subscriber(schema, table_name, cells, local)
+        except Exception:
+            logger.error("Change feed subscriber failed", exc_info=True)
+
+
+async def publish_changes(data_connection: Connection, schema: str, table_name: str, cells: list[tuple[int, int, str | None]] | None):
+    # NOTIFY is transactional, other workers only hear about the change once it is committed
+    message = {"origin": PROCESS_ID, "schema": schema, "table": table_name}
+    if cells is not None:
+        payload = json.dumps({**message, "cells": [[row, col, value or None] for row, col, value in cells]})
+        if len(payload.encode("utf-8")) <= MAX_PAYLOAD_BYTES:
+            await data_connection.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+            return
+    await data_connection.execute("SELECT pg_notify($1, $2)", CHANNEL, json.dumps(message))
+
+
+def _on_notification(payload: str):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning("Ignoring malformed change notification", exc_info=True)
+        return
+    cells = message.get("cells")
+    if cells is not None:
+        cells = [(row, col, value) for row, col, value in cells]
+    _dispatch(message["schema"], message["table"], cells, message.get("origin") == PROCESS_ID)
+
+
+class NotificationListener:
+    # Keeps one pooled connection listening on a channel for the lifetime of the process and reconnects when it is lost.
+    # Notifications sent while disconnected are lost, on_reset is called whenever that may have happened.
+
+    def __init__(self, channel: str, on_notification: Callable[[str], None], on_reset: Callable[[], None]):
+        self.channel = channel
+        self.on_notification = on_notification
+        self.on_reset = on_reset
+        self.pool: asyncpg.Pool | None = None
+        self.connection: Connection | None = None
+        self.reconnect_task: asyncio.Task | None = None
+        self._notification_callback = self._on_notification
+        self._termination_callback = self._on_termination
+
+    def _on_notification(self, connection: Connection, pid: int, channel: str, payload: str):
+        self.on_notification(payload)
+
+    def _on_termination(self, connection: Connection):
+        self.connection = None
+        self.on_reset()
+        if self.pool is not None:
+            self.reconnect_task = asyncio.get_running_loop().create_task(self._reconnect(connection))
+
+    async def _reconnect(self, lost_connection: Connection):
+        try:
+            await self.pool.release(lost_connection)
+        except Exception:
+            pass
+        while self.pool is not None and self.connection is None:
+            await asyncio.sleep(RECONNECT_DELAY)
+            try:
+                await self._listen()
+            except Exception:
+                logger.warning(f"Reconnecting listener on {self.channel} failed", exc_info=True)
+
+    async def _listen(self):
+        connection = await self.pool.acquire()
+        connection.add_termination_listener(self._termination_callback)
+        await connection.add_listener(self.channel, self._notification_callback)
+        self.connection = connection
+        self.on_reset()
+
+    async def start(self, pool: asyncpg.Pool):
+        self.pool = pool
+        await self._listen()
+
+    async def stop(self) -> bool:
+        pool, self.pool = self.pool, None
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.connection is None:
+            return False
+        connection, self.connection = self.connection, None
+        connection.remove_termination_listener(self._termination_callback)
+        await connection.remove_listener(self.channel, self._notification_callback)
+        await pool.release(connection)
+        return True
+
+
+_listener = NotificationListener(CHANNEL, _on_notification, lambda: _dispatch(None, None, None, False))
+
+
+async def start_change_feed(pool: asyncpg.Pool):
+    await _listener.start(pool)
+    print("Change feed listening.")
+
+
+async def stop_change_feed():
+    if await _listener.stop():
+        print("Change feed stopped.")
@@ -0,0 +1,73 @@
+import json
+
+from asyncpg import Connection
+
+# Every table keeps at least this many revisions in its change log, older entries are removed
+# once every COMPACT_INTERVAL revisions and clients further behind get a snapshot instead
+CHANGE_LOG_RETENTION = 10000
+COMPACT_INTERVAL = 1000
+
+
+async def record_changes(data_connection: Connection, schema: str, table_name: str, cells: list[tuple[int, int, str | None]] | None) -> int | None:
+    # Bumps the table revision and logs the written cells under it, None marks a change of the whole table.
+    # Must run in the transaction of the write, the catalog row lock keeps revisions in commit order.
+    if cells is not None:
+        latest = {(row, col): value or None for row, col, value in cells}
+        cells = json.dumps([[row, col, value] for (row, col), value in latest.items()])
+    revision = await data_connection.fetchval('''
+        WITH bumped AS (
+            UPDATE table_storage SET revision = revision + 1 WHERE schema_name = $1 AND table_name = $2 RETURNING revision
+        )
+        INSERT INTO table_changes (schema_name, table_name, revision, cells)
+        SELECT $1, $2, revision, $3 FROM bumped
+        RETURNING revision
+    ''', schema, table_name, cells)
+    if revision is not None and revision % COMPACT_INTERVAL == 0:
+        await compact_change_log(data_connection, schema, table_name, revision - CHANGE_LOG_RETENTION)
+    return revision
+
+
+async def compact_change_log(data_connection: Connection, schema: str, table_name: str, through_revision: int):
+    async with data_connection.transaction():
+        await data_connection.execute('''
+            DELETE FROM table_changes WHERE schema_name = $1 AND table_name = $2 AND revision <= $3
+        ''', schema, table_name, through_revision)
+        await data_connection.execute('''
+            UPDATE table_storage SET log_start = GREATEST(log_start, $3) WHERE schema_name = $1 AND table_name = $2
+        ''', schema, table_name, through_revision)
+
+
+async def delete_change_log(data_connection: Connection, schema: str, table_name: str):
+    await data_connection.execute('''DELETE FROM table_changes WHERE schema_name = $1 AND table_name = $2''', schema, table_name)
+
+
+async def get_revision(data_connection: Connection, schema: str, table_name: str) -> int:
+    revision = await data_connection.fetchval('''
+        SELECT revision FROM table_storage WHERE schema_name = $1 AND table_name = $2
+    ''', schema, table_name)
+    if revision is None:
+        raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+    return revision
+
+
+async def get_changes_since(data_connection: Connection, schema: str, table_name: str, since: int) -> tuple[int, list[tuple[int, int, str | None]] | None]:
+    # Returns the current revision and the last value of every cell written after since,
+    # or None instead of the cells when the log no longer covers that range
+    state = await data_connection.fetchrow('''
+        SELECT revision, log_start FROM table_storage WHERE schema_name = $1 AND table_name = $2
+    ''', schema, table_name)
+    if state is None:
+        raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+    if since < state['log_start'] or since > state['revision']:
+        return state['revision'], None
+
+    latest = {}
+    for record in await data_connection.fetch('''
+        SELECT cells FROM table_changes WHERE schema_name = $1 AND table_name = $2 AND revision > $3 AND revision <= $4
+        ORDER BY revision
+    ''', schema, table_name, since, state['revision']):
+        if record['cells'] is None:
+            return state['revision'], None
+        for row, col, value in json.loads(record['cells']):
+            latest[row, col] = value
+    return state['revision'], [(row, col, value) for (row, col), value in latest.items()]
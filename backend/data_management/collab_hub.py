@@ -0,0 +1,96 @@
+import asyncio
+import logging
+
+from fastapi import WebSocket
+
+from backend.data_management.pool_manager import DATA_POOL, pool_manager
+from backend.data_management.change_feed import subscribe
+from backend.data_management.table_handler import set_cell_values
+
+logger = logging.getLogger("api_logger")
+
+# Edits arriving within this window are written as one batch
+COALESCE_DELAY = 0.05
+SEND_TIMEOUT = 5
+
+
+class TableSession:
+    # Connected editors of one table and the edits that still have to be written
+
+    def __init__(self):
+        self.sockets: set[WebSocket] = set()
+        self.pending: dict[tuple[int, int], str | None] = {}
+        self.flush_task: asyncio.Task | None = None
+
+
+class CollabHub:
+
+    def __init__(self):
+        self.sessions: dict[tuple[str, str], TableSession] = {}
+        # The loop only keeps weak references to tasks, running broadcasts are kept here until they finish
+        self.broadcasts: set[asyncio.Task] = set()
+
+    def join(self, schema: str, table_name: str, websocket: WebSocket):
+        self.sessions.setdefault((schema, table_name), TableSession()).sockets.add(websocket)
+
+    def leave(self, schema: str, table_name: str, websocket: WebSocket):
+        session = self.sessions.get((schema, table_name))
+        if session is None:
+            return
+        session.sockets.discard(websocket)
+        if not session.sockets and not session.pending and session.flush_task is None:
+            del self.sessions[schema, table_name]
+
+    def submit(self, schema: str, table_name: str, edits: list[tuple[int, int, str | None]]):
+        session = self.sessions.setdefault((schema, table_name), TableSession())
+        # Only the latest value per cell is kept, keystrokes on the same cell collapse into one write
+        for row, col, value in edits:
+            session.pending[row, col] = value
+        if session.flush_task is None:
+            session.flush_task = asyncio.get_running_loop().create_task(self._flush_later(schema, table_name, session))
+
+    async def _flush_later(self, schema: str, table_name: str, session: TableSession):
+        try:
+            while session.pending:
+                await asyncio.sleep(COALESCE_DELAY)
+                edits = [(row, col, value) for (row, col), value in session.pending.items()]
+                session.pending = {}
+                try:
+                    async with pool_manager.acquire(DATA_POOL) as connection:
+                        await set_cell_values(connection, schema, table_name, edits)
+                except Exception:
+                    logger.error(f"Writing collaborative edits to {schema}.{table_name} failed", exc_info=True)
+                    await self._broadcast(session, {"type": "error", "cells": [[row, col] for row, col, _ in edits]})
+        finally:
+            session.flush_task = None
+            if not session.sockets and not session.pending:
+                self.sessions.pop((schema, table_name), None)
+
+    async def _broadcast(self, session: TableSession, message: dict):
+        for websocket in list(session.sockets):
+            try:
+                await asyncio.wait_for(websocket.send_json(message), SEND_TIMEOUT)
+            except Exception:
+                # Slow or broken clients are dropped, they resync when they reconnect
+                session.sockets.discard(websocket)
+
+    def on_table_changed(self, schema: str | None, table_name: str | None, cells: list[tuple[int, int, str | None]] | None, local: bool):
+        # Every worker hears every committed change through the change feed, including its own
+        if schema is None:
+            targets = [(session, {"type": "resync"}) for session in self.sessions.values()]
+        elif (session := self.sessions.get((schema, table_name))) is not None:
+            message = {"type": "resync"} if cells is None else {"type": "cells", "cells": [list(cell) for cell in cells]}
+            targets = [(session, message)]
+        else:
+            return
+
+        loop = asyncio.get_running_loop()
+        for session, message in targets:
+            if session.sockets:
+                task = loop.create_task(self._broadcast(session, message))
+                self.broadcasts.add(task)
+                task.add_done_callback(self.broadcasts.discard)
+
+
+collab_hub = CollabHub()
+subscribe(collab_hub.on_table_changed)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+from uuid import UUID
+
+import asyncpg
+from asyncpg import Connection
+
+from backend.data_management.shared_storage import delete_cells_batch
+
+logger = logging.getLogger("api_logger")
+
+# Deleted projects and tables are only renamed out of the way in the request, a background worker then drops
+# them one table per step, pausing between steps so the drops never hog the database
+DELETION_STEP_DELAY = float(os.getenv("DELETION_STEP_DELAY", "0.5"))
+DELETION_POLL_INTERVAL = float(os.getenv("DELETION_POLL_INTERVAL", "5"))
+DELETION_BATCH_SIZE = int(os.getenv("DELETION_BATCH_SIZE", "10000"))
+DELETION_MAX_ATTEMPTS = int(os.getenv("DELETION_MAX_ATTEMPTS", "5"))
+MAX_RETRY_DELAY = 300
+
+
+def tombstone_name(deletion_id: UUID) -> str:
+    # Fits into the 63 characters Postgres allows for names
+    return f"deleted_{deletion_id.hex}"
+
+
+async def queue_deletion(data_connection: Connection, deletion_id: UUID, schema: str, table_name: str | None, tombstone: str | None, tables_total: int, requested_by: UUID | None = None):
+    # A table_name of None deletes the whole project, tombstone is the name the schema or table was renamed to
+    await data_connection.execute('''
+        INSERT INTO pending_deletions (deletion_id, schema_name, table_name, tombstone, tables_total, requested_by)
+        VALUES ($1, $2, $3, $4, $5, $6)
+    ''', deletion_id, schema, table_name, tombstone, tables_total, requested_by)
+
+
+def _status(record) -> str:
+    if record['finished_at'] is not None:
+        return "done"
+    if record['attempts'] >= DELETION_MAX_ATTEMPTS:
+        return "failed"
+    return "pending"
+
+
+def _deletion_dict(record) -> dict:
+    return {
+        "deletion_id": str(record['deletion_id']),
+        "project_id": record['schema_name'],
+        "table_name": record['table_name'],
+        "requested_by": str(record['requested_by']) if record['requested_by'] else None,
+        "status": _status(record),
+        "tables_total": record['tables_total'],
+        "tables_dropped": record['tables_dropped'],
+        "attempts": record['attempts'],
+        "last_error": record['last_error'],
+        "requested_at": record['requested_at'].isoformat(),
+        "finished_at": record['finished_at'].isoformat() if record['finished_at'] else None,
+    }
+
+
+async def get_deletion(data_connection: Connection, deletion_id: UUID) -> dict:
+    record = await data_connection.fetchrow('SELECT * FROM pending_deletions WHERE deletion_id = $1', deletion_id)
+    if record is None:
+        raise ValueError(f"Deletion {deletion_id} does not exist")
+    return _deletion_dict(record)
+
+
+async def list_deletions(data_connection: Connection, schema: str | None = None, include_finished: bool = False,
+                         visible_schemas: list[str] | None = None, requested_by: UUID | None = None) -> list[dict]:
+    # With visible_schemas only deletions in those schemas or requested by requested_by are listed
+    results = await data_connection.fetch('''
+        SELECT * FROM pending_deletions
+        WHERE ($1::text IS NULL OR schema_name = $1) AND ($2 OR finished_at IS NULL)
+        AND ($3::text[] IS NULL OR schema_name = ANY($3) OR requested_by = $4)
+        ORDER BY requested_at
+    ''', schema, include_finished, visible_schemas, requested_by)
+    return [_deletion_dict(record) for record in results]
+
+
+async def retry_deletion(data_connection: Connection, deletion_id: UUID):
+    # Failed deletions are not picked up again until they are retried explicitly
+    result = await data_connection.execute('''
+        UPDATE pending_deletions SET attempts = 0, next_attempt = now() WHERE deletion_id = $1 AND finished_at IS NULL
+    ''', deletion_id)
+    if result == "UPDATE 0":
+        raise ValueError(f"Deletion {deletion_id} does not exist or is already done")
+
+
+async def _deletion_step(data_connection: Connection, job) -> tuple[bool, int]:
+    # Drops one table or one batch of shared cells, returns whether the deletion is done and how many tables were dropped
+    schema, table_name, tombstone = job['schema_name'], job['table_name'], job['tombstone']
+    if table_name is not None:
+        if tombstone is not None:
+            await data_connection.execute(f'DROP TABLE IF EXISTS "{schema}"."{tombstone}" CASCADE')
+            return True, 1
+        if await delete_cells_batch(data_connection, schema, table_name, DELETION_BATCH_SIZE) == DELETION_BATCH_SIZE:
+            return False, 0
+        return True, 1
+
+    if tombstone is not None:
+        remaining = await data_connection.fetchval('SELECT tablename FROM pg_tables WHERE schemaname = $1 LIMIT 1', tombstone)
+        if remaining is not None:
+            await data_connection.execute(f'DROP TABLE "{tombstone}"."{remaining}" CASCADE')
+            return False, 1
+        await data_connection.execute(f'DROP SCHEMA IF EXISTS "{tombstone}" CASCADE')
+    if await delete_cells_batch(data_connection, schema, None, DELETION_BATCH_SIZE) == DELETION_BATCH_SIZE:
+        return False, 0
+    await data_connection.execute('DELETE FROM table_changes WHERE schema_name = $1', schema)
+    return True, 0
+
+
+async def process_deletion_step(data_connection: Connection, deletion_id: UUID | None = None) -> bool:
+    # Runs one step of the oldest due deletion, or of the given one. Returns False when there was nothing to do.
+    # The job row stays locked during the step, so several workers never work on the same deletion.
+    async with data_connection.transaction():
+        job = await data_connection.fetchrow('''
+            SELECT * FROM pending_deletions
+            WHERE finished_at IS NULL AND attempts < $2 AND next_attempt <= now() AND ($1::uuid IS NULL OR deletion_id = $1)
+            ORDER BY requested_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ''', deletion_id, DELETION_MAX_ATTEMPTS)
+        if job is None:
+            return False
+
+        try:
+            async with data_connection.transaction():
+                finished, dropped = await _deletion_step(data_connection, job)
+        except Exception as e:
+            logger.warning(f"Deletion {job['deletion_id']} failed, attempt {job['attempts'] + 1}", exc_info=True)
+            await data_connection.execute('''
+                UPDATE pending_deletions SET attempts = attempts + 1, last_error = $2, next_attempt = now() + make_interval(secs => $3)
+                WHERE deletion_id = $1
+            ''', job['deletion_id'], str(e), float(min(2 ** job['attempts'], MAX_RETRY_DELAY)))
+            return True
+
+        await data_connection.execute('''
+            UPDATE pending_deletions
+            SET tables_dropped = CASE WHEN $3 THEN tables_total ELSE tables_dropped + $2 END,
+                finished_at = CASE WHEN $3 THEN now() END,
+                last_error = NULL
+            WHERE deletion_id = $1
+        ''', job['deletion_id'], dropped, finished)
+    return True
+
+
+class DeletionWorker:
+    # Works through the pending deletions in the background for the lifetime of the process
+
+    def __init__(self):
+        self.pool: asyncpg.Pool | None = None
+        self.task: asyncio.Task | None = None
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.pool.acquire() as connection:
+                    worked = await process_deletion_step(connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Deletion worker step failed", exc_info=True)
+                worked = False
+            await asyncio.sleep(DELETION_STEP_DELAY if worked else DELETION_POLL_INTERVAL)
+
+    async def start(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> bool:
+        task, self.task = self.task, None
+        self.pool = None
+        if task is None:
+            return False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return True
+
+
+_worker = DeletionWorker()
+
+
+async def start_deletion_worker(pool: asyncpg.Pool):
+    await _worker.start(pool)
+    print("Deletion worker started.")
+
+
+async def stop_deletion_worker():
+    if await _worker.stop():
+        print("Deletion worker stopped.")
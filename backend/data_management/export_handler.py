@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from asyncpg import Connection
+
+from backend.data_management.table_handler import get_cells_sql
+
+EXPORT_PREFETCH = 5000
+EXPORT_CHUNK_ROWS = 1000
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+async def get_table_width(data_connection: Connection, schema: str, table_name: str) -> int:
+    cells_sql = await get_cells_sql(data_connection, schema, table_name)
+    max_col = await data_connection.fetchval(f'SELECT max(col_index) FROM ({cells_sql}) AS cells')
+    return 0 if max_col is None else max_col + 1
+
+
+async def _iter_rows(cursor, width: int) -> AsyncIterator[tuple[int, list[str | None]]]:
+    current_row = None
+    values = None
+    async for record in cursor:
+        if record['row_index'] != current_row:
+            if current_row is not None:
+                yield current_row, values
+            current_row = record['row_index']
+            values = [None] * width
+        values[record['col_index']] = record['value']
+
+    if current_row is not None:
+        yield current_row, values
+
+
+@asynccontextmanager
+async def table_snapshot(data_connection: Connection, schema: str, table_name: str, prefetch: int = EXPORT_PREFETCH) -> AsyncIterator[tuple[int, AsyncIterator[tuple[int, list[str | None]]]]]:
+    # The width and the rows come from one snapshot, a concurrent write can not widen the table halfway through.
+    # Server-side cursors only live inside a transaction, cell tables are read in primary key order.
+    if data_connection.is_in_transaction():
+        transaction = data_connection.transaction()
+    else:
+        transaction = data_connection.transaction(isolation='repeatable_read', readonly=True)
+    async with transaction:
+        width = await get_table_width(data_connection, schema, table_name)
+        cursor = data_connection.cursor(f'''
+            SELECT row_index, col_index, value FROM ({await get_cells_sql(data_connection, schema, table_name)}) AS cells
+            ORDER BY row_index, col_index
+        ''', prefetch=prefetch)
+        yield width, _iter_rows(cursor, width)
+
+
+async def export_csv(data_connection: Connection, schema: str, table_name: str) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # Rows without any cells are written as empty lines so that row positions are kept
+    next_row = 0
+    async with table_snapshot(data_connection, schema, table_name) as (width, rows):
+        async for row_index, values in rows:
+            writer.writerows([] for _ in range(next_row, row_index))
+            writer.writerow(values)
+            next_row = row_index + 1
+
+            if buffer.tell() >= 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def export_ndjson(data_connection: Connection, schema: str, table_name: str) -> AsyncIterator[str]:
+    lines = []
+    async with table_snapshot(data_connection, schema, table_name) as (width, rows):
+        async for row_index, values in rows:
+            lines.append(json.dumps({"row": row_index, "values": values}) + "\n")
+            if len(lines) >= EXPORT_CHUNK_ROWS:
+                yield "".join(lines)
+                lines = []
+
+    if lines:
+        yield "".join(lines)
+
+
+async def export_arrow(data_connection: Connection, schema: str, table_name: str) -> AsyncIterator[bytes]:
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ValueError("Arrow export requires the pyarrow package")
+
+    async with table_snapshot(data_connection, schema, table_name) as (width, rows):
+        arrow_schema = pa.schema([pa.field("row_index", pa.int32())] + [pa.field(f"c{col}", pa.string()) for col in range(width)])
+        sink = io.BytesIO()
+        writer = pa.ipc.new_stream(sink, arrow_schema)
+
+        def drain() -> bytes:
+            data = sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+            return data
+
+        def write_batch(batch: list[tuple[int, list[str | None]]]):
+            columns = [[row_index for row_index, _ in batch]] + [[values[col] for _, values in batch] for col in range(width)]
+            writer.write_batch(pa.record_batch(columns, schema=arrow_schema))
+
+        batch = []
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= EXPORT_CHUNK_ROWS:
+                write_batch(batch)
+                batch = []
+                yield drain()
+
+        if batch:
+            write_batch(batch)
+        writer.close()
+        yield drain()
+
+
+def export_table(data_connection: Connection, schema: str, table_name: str, export_format: str) -> AsyncIterator[str | bytes]:
+    if export_format == "csv":
+        return export_csv(data_connection, schema, table_name)
+    if export_format == "ndjson":
+        return export_ndjson(data_connection, schema, table_name)
+    if export_format == "arrow":
+        return export_arrow(data_connection, schema, table_name)
+    raise ValueError(f"Unsupported export format {export_format}, expected one of {', '.join(EXPORT_FORMATS)}")
@@ -0,0 +1,591 @@
+import math
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+from asyncpg import Connection
+
+from backend.data_management.change_feed import subscribe
+from backend.data_management.table_handler import add_write_listener, get_cells, get_cells_sql, get_range, \
+    get_range_aggregates
+
+# Formula engines are kept for the most recently used tables only
+MAX_FORMULA_TABLES = 128
+
+_TOKEN_PATTERN = re.compile(r'''\s*(?:
+    (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)
+    | (?P<string>"(?:[^"]|"")*")
+    | (?P<ref>\$?[A-Za-z]{1,3}\$?[0-9]+(?![A-Za-z0-9_(]))
+    | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    | (?P<op><>|<=|>=|[-+*/^&=<>():,%])
+)''', re.VERBOSE)
+
+_REF_PATTERN = re.compile(r'\$?([A-Za-z]{1,3})\$?([0-9]+)')
+
+_NUMBER_PATTERN = re.compile(r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$')
+
+_COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+_AGGREGATES = ("SUM", "COUNT", "AVERAGE", "MIN", "MAX")
+
+
+class FormulaError(Exception):
+    pass
+
+
+class CellError:
+    # Error values are regular cell values, they propagate through every formula that uses them
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, CellError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return self.code
+
+
+DIV_ZERO = CellError("#DIV/0!")
+VALUE_ERROR = CellError("#VALUE!")
+NAME_ERROR = CellError("#NAME?")
+CYCLE_ERROR = CellError("#CYCLE!")
+PARSE_ERROR = CellError("#ERROR!")
+
+
+def column_index(letters: str) -> int:
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def parse_reference(reference: str) -> tuple[int, int]:
+    match = _REF_PATTERN.fullmatch(reference)
+    if not match or int(match.group(2)) < 1:
+        raise FormulaError(f"Invalid cell reference {reference}")
+    return int(match.group(2)) - 1, column_index(match.group(1))
+
+
+def _tokenize(source: str) -> list[tuple[str, str]]:
+    tokens = []
+    position = 0
+    source = source.rstrip()
+    while position < len(source):
+        match = _TOKEN_PATTERN.match(source, position)
+        if not match:
+            raise FormulaError(f"Unexpected character at {position}: {source[position:]}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    # Recursive descent over the Excel operator precedence: comparison < & < +- < */ < ^ < unary < %
+
+    def __init__(self, tokens: list[tuple[str, str]]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> tuple[str, str] | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self) -> tuple[str, str]:
+        token = self.peek()
+        if token is None:
+            raise FormulaError("Unexpected end of formula")
+        self.position += 1
+        return token
+
+    def accept(self, *operators: str) -> str | None:
+        token = self.peek()
+        if token is not None and token[0] == "op" and token[1] in operators:
+            self.position += 1
+            return token[1]
+        return None
+
+    def expect(self, operator: str):
+        if not self.accept(operator):
+            raise FormulaError(f"Expected {operator}")
+
+    def parse(self) -> tuple:
+        node = self.comparison()
+        if self.peek() is not None:
+            raise FormulaError(f"Unexpected {self.peek()[1]}")
+        return node
+
+    def binary(self, operand, *operators: str) -> tuple:
+        node = operand()
+        while operator := self.accept(*operators):
+            node = ("binary", operator, node, operand())
+        return node
+
+    def comparison(self) -> tuple:
+        return self.binary(self.concatenation, *_COMPARISONS)
+
+    def concatenation(self) -> tuple:
+        return self.binary(self.additive, "&")
+
+    def additive(self) -> tuple:
+        return self.binary(self.term, "+", "-")
+
+    def term(self) -> tuple:
+        return self.binary(self.power, "*", "/")
+
+    def power(self) -> tuple:
+        return self.binary(self.unary, "^")
+
+    def unary(self) -> tuple:
+        if operator := self.accept("-", "+"):
+            return ("negate", self.unary()) if operator == "-" else self.unary()
+        node = self.primary()
+        while self.accept("%"):
+            node = ("binary", "/", node, ("value", 100.0))
+        return node
+
+    def primary(self) -> tuple:
+        kind, text = self.take()
+        if kind == "number":
+            return ("value", float(text))
+        if kind == "string":
+            return ("value", text[1:-1].replace('""', '"'))
+        if kind == "ref":
+            start = parse_reference(text)
+            if self.accept(":"):
+                ref_kind, ref_text = self.take()
+                if ref_kind != "ref":
+                    raise FormulaError("Expected a cell reference after :")
+                end = parse_reference(ref_text)
+                return ("range", min(start[0], end[0]), max(start[0], end[0]), min(start[1], end[1]), max(start[1], end[1]))
+            return ("cell", *start)
+        if kind == "name":
+            name = text.upper()
+            if self.accept("("):
+                args = []
+                if not self.accept(")"):
+                    args.append(self.comparison())
+                    while self.accept(","):
+                        args.append(self.comparison())
+                    self.expect(")")
+                return ("call", name, tuple(args))
+            if name in ("TRUE", "FALSE"):
+                return ("value", name == "TRUE")
+            return ("value", NAME_ERROR)
+        if kind == "op" and text == "(":
+            node = self.comparison()
+            self.expect(")")
+            return node
+        raise FormulaError(f"Unexpected {text}")
+
+
+@lru_cache(maxsize=4096)
+def parse_formula(source: str) -> tuple:
+    # Formulas are parsed once per distinct text, the tree is immutable and shared between cells
+    return _Parser(_tokenize(source.lstrip("="))).parse()
+
+
+def references(node: tuple, cells: set | None = None, ranges: set | None = None) -> tuple[set, set]:
+    cells = set() if cells is None else cells
+    ranges = set() if ranges is None else ranges
+    kind = node[0]
+    if kind == "cell":
+        cells.add(node[1:])
+    elif kind == "range":
+        ranges.add(node[1:])
+    elif kind == "binary":
+        references(node[2], cells, ranges)
+        references(node[3], cells, ranges)
+    elif kind == "negate":
+        references(node[1], cells, ranges)
+    elif kind == "call":
+        for arg in node[2]:
+            references(arg, cells, ranges)
+    return cells, ranges
+
+
+def is_formula(value: str | None) -> bool:
+    return bool(value) and value.startswith("=") and len(value) > 1
+
+
+def _in_range(cell: tuple[int, int], cell_range: tuple[int, int, int, int]) -> bool:
+    return cell_range[0] <= cell[0] <= cell_range[1] and cell_range[2] <= cell[1] <= cell_range[3]
+
+
+def _number(value):
+    if isinstance(value, CellError):
+        return value
+    if value is None or value == "":
+        return 0.0
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, float):
+        return value
+    if _NUMBER_PATTERN.match(value):
+        return float(value)
+    return VALUE_ERROR
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+def _truthy(value):
+    number = _number(value)
+    return number if isinstance(number, CellError) else number != 0
+
+
+def format_value(value) -> str | None:
+    if isinstance(value, CellError):
+        return value.code
+    if value is None:
+        return None
+    return _text(value)
+
+
+class TableFormulas:
+    # Parsed formulas, dependency graph and cached results of one table
+
+    def __init__(self, schema: str, table_name: str):
+        self.schema = schema
+        self.table_name = table_name
+        self.formulas: dict[tuple[int, int], tuple] = {}
+        self.results: dict[tuple[int, int], object] = {}
+        self.precedents: dict[tuple[int, int], tuple[set, set]] = {}
+        self.cell_dependents: dict[tuple[int, int], set[tuple[int, int]]] = {}
+        self.range_dependents: dict[tuple[int, int, int, int], set[tuple[int, int]]] = {}
+        self.range_aggregates: dict[tuple[int, int, int, int], tuple] = {}
+
+    async def load(self, data_connection: Connection):
+        cells_sql = await get_cells_sql(data_connection, self.schema, self.table_name)
+        records = await data_connection.fetch(f'''
+            SELECT row_index, col_index, value FROM ({cells_sql}) AS cells WHERE value LIKE '=%'
+        ''')
+        for record in records:
+            self._set_formula((record['row_index'], record['col_index']), record['value'])
+        await self._recalculate(data_connection, set(self.formulas))
+
+    def _set_formula(self, cell: tuple[int, int], source: str | None):
+        self._remove_formula(cell)
+        if not is_formula(source):
+            return
+
+        try:
+            node = parse_formula(source)
+        except FormulaError:
+            node = ("value", PARSE_ERROR)
+        self.formulas[cell] = node
+        cells, ranges = references(node)
+        self.precedents[cell] = (cells, ranges)
+        for precedent in cells:
+            self.cell_dependents.setdefault(precedent, set()).add(cell)
+        for cell_range in ranges:
+            self.range_dependents.setdefault(cell_range, set()).add(cell)
+
+    def _remove_formula(self, cell: tuple[int, int]):
+        if cell not in self.formulas:
+            return
+        del self.formulas[cell]
+        self.results.pop(cell, None)
+        cells, ranges = self.precedents.pop(cell)
+        for precedent in cells:
+            self.cell_dependents[precedent].discard(cell)
+            if not self.cell_dependents[precedent]:
+                del self.cell_dependents[precedent]
+        for cell_range in ranges:
+            self.range_dependents[cell_range].discard(cell)
+            if not self.range_dependents[cell_range]:
+                del self.range_dependents[cell_range]
+                self.range_aggregates.pop(cell_range, None)
+
+    def _dependents(self, cell: tuple[int, int]) -> set[tuple[int, int]]:
+        dependents = set(self.cell_dependents.get(cell, ()))
+        for cell_range, formulas in self.range_dependents.items():
+            if _in_range(cell, cell_range):
+                dependents |= formulas
+        return dependents
+
+    async def apply_changes(self, data_connection: Connection, changes: list[tuple[int, int, str | None]]):
+        dirty = set()
+        pending = []
+        for row, col, value in changes:
+            cell = (row, col)
+            self._set_formula(cell, value)
+            if cell in self.formulas:
+                dirty.add(cell)
+            pending.append(cell)
+            for cell_range in [cell_range for cell_range in self.range_aggregates if _in_range(cell, cell_range)]:
+                del self.range_aggregates[cell_range]
+
+        # Everything downstream of a changed cell is dirty, everything else keeps its cached result
+        while pending:
+            for dependent in self._dependents(pending.pop()):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    pending.append(dependent)
+
+        await self._recalculate(data_connection, dirty)
+
+    def _formula_precedents(self, cell: tuple[int, int], candidates: set[tuple[int, int]]) -> set[tuple[int, int]]:
+        cells, ranges = self.precedents[cell]
+        found = cells & candidates
+        for cell_range in ranges:
+            found |= {candidate for candidate in candidates if _in_range(candidate, cell_range)}
+        return found
+
+    def _evaluation_order(self, dirty: set[tuple[int, int]]) -> tuple[list[tuple[int, int]], set[tuple[int, int]]]:
+        order = []
+        cyclic = set()
+        state = {}
+        for start in dirty:
+            if start in state:
+                continue
+            stack = [(start, iter(self._formula_precedents(start, dirty)))]
+            state[start] = "visiting"
+            while stack:
+                cell, precedents = stack[-1]
+                for precedent in precedents:
+                    if state.get(precedent) == "visiting":
+                        cyclic.update(entry[0] for entry in stack)
+                    elif precedent not in state:
+                        state[precedent] = "visiting"
+                        stack.append((precedent, iter(self._formula_precedents(precedent, dirty))))
+                        break
+                else:
+                    state[cell] = "done"
+                    order.append(cell)
+                    stack.pop()
+        return order, cyclic
+
+    async def _recalculate(self, data_connection: Connection, dirty: set[tuple[int, int]]):
+        if not dirty:
+            return
+        order, cyclic = self._evaluation_order(dirty)
+
+        # Inputs are fetched in bulk before evaluation: one query for single cells, one aggregate query per range
+        inputs = set()
+        for cell in order:
+            inputs |= self.precedents[cell][0] - self.formulas.keys()
+            for cell_range in self.precedents[cell][1]:
+                if cell_range not in self.range_aggregates:
+                    self.range_aggregates[cell_range] = await get_range_aggregates(data_connection, self.schema, self.table_name, *cell_range)
+        values = await get_cells(data_connection, self.schema, self.table_name, inputs)
+
+        for cell in order:
+            if cell in cyclic:
+                self.results[cell] = CYCLE_ERROR
+            else:
+                self.results[cell] = self._evaluate(self.formulas[cell], values)
+
+    def _cell_value(self, cell: tuple[int, int], values: dict):
+        if cell in self.formulas:
+            return self.results.get(cell)
+        return values.get(cell)
+
+    def _aggregate(self, name: str, args: tuple, values: dict):
+        count, total, low, high = 0, [], None, None
+        for arg in args:
+            if arg[0] == "range":
+                cell_range = arg[1:]
+                range_count, range_sum, range_min, range_max = self.range_aggregates[cell_range]
+                if range_count:
+                    count += range_count
+                    total.append(range_sum)
+                    low = range_min if low is None else min(low, range_min)
+                    high = range_max if high is None else max(high, range_max)
+                # Formula cells are stored as text, their numeric results are added on top of the database aggregate
+                numbers = [self.results.get(cell) for cell in self.formulas if _in_range(cell, cell_range)]
+            elif arg[0] == "cell":
+                # Like in ranges, referenced text and empty cells are skipped
+                numbers = [self._evaluate(arg, values)]
+            else:
+                numbers = [_number(self._evaluate(arg, values))]
+            for number in numbers:
+                if isinstance(number, CellError):
+                    return number
+                if isinstance(number, float):
+                    count += 1
+                    total.append(number)
+                    low = number if low is None else min(low, number)
+                    high = number if high is None else max(high, number)
+
+        if name == "COUNT":
+            return float(count)
+        if name == "SUM":
+            return math.fsum(total)
+        if name == "AVERAGE":
+            return math.fsum(total) / count if count else DIV_ZERO
+        if name == "MIN":
+            return 0.0 if low is None else low
+        return 0.0 if high is None else high
+
+    def _evaluate(self, node: tuple, values: dict):
+        kind = node[0]
+        if kind == "value":
+            return node[1]
+        if kind == "cell":
+            value = self._cell_value(node[1:], values)
+            if isinstance(value, str) and _NUMBER_PATTERN.match(value):
+                return float(value)
+            return value
+        if kind == "range":
+            return VALUE_ERROR
+        if kind == "negate":
+            number = _number(self._evaluate(node[1], values))
+            return number if isinstance(number, CellError) else -number
+        if kind == "binary":
+            return self._binary(node[1], self._evaluate(node[2], values), self._evaluate(node[3], values))
+        return self._call(node[1], node[2], values)
+
+    def _binary(self, operator: str, left, right):
+        for value in (left, right):
+            if isinstance(value, CellError):
+                return value
+        if operator == "&":
+            return _text(left) + _text(right)
+        if operator in _COMPARISONS:
+            if isinstance(left, str) or isinstance(right, str):
+                return _COMPARISONS[operator](_text(left).lower(), _text(right).lower())
+            return _COMPARISONS[operator](_number(left), _number(right))
+
+        left, right = _number(left), _number(right)
+        for value in (left, right):
+            if isinstance(value, CellError):
+                return value
+        if operator == "+":
+            return left + right
+        if operator == "-":
+            return left - right
+        if operator == "*":
+            return left * right
+        if operator == "/":
+            return left / right if right else DIV_ZERO
+        try:
+            result = left ** right
+        except (OverflowError, ZeroDivisionError):
+            return VALUE_ERROR
+        return VALUE_ERROR if isinstance(result, complex) else result
+
+    def _call(self, name: str, args: tuple, values: dict):
+        if name in _AGGREGATES:
+            return self._aggregate(name, args, values)
+
+        if name == "IF":
+            if len(args) not in (2, 3):
+                return VALUE_ERROR
+            condition = _truthy(self._evaluate(args[0], values))
+            if isinstance(condition, CellError):
+                return condition
+            if condition:
+                return self._evaluate(args[1], values)
+            return self._evaluate(args[2], values) if len(args) == 3 else False
+
+        evaluated = [self._evaluate(arg, values) for arg in args]
+        for value in evaluated:
+            if isinstance(value, CellError):
+                return value
+
+        if name in ("AND", "OR", "NOT"):
+            flags = [_truthy(value) for value in evaluated]
+            for flag in flags:
+                if isinstance(flag, CellError):
+                    return flag
+            if name == "NOT":
+                return not flags[0] if len(flags) == 1 else VALUE_ERROR
+            return all(flags) if name == "AND" else any(flags)
+        if name == "CONCAT":
+            return "".join(_text(value) for value in evaluated)
+        if name in ("LEN", "UPPER", "LOWER"):
+            if len(evaluated) != 1:
+                return VALUE_ERROR
+            text = _text(evaluated[0])
+            return float(len(text)) if name == "LEN" else text.upper() if name == "UPPER" else text.lower()
+        if name in ("ABS", "ROUND"):
+            numbers = [_number(value) for value in evaluated]
+            for number in numbers:
+                if isinstance(number, CellError):
+                    return number
+            if name == "ABS":
+                return abs(numbers[0]) if len(numbers) == 1 else VALUE_ERROR
+            if len(numbers) not in (1, 2):
+                return VALUE_ERROR
+            digits = int(numbers[1]) if len(numbers) == 2 else 0
+            return math.copysign(math.floor(abs(numbers[0]) * 10 ** digits + 0.5), numbers[0]) / 10 ** digits
+        return NAME_ERROR
+
+
+_tables: OrderedDict[tuple[str, str], TableFormulas] = OrderedDict()
+
+
+async def get_table_formulas(data_connection: Connection, schema: str, table_name: str) -> TableFormulas:
+    key = (schema, table_name)
+    formulas = _tables.get(key)
+    if formulas is None:
+        formulas = TableFormulas(schema, table_name)
+        await formulas.load(data_connection)
+        _tables[key] = formulas
+        if len(_tables) > MAX_FORMULA_TABLES:
+            _tables.popitem(last=False)
+    else:
+        _tables.move_to_end(key)
+    return formulas
+
+
+def discard_table_formulas(schema: str, table_name: str):
+    _tables.pop((schema, table_name), None)
+
+
+async def get_computed_range(data_connection: Connection, schema: str, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> list[tuple[int, int, str | None]]:
+    cells = await get_range(data_connection, schema, table_name, start_row, end_row, start_col, end_col)
+    if not any(is_formula(value) for _, _, value in cells):
+        return cells
+
+    formulas = await get_table_formulas(data_connection, schema, table_name)
+    return [
+        (row, col, format_value(formulas.results.get((row, col))) if is_formula(value) else value)
+        for row, col, value in cells
+    ]
+
+
+async def _on_cells_written(data_connection: Connection, schema: str, table_name: str, cells: list[tuple[int, int, str | None]] | None):
+    formulas = _tables.get((schema, table_name))
+    if formulas is None:
+        return
+
+    # Writes inside an open transaction may still be rolled back, the table is then reloaded on the next read
+    if cells is None or data_connection.is_in_transaction():
+        discard_table_formulas(schema, table_name)
+        return
+    try:
+        await formulas.apply_changes(data_connection, cells)
+    except Exception:
+        discard_table_formulas(schema, table_name)
+        raise
+
+
+def _on_table_changed(schema: str | None, table_name: str | None, cells: list[tuple[int, int, str | None]] | None, local: bool):
+    # Local writes were already applied by _on_cells_written, changes from other workers reload the table
+    if schema is None:
+        _tables.clear()
+    elif not local:
+        discard_table_formulas(schema, table_name)
+
+
+add_write_listener(_on_cells_written)
+subscribe(_on_table_changed)
@@ -0,0 +1,100 @@
+import asyncio
+import csv
+import io
+import os
+from dataclasses import dataclass
+from itertools import islice
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator
+
+from asyncpg import Connection
+
+from backend.data_management.table_handler import set_cell_values
+
+IMPORT_BATCH_SIZE = 10000
+
+IMPORT_FORMATS = ("csv", "xlsx")
+
+
+@dataclass
+class ImportProgress:
+    cells: int = 0
+    rows: int = 0
+    bytes_read: int = 0
+    total_bytes: int | None = None
+
+
+def _file_size(file: BinaryIO) -> int | None:
+    try:
+        position = file.tell()
+        size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+        return size
+    except (OSError, ValueError):
+        return None
+
+
+def iter_csv_cells(file: BinaryIO, progress: ImportProgress, start_row: int = 0, start_col: int = 0, delimiter: str = ",", encoding: str = "utf-8-sig") -> Iterator[tuple[int, int, str]]:
+    text = io.TextIOWrapper(file, encoding=encoding, newline="")
+    try:
+        for row_offset, values in enumerate(csv.reader(text, delimiter=delimiter)):
+            for col_offset, value in enumerate(values):
+                if value:
+                    yield start_row + row_offset, start_col + col_offset, value
+            progress.rows = row_offset + 1
+            # The wrapper reads ahead, so the position of the underlying file is an estimate
+            progress.bytes_read = file.tell()
+    finally:
+        # Keep the caller's file open, the wrapper would close it on garbage collection
+        text.detach()
+
+
+def iter_xlsx_cells(file: BinaryIO, progress: ImportProgress, start_row: int = 0, start_col: int = 0, sheet_name: str | None = None) -> Iterator[tuple[int, int, str]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("XLSX import requires the openpyxl package")
+
+    # read_only streams the sheet XML instead of building the whole workbook in memory
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.active
+        for row_offset, values in enumerate(sheet.iter_rows(values_only=True)):
+            for col_offset, value in enumerate(values):
+                if value is None or value == "":
+                    continue
+                if hasattr(value, "isoformat"):
+                    value = value.isoformat()
+                yield start_row + row_offset, start_col + col_offset, str(value)
+            progress.rows = row_offset + 1
+            # The sheet is inflated from the zip archive in chunks, the position in the archive follows the rows read
+            progress.bytes_read = file.tell()
+        if progress.total_bytes is not None:
+            progress.bytes_read = progress.total_bytes
+    finally:
+        workbook.close()
+
+
+async def stream_import(data_connection: Connection, schema: str, table_name: str, cells: Iterable[tuple[int, int, str]], progress: ImportProgress, batch_size: int = IMPORT_BATCH_SIZE) -> AsyncIterator[ImportProgress]:
+    iterator = iter(cells)
+    # Parsing runs in a worker thread and every batch is committed on its own, so only one batch is ever held in memory
+    while batch := await asyncio.to_thread(list, islice(iterator, batch_size)):
+        progress.cells += await set_cell_values(data_connection, schema, table_name, batch)
+        yield progress
+
+
+def file_cells(file: BinaryIO, file_format: str, progress: ImportProgress, start_row: int = 0, start_col: int = 0) -> Iterator[tuple[int, int, str]]:
+    progress.total_bytes = _file_size(file)
+
+    if file_format == "csv":
+        return iter_csv_cells(file, progress, start_row, start_col)
+    if file_format == "xlsx":
+        return iter_xlsx_cells(file, progress, start_row, start_col)
+    raise ValueError(f"Unsupported import format {file_format}, expected one of {', '.join(IMPORT_FORMATS)}")
+
+
+async def import_file(data_connection: Connection, schema: str, table_name: str, file: BinaryIO, file_format: str, start_row: int = 0, start_col: int = 0, batch_size: int = IMPORT_BATCH_SIZE) -> ImportProgress:
+    progress = ImportProgress()
+    cells = file_cells(file, file_format, progress, start_row, start_col)
+    async for _ in stream_import(data_connection, schema, table_name, cells, progress, batch_size):
+        pass
+    return progress
@@ -0,0 +1,271 @@
+import bisect
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable
+from uuid import UUID
+
+import asyncpg
+from asyncpg import Connection
+
+from backend.data_management.change_feed import NotificationListener, PROCESS_ID
+from backend.data_management.pool_manager import reading_replica
+from backend.data_management.shared_storage import forget_project_layout, get_permission_table
+
+logger = logging.getLogger("api_logger")
+
+PERMISSION_CHANNEL = "flowtables_permissions"
+
+PERMISSION_LEVELS = ("none", "read", "write")
+
+MAX_PERMISSION_INDEXES = int(os.getenv("PERMISSION_INDEX_CACHE_SIZE", "4096"))
+
+# (start_row, end_row, start_col, end_col, permission)
+Rectangle = tuple[int, int, int, int, str]
+
+# Called with (project, table, user, local) once a permission change is committed, None matches everything
+PermissionSubscriber = Callable[[str | None, str | None, str | None, bool], None]
+_subscribers: list[PermissionSubscriber] = []
+
+# Awaited with (user_connection, project, table, user) in the write path of every permission change, before it is announced
+PermissionWriteListener = Callable[[Connection, UUID, UUID | str | None, UUID | None], Awaitable[None]]
+_write_listeners: list[PermissionWriteListener] = []
+
+
+class PermissionIndex:
+    # A user's permission rectangles on one table compiled into row slabs of sorted, non-overlapping column runs.
+    # Where rectangles overlap the highest permission wins, cells outside every rectangle have permission none.
+
+    def __init__(self, rectangles: Iterable[Rectangle]):
+        rectangles = [rectangle for rectangle in rectangles if rectangle[4] != "none"]
+        self.slab_starts: list[int] = []
+        self.slabs: list[tuple[int, list[int], list[tuple[int, int, int]]]] = []
+
+        boundaries = sorted({rectangle[0] for rectangle in rectangles} | {rectangle[1] + 1 for rectangle in rectangles})
+        by_start = sorted(rectangles, key=lambda rectangle: rectangle[0])
+        active = []
+        next_rectangle = 0
+        for slab_start, slab_after in zip(boundaries, boundaries[1:]):
+            while next_rectangle < len(by_start) and by_start[next_rectangle][0] <= slab_start:
+                active.append(by_start[next_rectangle])
+                next_rectangle += 1
+            active = [rectangle for rectangle in active if rectangle[1] >= slab_start]
+            runs = self._column_runs(active)
+            if not runs:
+                continue
+            # Consecutive slabs with the same runs are stored once
+            if self.slabs and self.slabs[-1][0] == slab_start - 1 and self.slabs[-1][2] == runs:
+                self.slabs[-1] = (slab_after - 1, self.slabs[-1][1], runs)
+            else:
+                self.slab_starts.append(slab_start)
+                self.slabs.append((slab_after - 1, [run[0] for run in runs], runs))
+
+    @staticmethod
+    def _column_runs(rectangles: list[Rectangle]) -> list[tuple[int, int, int]]:
+        # Sweep over the column bounds counting the open rectangles per level
+        events = sorted(
+            [(rectangle[2], 1, PERMISSION_LEVELS.index(rectangle[4])) for rectangle in rectangles]
+            + [(rectangle[3] + 1, -1, PERMISSION_LEVELS.index(rectangle[4])) for rectangle in rectangles]
+        )
+        counts = [0] * len(PERMISSION_LEVELS)
+        runs = []
+        index = 0
+        while index < len(events):
+            position = events[index][0]
+            while index < len(events) and events[index][0] == position:
+                counts[events[index][2]] += events[index][1]
+                index += 1
+            level = max((level for level, count in enumerate(counts) if count > 0), default=0)
+            if runs and runs[-1][1] is None:
+                if runs[-1][2] == level:
+                    continue
+                runs[-1] = (runs[-1][0], position - 1, runs[-1][2])
+            if level > 0:
+                runs.append((position, None, level))
+        return runs
+
+    def _slab_index(self, row: int) -> int | None:
+        index = bisect.bisect_right(self.slab_starts, row) - 1
+        if index < 0 or self.slabs[index][0] < row:
+            return None
+        return index
+
+    def cell(self, row: int, col: int) -> str:
+        index = self._slab_index(row)
+        if index is None:
+            return "none"
+        _, run_starts, runs = self.slabs[index]
+        run = bisect.bisect_right(run_starts, col) - 1
+        if run < 0 or runs[run][1] < col:
+            return "none"
+        return PERMISSION_LEVELS[runs[run][2]]
+
+    def viewport(self, start_row: int, end_row: int, start_col: int, end_col: int) -> list[Rectangle]:
+        # Non-overlapping rectangles clipped to the viewport, everything not covered has permission none
+        result = []
+        index = max(bisect.bisect_right(self.slab_starts, start_row) - 1, 0)
+        while index < len(self.slabs) and self.slab_starts[index] <= end_row:
+            slab_end, run_starts, runs = self.slabs[index]
+            if slab_end >= start_row:
+                run = max(bisect.bisect_right(run_starts, start_col) - 1, 0)
+                while run < len(runs) and runs[run][0] <= end_col:
+                    run_start, run_end, level = runs[run]
+                    if run_end >= start_col:
+                        result.append((max(self.slab_starts[index], start_row), min(slab_end, end_row), max(run_start, start_col), min(run_end, end_col), PERMISSION_LEVELS[level]))
+                    run += 1
+            index += 1
+        return result
+
+    def viewport_permission(self, start_row: int, end_row: int, start_col: int, end_col: int) -> str:
+        # The permission the user has on every cell of the viewport
+        rectangles = self.viewport(start_row, end_row, start_col, end_col)
+        if not rectangles:
+            return "none"
+        covered = sum((rectangle[1] - rectangle[0] + 1) * (rectangle[3] - rectangle[2] + 1) for rectangle in rectangles)
+        if covered < (end_row - start_row + 1) * (end_col - start_col + 1):
+            return "none"
+        return min(rectangles, key=lambda rectangle: PERMISSION_LEVELS.index(rectangle[4]))[4]
+
+    def rectangles(self) -> list[Rectangle]:
+        return [
+            (slab_start, slab_end, run_start, run_end, PERMISSION_LEVELS[level])
+            for slab_start, (slab_end, _, runs) in zip(self.slab_starts, self.slabs)
+            for run_start, run_end, level in runs
+        ]
+
+
+def subtract_rectangle(rectangle: Rectangle, cut: tuple[int, int, int, int, str]) -> list[Rectangle]:
+    # The parts of rectangle outside of cut, at most one band above, below, left and right of it
+    start_row, end_row, start_col, end_col, permission = rectangle
+    if cut[0] > end_row or cut[1] < start_row or cut[2] > end_col or cut[3] < start_col:
+        return [rectangle]
+    pieces = []
+    if start_row < cut[0]:
+        pieces.append((start_row, cut[0] - 1, start_col, end_col, permission))
+    if end_row > cut[1]:
+        pieces.append((cut[1] + 1, end_row, start_col, end_col, permission))
+    middle_start, middle_end = max(start_row, cut[0]), min(end_row, cut[1])
+    if start_col < cut[2]:
+        pieces.append((middle_start, middle_end, start_col, cut[2] - 1, permission))
+    if end_col > cut[3]:
+        pieces.append((middle_start, middle_end, cut[3] + 1, end_col, permission))
+    return pieces
+
+
+def normalize_rectangles(rectangles: Iterable[Rectangle]) -> list[Rectangle]:
+    # Non-overlapping rectangles with the same effective permissions, merged wherever they touch
+    merged = []
+    open_runs = {}
+    for rectangle in PermissionIndex(rectangles).rectangles():
+        # Runs with the same columns and permission in consecutive slabs become one rectangle
+        key = rectangle[2:]
+        previous = open_runs.get(key)
+        if previous is not None and merged[previous][1] == rectangle[0] - 1:
+            merged[previous] = (merged[previous][0], rectangle[1], *key)
+        else:
+            open_runs[key] = len(merged)
+            merged.append(rectangle)
+    return merged
+
+
+_indexes: OrderedDict[tuple[str, str, str], PermissionIndex] = OrderedDict()
+_generation = 0
+_hits = 0
+_misses = 0
+
+
+async def get_permission_index(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID) -> PermissionIndex:
+    global _hits, _misses
+    key = (str(project_id), str(table_id), str(user_id))
+    index = _indexes.get(key)
+    if index is not None:
+        _indexes.move_to_end(key)
+        _hits += 1
+        return index
+
+    _misses += 1
+    generation = _generation
+    permissions = await get_permission_table(user_connection, project_id)
+    results = await user_connection.fetch(f'''
+        SELECT start_row, end_row, start_col, end_col, permission FROM {permissions.relation} WHERE {permissions.scope} AND table_id = $1 AND user_id = $2
+    ''', table_id, user_id)
+    index = PermissionIndex(tuple(record) for record in results)
+    # Indexes read inside a transaction, from a replica or before an invalidation may be outdated and are not kept
+    if generation == _generation and not user_connection.is_in_transaction() and not reading_replica.get():
+        _indexes[key] = index
+        while len(_indexes) > MAX_PERMISSION_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def invalidate_permission_indexes(project_id: UUID | None = None, table_id: UUID | None = None, user_id: UUID | None = None):
+    # None matches everything, so a missing project clears all indexes
+    global _generation
+    _generation += 1
+    if project_id is None:
+        _indexes.clear()
+        return
+    for key in [key for key in _indexes
+                if key[0] == str(project_id)
+                and (table_id is None or key[1] == str(table_id))
+                and (user_id is None or key[2] == str(user_id))]:
+        del _indexes[key]
+
+
+def permission_index_stats() -> dict[str, int]:
+    return {"indexes": len(_indexes), "max_indexes": MAX_PERMISSION_INDEXES, "hits": _hits, "misses": _misses}
+
+
+def subscribe_permissions(subscriber: PermissionSubscriber):
+    _subscribers.append(subscriber)
+
+
+def add_permission_write_listener(listener: PermissionWriteListener):
+    _write_listeners.append(listener)
+
+
+def _dispatch(project_id: str | None, table_id: str | None, user_id: str | None, local: bool):
+    invalidate_permission_indexes(project_id, table_id, user_id)
+    # Changes of a whole project include the migration to another storage layout
+    if table_id is None and user_id is None:
+        forget_project_layout(project_id)
+    for subscriber in _subscribers:
+        try:
+            subscriber(project_id, table_id, user_id, local)
+        except Exception:
+            logger.error("Permission subscriber failed", exc_info=True)
+
+
+async def permissions_changed(user_connection: Connection, project_id: UUID, table_id: UUID | None = None, user_id: UUID | None = None):
+    invalidate_permission_indexes(project_id, table_id, user_id)
+    for listener in _write_listeners:
+        await listener(user_connection, project_id, table_id, user_id)
+    await user_connection.execute("SELECT pg_notify($1, $2)", PERMISSION_CHANNEL, json.dumps({
+        "origin": PROCESS_ID,
+        "project": str(project_id),
+        "table": None if table_id is None else str(table_id),
+        "user": None if user_id is None else str(user_id),
+    }))
+
+
+def _on_notification(payload: str):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning("Ignoring malformed permission notification", exc_info=True)
+        return
+    _dispatch(message["project"], message["table"], message["user"], message.get("origin") == PROCESS_ID)
+
+
+_listener = NotificationListener(PERMISSION_CHANNEL, _on_notification, lambda: _dispatch(None, None, None, False))
+
+
+async def start_permission_feed(pool: asyncpg.Pool):
+    await _listener.start(pool)
+    print("Permission feed listening.")
+
+
+async def stop_permission_feed():
+    if await _listener.stop():
+        print("Permission feed stopped.")
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from uuid import UUID
+
+import asyncpg
+from asyncpg import Connection
+
+from backend.data_management.pool_manager import DATA_POOL, USER_POOL, pool_manager
+from backend.data_management.permission_index import PermissionIndex, add_permission_write_listener, subscribe_permissions
+from backend.data_management.shared_storage import get_permission_table
+from backend.data_management.table_handler import get_range_sql
+
+logger = logging.getLogger("api_logger")
+
+# The compiled, non-overlapping readable rectangles of every user are mirrored into permission_mirror in the data
+# database, so masked reads can join cells and permissions in one statement
+
+
+async def _delete_mirror_rows(data_connection: Connection, project_id: UUID | str, table_id: UUID | str | None, user_id: UUID | None):
+    await data_connection.execute('''
+        DELETE FROM permission_mirror
+        WHERE schema_name = $1 AND ($2::text IS NULL OR table_id = $2) AND ($3::uuid IS NULL OR user_id = $3)
+    ''', str(project_id), None if table_id is None else str(table_id), user_id)
+
+
+async def sync_permission_mirror(user_connection: Connection, data_connection: Connection, project_id: UUID, table_id: UUID | str | None = None, user_id: UUID | None = None):
+    # Rebuilds the mirror of a project, optionally only for one table and user
+    table_id = None if table_id is None else str(table_id)
+    async with data_connection.transaction():
+        # Refreshes of one project are serialized so an older read never overwrites a newer one
+        await data_connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', f"permission_mirror:{project_id}")
+        permissions = await get_permission_table(user_connection, project_id)
+        try:
+            # Compared as text, delete_table passes the table name
+            results = await user_connection.fetch(f'''
+                SELECT table_id, user_id, start_row, end_row, start_col, end_col, permission FROM {permissions.relation}
+                WHERE {permissions.scope} AND ($1::text IS NULL OR table_id::text = $1) AND ($2::uuid IS NULL OR user_id = $2)
+            ''', table_id, user_id)
+        except asyncpg.UndefinedTableError:
+            # The project was deleted
+            results = []
+
+        rectangles = {}
+        for record in results:
+            rectangles.setdefault((str(record['table_id']), record['user_id']), []).append(
+                (record['start_row'], record['end_row'], record['start_col'], record['end_col'], record['permission'])
+            )
+        records = [
+            (str(project_id), mirrored_table, mirrored_user, *rectangle)
+            for (mirrored_table, mirrored_user), user_rectangles in rectangles.items()
+            for rectangle in PermissionIndex(user_rectangles).rectangles()
+        ]
+
+        await _delete_mirror_rows(data_connection, project_id, table_id, user_id)
+        if records:
+            await data_connection.copy_records_to_table('permission_mirror', records=records, columns=[
+                'schema_name', 'table_id', 'user_id', 'start_row', 'end_row', 'start_col', 'end_col', 'permission'
+            ])
+
+
+async def _update_mirror(user_connection: Connection, project_id: UUID, table_id: UUID | str | None, user_id: UUID | None):
+    # Runs in the write path of every permission change. A committed change is mirrored right away. A change inside an
+    # open transaction may still roll back, its rows are removed so masked reads fail closed until the refresh after the commit.
+    if pool_manager.get(DATA_POOL) is None:
+        return
+    async with pool_manager.acquire(DATA_POOL) as data_connection:
+        if not user_connection.is_in_transaction():
+            try:
+                await sync_permission_mirror(user_connection, data_connection, project_id, table_id, user_id)
+                return
+            except Exception:
+                logger.error(f"Mirroring the permissions of project {project_id} failed, its rows are removed instead", exc_info=True)
+        async with data_connection.transaction():
+            await data_connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', f"permission_mirror:{project_id}")
+            await _delete_mirror_rows(data_connection, project_id, table_id, user_id)
+
+
+async def _refresh_mirror(project_id: str, table_id: str | None, user_id: str | None):
+    if pool_manager.get(DATA_POOL) is None or pool_manager.get(USER_POOL) is None:
+        return
+    try:
+        async with pool_manager.acquire(DATA_POOL) as data_connection, pool_manager.acquire(USER_POOL) as user_connection:
+            await sync_permission_mirror(user_connection, data_connection, project_id, table_id, user_id)
+    except Exception:
+        logger.error(f"Refreshing the permission mirror of project {project_id} failed", exc_info=True)
+
+
+# Running refreshes are referenced here until they finish, the loop only keeps weak references
+_tasks: set[asyncio.Task] = set()
+_resync_task: asyncio.Task | None = None
+_resync_again = False
+
+
+def _start(coroutine) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _resync_all_mirrors():
+    # Rebuilds the mirror of every project, including projects that were deleted in the meantime
+    global _resync_again
+    while True:
+        _resync_again = False
+        if pool_manager.get(DATA_POOL) is None or pool_manager.get(USER_POOL) is None:
+            return
+        try:
+            async with pool_manager.acquire(DATA_POOL) as data_connection, pool_manager.acquire(USER_POOL) as user_connection:
+                project_ids = {str(record['project_id']) for record in await user_connection.fetch('SELECT project_id FROM projects')}
+                project_ids |= {record['schema_name'] for record in await data_connection.fetch('SELECT DISTINCT schema_name FROM permission_mirror')}
+        except Exception:
+            logger.error("Listing the projects for a permission mirror resync failed", exc_info=True)
+            return
+        for project_id in project_ids:
+            await _refresh_mirror(project_id, None, None)
+        if not _resync_again:
+            return
+
+
+def _schedule_resync():
+    # One resync at a time, a reset during a running resync starts another one once it finished
+    global _resync_task, _resync_again
+    if _resync_task is not None and not _resync_task.done():
+        _resync_again = True
+        return
+    _resync_task = _start(_resync_all_mirrors())
+
+
+def _on_permissions_changed(project_id: str | None, table_id: str | None, user_id: str | None, local: bool):
+    # Only the worker that changed the permissions refreshes the mirror again, after the change was committed.
+    # A reset means notifications may have been lost while the listener was disconnected, so every mirror is rebuilt.
+    if project_id is None:
+        _schedule_resync()
+    elif local:
+        _start(_refresh_mirror(project_id, table_id, user_id))
+
+
+add_permission_write_listener(_update_mirror)
+subscribe_permissions(_on_permissions_changed)
+
+
+async def get_masked_range(data_connection: Connection, schema: str, table_name: str, table_id: UUID, user_id: UUID, start_row: int, end_row: int, start_col: int, end_col: int) -> list[tuple[int, int, str, str]]:
+    # Cells of the range the user may read with their permission, filtered by Postgres in a single statement
+    if end_row < start_row or end_col < start_col:
+        raise ValueError("Range end must not be before range start")
+
+    range_sql, args = await get_range_sql(data_connection, schema, table_name, start_row, end_row, start_col, end_col)
+    results = await data_connection.fetch(f'''
+        SELECT cells.row_index, cells.col_index, cells.value, mirror.permission
+        FROM ({range_sql}) AS cells
+        JOIN permission_mirror AS mirror
+            ON mirror.schema_name = ${len(args) + 1} AND mirror.table_id = ${len(args) + 2} AND mirror.user_id = ${len(args) + 3}
+            AND cells.row_index BETWEEN mirror.start_row AND mirror.end_row
+            AND cells.col_index BETWEEN mirror.start_col AND mirror.end_col
+        ORDER BY cells.row_index, cells.col_index
+    ''', *args, schema, str(table_id), user_id)
+    return [(record['row_index'], record['col_index'], record['value'], record['permission']) for record in results]
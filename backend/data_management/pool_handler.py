@@ -1,41 +1,28 @@
-import asyncpg
-from dotenv import load_dotenv
-import os
+from starlette.requests import Request
 
-# noinspection PyTypeChecker
-data_pool : asyncpg.Pool = None
+from backend.data_management.change_feed import start_change_feed, stop_change_feed
+from backend.data_management.deletion_queue import start_deletion_worker, stop_deletion_worker
+from backend.data_management.pool_manager import DATA_POOL, pool_manager
+from backend.data_management.replica_router import LAST_WRITE_KEY, replica_router
+from backend.data_management.table_handler import STORAGE_MODE_SQL
 
-async def init_data_pool():
+pool_manager.register_warmup(DATA_POOL, STORAGE_MODE_SQL)
 
-    print("Initializing data database pool...")
+async def start_data_services():
+    # Background services on the data database, its pool is opened by the pool manager first
+    data_pool = pool_manager.get(DATA_POOL)
+    await start_change_feed(data_pool)
+    await start_deletion_worker(data_pool)
 
-    load_dotenv('.env.deployment')
-    host = os.getenv('POSTGRES_HOST')
-    port = os.getenv('POSTGRES_PORT')
-    database = os.getenv('DATA_DB_NAME')
-    user = os.getenv('POSTGRES_USER')
-    password = os.getenv('POSTGRES_PASSWORD')
-
-    global data_pool
-    # noinspection PyUnresolvedReferences
-    data_pool = await asyncpg.create_pool(
-        host=host,
-        port=port,
-        database=database,
-        user=user,
-        password=password,
-    )
-
-    print("Data database pool initialized.")
-
-async def close_data_pool():
-    global data_pool
-    if data_pool is not None:
-        await data_pool.close()
-        data_pool = None
-
-        print("Data database pool closed.")
+async def stop_data_services():
+    await stop_deletion_worker()
+    await stop_change_feed()
 
 async def get_data_pool():
-    with data_pool.acquire() as conn:
-        yield conn
\ No newline at end of file
+    async with pool_manager.acquire(DATA_POOL) as conn:
+        yield conn
+
+async def get_data_read_pool(request: Request):
+    # For handlers that only read, served by the data replica when one is configured and recent enough
+    async with replica_router.read(DATA_POOL, request.session.get(LAST_WRITE_KEY)) as conn:
+        yield conn
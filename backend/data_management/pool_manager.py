@@ -0,0 +1,205 @@
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+import asyncpg
+from asyncpg import Connection
+from dotenv import load_dotenv
+
+logger = logging.getLogger("api_logger")
+
+DATA_POOL = "data"
+USER_POOL = "users"
+
+# Positional parameters of a warm-up statement
+_PLACEHOLDER = re.compile(r'\$(\d+)')
+
+# Set while a request reads through a replica connection, the process wide caches must not keep what it reads
+reading_replica: ContextVar[bool] = ContextVar("reading_replica", default=False)
+
+if os.getenv('CI') is None:
+    load_dotenv('.env.deployment')
+
+
+def replica_name(name: str) -> str:
+    return f"{name}_replica"
+
+
+@dataclass
+class PoolSettings:
+    database: str
+    host: str | None = None
+    port: str | None = None
+    min_size: int = 2
+    max_size: int = 10
+    # Connections are replaced after this many queries or after being idle this many seconds
+    max_queries: int = 50000
+    max_inactive_lifetime: float = 300.0
+    statement_cache_size: int = 100
+    command_timeout: float | None = 60.0
+
+    @classmethod
+    def from_env(cls, prefix: str, database: str, host: str | None = None, port: str | None = None) -> "PoolSettings":
+        # e.g. DATA_POOL_MAX_SIZE=20, a command timeout of 0 disables it
+        def setting(name: str, default):
+            return type(default)(os.getenv(f"{prefix}_POOL_{name}", default))
+        command_timeout = setting("COMMAND_TIMEOUT", 60.0)
+        return cls(
+            database=database,
+            host=host,
+            port=port,
+            min_size=setting("MIN_SIZE", cls.min_size),
+            max_size=setting("MAX_SIZE", cls.max_size),
+            max_queries=setting("MAX_QUERIES", cls.max_queries),
+            max_inactive_lifetime=setting("MAX_INACTIVE_LIFETIME", cls.max_inactive_lifetime),
+            statement_cache_size=setting("STATEMENT_CACHE_SIZE", cls.statement_cache_size),
+            command_timeout=command_timeout or None,
+        )
+
+
+class PoolStats:
+
+    def __init__(self):
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_recent = 0.0
+        self.wait_recent_at = 0.0
+        self.opened = 0
+        self.closed = 0
+
+    def recent_wait(self) -> float:
+        # Smoothed over the last few acquires, halves every second without acquires so a past spike fades out
+        return self.wait_recent * 0.5 ** (time.monotonic() - self.wait_recent_at)
+
+    def record_wait(self, seconds: float):
+        self.acquires += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.wait_recent = 0.8 * self.recent_wait() + 0.2 * seconds
+        self.wait_recent_at = time.monotonic()
+
+
+class PoolManager:
+    # Owns the asyncpg pools of the process by name, with their settings, warm-up statements and statistics
+
+    def __init__(self):
+        self.settings: dict[str, PoolSettings] = {
+            DATA_POOL: PoolSettings.from_env("DATA", os.getenv('DATA_DB_NAME')),
+            USER_POOL: PoolSettings.from_env("USER", os.getenv('USER_DB_NAME')),
+        }
+        # Read replicas are optional, e.g. DATA_REPLICA_HOST=replica.local with DATA_REPLICA_PORT and DATA_REPLICA_DB_NAME
+        for name, prefix in ((DATA_POOL, "DATA"), (USER_POOL, "USER")):
+            host, port = os.getenv(f"{prefix}_REPLICA_HOST"), os.getenv(f"{prefix}_REPLICA_PORT")
+            if host or port:
+                self.settings[replica_name(name)] = PoolSettings.from_env(
+                    f"{prefix}_REPLICA", os.getenv(f"{prefix}_REPLICA_DB_NAME", self.settings[name].database), host, port
+                )
+        self.pools: dict[str, asyncpg.Pool] = {}
+        self.stats_by_pool: dict[str, PoolStats] = {}
+        self.warmups: dict[str, list[str]] = {}
+
+    def register_warmup(self, name: str, query: str):
+        # Read-only statements of hot paths, prepared on every new connection so their first use skips parse and plan
+        self.warmups.setdefault(name, []).append(query)
+
+    async def _warm_up(self, name: str, connection: Connection):
+        for query in self.warmups.get(name, []):
+            try:
+                # Running the statement once with NULL arguments prepares it once and stores it in the connection's
+                # statement cache. connection.prepare would bypass the cache and prepare it a second time.
+                arguments = max((int(number) for number in _PLACEHOLDER.findall(query)), default=0)
+                await connection.fetch(query, *[None] * arguments)
+            except Exception:
+                logger.warning(f"Warming up a statement on pool {name} failed: {query}", exc_info=True)
+
+    async def open(self, name: str) -> asyncpg.Pool:
+        if name in self.pools:
+            return self.pools[name]
+        settings = self.settings[name]
+        stats = self.stats_by_pool.setdefault(name, PoolStats())
+
+        def on_close(connection: Connection):
+            stats.closed += 1
+
+        async def init(connection: Connection):
+            stats.opened += 1
+            connection.add_termination_listener(on_close)
+            await self._warm_up(name, connection)
+
+        print(f"Initializing {name} database pool...")
+        # noinspection PyUnresolvedReferences
+        self.pools[name] = await asyncpg.create_pool(
+            host=settings.host or os.getenv('POSTGRES_HOST'),
+            port=settings.port or os.getenv('POSTGRES_PORT'),
+            user=os.getenv('POSTGRES_USER'),
+            password=os.getenv('POSTGRES_PASSWORD'),
+            database=settings.database,
+            min_size=settings.min_size,
+            max_size=settings.max_size,
+            max_queries=settings.max_queries,
+            max_inactive_connection_lifetime=settings.max_inactive_lifetime,
+            statement_cache_size=settings.statement_cache_size,
+            command_timeout=settings.command_timeout,
+            init=init,
+        )
+        print(f"{name.capitalize()} database pool initialized.")
+        return self.pools[name]
+
+    async def close(self, name: str):
+        pool = self.pools.pop(name, None)
+        if pool is not None:
+            await pool.close()
+            print(f"{name.capitalize()} database pool closed.")
+
+    def attach(self, name: str, pool: asyncpg.Pool):
+        # Serves a pool created elsewhere under the name, e.g. the pools of the tests
+        self.pools[name] = pool
+        self.stats_by_pool.setdefault(name, PoolStats())
+
+    def detach(self, name: str) -> asyncpg.Pool | None:
+        return self.pools.pop(name, None)
+
+    def get(self, name: str) -> asyncpg.Pool | None:
+        return self.pools.get(name)
+
+    @asynccontextmanager
+    async def acquire(self, name: str):
+        pool = self.pools.get(name)
+        if pool is None:
+            raise RuntimeError(f"The {name} database pool is not open")
+        start = time.monotonic()
+        async with pool.acquire() as connection:
+            self.stats_by_pool[name].record_wait(time.monotonic() - start)
+            yield connection
+
+    def recent_wait(self, name: str) -> float:
+        stats = self.stats_by_pool.get(name)
+        return 0.0 if stats is None else stats.recent_wait()
+
+    def stats(self) -> dict[str, dict]:
+        result = {}
+        for name, stats in self.stats_by_pool.items():
+            pool = self.pools.get(name)
+            size = pool.get_size() if pool is not None else 0
+            idle = pool.get_idle_size() if pool is not None else 0
+            result[name] = {
+                "open": pool is not None,
+                "size": size,
+                "in_use": size - idle,
+                "max_size": pool.get_max_size() if pool is not None else 0,
+                "acquires": stats.acquires,
+                "wait_avg": stats.wait_total / stats.acquires if stats.acquires else 0.0,
+                "wait_max": stats.wait_max,
+                "wait_recent": stats.recent_wait(),
+                "connections_opened": stats.opened,
+                "connections_closed": stats.closed,
+            }
+        return result
+
+
+pool_manager = PoolManager()
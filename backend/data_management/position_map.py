@@ -0,0 +1,180 @@
+import bisect
+import json
+from typing import Callable
+
+ROW_AXIS = "row"
+COL_AXIS = "col"
+AXES = (ROW_AXIS, COL_AXIS)
+
+MAX_POSITION = 2 ** 31 - 1
+
+# (logical_start, physical_start, physical_end) of a run of consecutive positions
+Interval = tuple[int, int, int]
+
+
+class AxisMap:
+    # Maps the logical positions of one axis to stable physical row or column ids.
+    # The first positions are listed as pieces of (physical_start, length) in logical order, every position after
+    # them maps to logical + offset. Inserted positions get negative ids so they never collide with that tail.
+
+    def __init__(self, pieces: list[tuple[int, int]] | None = None, offset: int = 0, next_id: int = -1):
+        self.pieces = list(pieces or [])
+        self.offset = offset
+        self.next_id = next_id
+        self._update_starts()
+
+    @classmethod
+    def from_json(cls, data: str | None) -> "AxisMap":
+        if data is None:
+            return cls()
+        data = json.loads(data)
+        return cls([tuple(piece) for piece in data["pieces"]], data["offset"], data["next_id"])
+
+    def to_json(self) -> str | None:
+        if self.identity:
+            return None
+        return json.dumps({"pieces": self.pieces, "offset": self.offset, "next_id": self.next_id})
+
+    @property
+    def identity(self) -> bool:
+        return not self.pieces and self.offset == 0
+
+    @property
+    def extent(self) -> int:
+        return self.starts[-1]
+
+    def _update_starts(self):
+        self.starts = [0]
+        for _, length in self.pieces:
+            self.starts.append(self.starts[-1] + length)
+
+    def physical(self, position: int) -> int:
+        if position >= self.extent:
+            return position + self.offset
+        index = bisect.bisect_right(self.starts, position) - 1
+        return self.pieces[index][0] + position - self.starts[index]
+
+    def intervals(self, start: int, end: int) -> list[Interval]:
+        result = []
+        index = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        while index < len(self.pieces) and self.starts[index] <= end:
+            physical_start, length = self.pieces[index]
+            first = max(start, self.starts[index])
+            last = min(end, self.starts[index] + length - 1)
+            if first <= last:
+                result.append((first, physical_start + first - self.starts[index], physical_start + last - self.starts[index]))
+            index += 1
+        if end >= self.extent:
+            first = max(start, self.extent)
+            result.append((first, first + self.offset, min(end + self.offset, MAX_POSITION)))
+        return result
+
+    def _split(self, position: int) -> int:
+        # Makes sure a piece starts at the position and returns its index
+        if position > self.extent:
+            self.pieces.append((self.extent + self.offset, position - self.extent))
+            self._update_starts()
+        index = bisect.bisect_right(self.starts, position) - 1
+        if self.starts[index] == position:
+            return index
+        physical_start, length = self.pieces[index]
+        before = position - self.starts[index]
+        self.pieces[index:index + 1] = [(physical_start, before), (physical_start + before, length - before)]
+        self._update_starts()
+        return index + 1
+
+    def _normalize(self):
+        merged = []
+        for physical_start, length in self.pieces:
+            if merged and merged[-1][0] + merged[-1][1] == physical_start:
+                merged[-1] = (merged[-1][0], merged[-1][1] + length)
+            else:
+                merged.append((physical_start, length))
+        # A last piece that continues into the tail becomes part of it again
+        while merged and merged[-1][0] + merged[-1][1] == sum(length for _, length in merged) + self.offset:
+            merged.pop()
+        self.pieces = merged
+        self._update_starts()
+
+    def insert(self, position: int, count: int):
+        index = self._split(position)
+        self.pieces.insert(index, (self.next_id - count + 1, count))
+        self.next_id -= count
+        self.offset -= count
+        self._normalize()
+
+    def delete(self, position: int, count: int) -> list[tuple[int, int]]:
+        # Returns the (physical_start, physical_end) runs that were removed, their cells have to be deleted
+        start = self._split(position)
+        end = self._split(position + count)
+        removed = self.pieces[start:end]
+        del self.pieces[start:end]
+        self.offset += count
+        self._normalize()
+        return [(physical_start, physical_start + length - 1) for physical_start, length in removed]
+
+    def move(self, position: int, count: int, destination: int):
+        # The moved block starts at destination afterwards
+        start = self._split(position)
+        end = self._split(position + count)
+        block = self.pieces[start:end]
+        del self.pieces[start:end]
+        self.offset += count
+        self._update_starts()
+        index = self._split(destination)
+        self.pieces[index:index] = block
+        self.offset -= count
+        self._normalize()
+
+
+def remap_range(operation: str, position: int, count: int, destination: int | None, start: int, end: int) -> list[tuple[int, int]]:
+    # Logical ranges covering what [start, end] covered before a structural change. Ranges grow with positions
+    # inserted inside them, shrink with deleted ones and fall apart when a moved block leaves or enters them.
+    if operation == "insert":
+        return [(start + count if start >= position else start, min(end + count, MAX_POSITION) if end >= position else end)]
+
+    block_end = position + count - 1
+    remaining = []
+    if start < position:
+        remaining.append((start, min(end, position - 1)))
+    if end > block_end:
+        remaining.append((max(start, block_end + 1) - count, end - count))
+
+    ranges = []
+    if operation == "delete":
+        ranges = remaining
+    else:
+        for first, last in remaining:
+            if first < destination:
+                ranges.append((first, min(last, destination - 1)))
+            if last >= destination:
+                ranges.append((max(first, destination) + count, min(last + count, MAX_POSITION)))
+        if start <= block_end and end >= position:
+            ranges.append((destination + max(start, position) - position, destination + min(end, block_end) - position))
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _int_array(values: list[int]) -> str:
+    return "'{" + ",".join(str(value) for value in values) + "}'::int[]"
+
+
+def mapped_cells_sql(box_sql: Callable[[str, str, str, str], str], row_intervals: list[Interval], col_intervals: list[Interval]) -> str:
+    # box_sql returns the physical cells between the given row and column bounds, every pair of mapped
+    # row and column runs is read as one box and translated back to logical positions
+    rows = list(zip(*row_intervals)) or [(), (), ()]
+    cols = list(zip(*col_intervals)) or [(), (), ()]
+    return f'''
+        SELECT row_runs.logical_start + (physical_cells.row_index - row_runs.physical_start) AS row_index,
+               col_runs.logical_start + (physical_cells.col_index - col_runs.physical_start) AS col_index,
+               physical_cells.value
+        FROM unnest({_int_array(rows[0])}, {_int_array(rows[1])}, {_int_array(rows[2])}) AS row_runs (logical_start, physical_start, physical_end)
+        CROSS JOIN unnest({_int_array(cols[0])}, {_int_array(cols[1])}, {_int_array(cols[2])}) AS col_runs (logical_start, physical_start, physical_end)
+        CROSS JOIN LATERAL ({box_sql("row_runs.physical_start", "row_runs.physical_end", "col_runs.physical_start", "col_runs.physical_end")}) AS physical_cells
+    '''
@@ -1,18 +1,36 @@
+import asyncio
 import json
+import os
 from uuid import UUID
 
+import asyncpg
 from asyncpg import Connection
 import uuid
 
 from pydantic import Json
 
+from backend.data_management.deletion_queue import queue_deletion, tombstone_name
+from backend.data_management.permission_index import permissions_changed
+from backend.data_management.shared_storage import DEFAULT_PROJECT_LAYOUT, PROJECT_LAYOUTS, SHARED_LAYOUT, forget_project_layout
+from backend.data_management.table_handler import SHARED_STORAGE, migrate_table_storage, clone_table, clone_table_permissions
+from backend.user_management.effective_roles import refresh_effective_roles
 
-async def create_project(user_connection:Connection, data_connection:Connection, project_name: str, owner_id: UUID):
+
+async def create_project(user_connection:Connection, data_connection:Connection, project_name: str, owner_id: UUID, storage_layout: str = DEFAULT_PROJECT_LAYOUT):
+    if storage_layout not in PROJECT_LAYOUTS:
+        raise ValueError(f"Unknown storage layout {storage_layout}")
     project_id = uuid.uuid4()
 
-    await data_connection.execute(f'CREATE SCHEMA "{project_id}"')
-    await user_connection.execute('INSERT INTO projects (project_id, project_name, owner_id) VALUES ($1, $2, $3)', project_id, project_name, owner_id)
+    if storage_layout == SHARED_LAYOUT:
+        await data_connection.execute('INSERT INTO shared_projects (schema_name) VALUES ($1)', str(project_id))
+    else:
+        await data_connection.execute(f'CREATE SCHEMA "{project_id}"')
+    await user_connection.execute('INSERT INTO projects (project_id, project_name, owner_id, storage_layout) VALUES ($1, $2, $3, $4)', project_id, project_name, owner_id, storage_layout)
     await user_connection.execute('INSERT INTO project_members (project_id, user_id, role) VALUES ($1, $2, $3)', project_id, owner_id, 'owner')
+    await refresh_effective_roles(user_connection, [owner_id], [project_id])
+
+    if storage_layout == SHARED_LAYOUT:
+        return str(project_id)
 
     await user_connection.execute(f'''CREATE TABLE IF NOT EXISTS permissions."{project_id}" (
         table_id UUID,
@@ -29,6 +47,45 @@ async def create_project(user_connection:Connection, data_connection:Connection,
 
     return str(project_id)
 
+# Number of tables copied at the same time by clone_project, each on its own pooled connection
+CLONE_CONCURRENCY = int(os.getenv("CLONE_CONCURRENCY", "4"))
+
+
+async def clone_project(user_connection:Connection, data_pool: asyncpg.Pool, project_id: UUID, project_name: str, owner_id: UUID, storage_layout: str | None = None) -> str:
+    # Copies the tables and permission rectangles of a project into a new project owned by owner_id.
+    # Every table is copied inside Postgres in its own transaction, up to CLONE_CONCURRENCY tables at once.
+    if storage_layout is None:
+        storage_layout = await user_connection.fetchval('SELECT storage_layout FROM projects WHERE project_id = $1', project_id)
+        if storage_layout is None:
+            raise ValueError(f"Project {project_id} does not exist")
+
+    async with data_pool.acquire() as data_connection:
+        new_project_id = await create_project(user_connection, data_connection, project_name, owner_id, storage_layout)
+        table_names = [record['table_name'] for record in await data_connection.fetch('''
+            SELECT table_name FROM table_storage WHERE schema_name = $1
+            UNION
+            SELECT tablename FROM pg_tables WHERE schemaname = $1
+        ''', str(project_id))]
+
+    semaphore = asyncio.Semaphore(CLONE_CONCURRENCY)
+
+    async def copy_table(table_name: str):
+        async with semaphore, data_pool.acquire() as connection:
+            await clone_table(connection, str(project_id), table_name, new_project_id, table_name)
+
+    try:
+        # All copies are waited for before a failure is raised, so none of them still runs during the cleanup
+        for result in await asyncio.gather(*(copy_table(table_name) for table_name in table_names), return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+        # Tables keep their names, so the rectangles keep their table ids
+        await clone_table_permissions(user_connection, project_id, None, new_project_id)
+    except Exception:
+        async with data_pool.acquire() as data_connection:
+            await delete_project(user_connection, data_connection, new_project_id)
+        raise
+    return new_project_id
+
 
 async def get_project_name(user_connection:Connection, project_id: UUID) -> str | None:
 
@@ -38,12 +95,33 @@ async def get_project_name(user_connection:Connection, project_id: UUID) -> str
     else:
         return None
 
-async def delete_project(user_connection:Connection, data_connection:Connection, project_id: UUID):
-    await data_connection.execute(f'DROP SCHEMA IF EXISTS "{project_id}" CASCADE')
+async def delete_project(user_connection:Connection, data_connection:Connection, project_id: UUID, requested_by: UUID | None = None) -> UUID:
+    # The schema is only renamed out of the way here, the deletion worker drops its tables one by one and removes
+    # the shared cells and change log of the project later. Returns the id of the deletion.
+    schema = str(project_id)
+    deletion_id = uuid.uuid4()
+    async with data_connection.transaction():
+        tables_total = await data_connection.fetchval('''
+            SELECT count(*) FROM (
+                SELECT table_name FROM table_storage WHERE schema_name = $1
+                UNION
+                SELECT tablename FROM pg_tables WHERE schemaname = $1
+            ) AS tables
+        ''', schema)
+        tombstone = None
+        if await data_connection.fetchval('SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = $1)', schema):
+            tombstone = tombstone_name(deletion_id)
+            await data_connection.execute(f'ALTER SCHEMA "{project_id}" RENAME TO "{tombstone}"')
+        await data_connection.execute('DELETE FROM shared_projects WHERE schema_name = $1', schema)
+        await data_connection.execute('DELETE FROM table_storage WHERE schema_name = $1', schema)
+        await queue_deletion(data_connection, deletion_id, schema, None, tombstone, tables_total, requested_by)
     await user_connection.execute(f'DROP TABLE IF EXISTS permissions."{project_id}" CASCADE')
+    await user_connection.execute('DELETE FROM permissions.shared_permissions WHERE project_id = $1', project_id)
+    await permissions_changed(user_connection, project_id)
     await user_connection.execute('DELETE FROM projects WHERE project_id = $1', project_id)
     await user_connection.execute('DELETE FROM project_members WHERE project_id = $1', project_id)
     await user_connection.execute('DELETE FROM project_teams WHERE project_id = $1', project_id)
+    return deletion_id
 
 async def project_exists(user_connection:Connection, project_id: UUID) -> bool:
     result = await user_connection.fetchrow('SELECT 1 FROM projects WHERE project_id = $1', project_id)
@@ -51,9 +129,11 @@ async def project_exists(user_connection:Connection, project_id: UUID) -> bool:
 
 async def add_member(user_connection:Connection, project_id: UUID, user_id: UUID, role: str):
     await user_connection.execute('INSERT INTO project_members (project_id, user_id, role) VALUES ($1, $2, $3)', project_id, user_id, role)
+    await refresh_effective_roles(user_connection, [user_id], [project_id])
 
 async def remove_member(user_connection:Connection, project_id: UUID, user_id: UUID):
     await user_connection.execute('DELETE FROM project_members WHERE project_id = $1 AND user_id = $2', project_id, user_id)
+    await refresh_effective_roles(user_connection, [user_id], [project_id])
 
 async def list_project_members(user_connection:Connection, project_id: UUID):
     results = await user_connection.fetch('SELECT user_id, role FROM project_members WHERE project_id = $1', project_id)
@@ -61,7 +141,112 @@ async def list_project_members(user_connection:Connection, project_id: UUID):
 
 async def change_member_role(user_connection:Connection, project_id: UUID, user_id: UUID, new_role: str):
     await user_connection.execute('UPDATE project_members SET role = $1 WHERE project_id = $2 AND user_id = $3', new_role, project_id, user_id)
+    await refresh_effective_roles(user_connection, [user_id], [project_id])
 
 async def list_user_projects(user_connection:Connection, user_id: UUID):
     results = await user_connection.fetch('SELECT project_id, project_name, role FROM projects JOIN project_members USING (project_id) WHERE user_id = $1', user_id)
     return [{'project_id': record['project_id'], 'project_name': record['project_name'], 'role': record['role']} for record in results]
+
+async def _team_member_ids(user_connection:Connection, team_id: UUID) -> list[UUID]:
+    return [record['user_id'] for record in await user_connection.fetch('SELECT user_id FROM team_members WHERE team_id = $1', team_id)]
+
+async def add_team(user_connection:Connection, project_id: UUID, team_id: UUID, role: str):
+    await user_connection.execute('INSERT INTO project_teams (project_id, team_id, role) VALUES ($1, $2, $3)', project_id, team_id, role)
+    await refresh_effective_roles(user_connection, await _team_member_ids(user_connection, team_id), [project_id])
+
+async def remove_team(user_connection:Connection, project_id: UUID, team_id: UUID):
+    await user_connection.execute('DELETE FROM project_teams WHERE project_id = $1 AND team_id = $2', project_id, team_id)
+    await refresh_effective_roles(user_connection, await _team_member_ids(user_connection, team_id), [project_id])
+
+async def change_team_role(user_connection:Connection, project_id: UUID, team_id: UUID, new_role: str):
+    await user_connection.execute('UPDATE project_teams SET role = $1 WHERE project_id = $2 AND team_id = $3', new_role, project_id, team_id)
+    await refresh_effective_roles(user_connection, await _team_member_ids(user_connection, team_id), [project_id])
+
+async def list_project_teams(user_connection:Connection, project_id: UUID):
+    results = await user_connection.fetch('SELECT team_id, role FROM project_teams WHERE project_id = $1', project_id)
+    return [{'team_id': record['team_id'], 'role': record['role']} for record in results]
+
+async def migrate_project_to_shared(user_connection:Connection, data_connection:Connection, project_id: UUID) -> int:
+    # Moves the tables and permissions of a project into the shared partitioned tables and drops its schema
+    # and permissions table. Both databases are migrated one after the other, each half is valid on its own.
+    layout = await user_connection.fetchval('SELECT storage_layout FROM projects WHERE project_id = $1', project_id)
+    if layout is None:
+        raise ValueError(f"Project {project_id} does not exist")
+
+    schema = str(project_id)
+    table_names = [record['table_name'] for record in await data_connection.fetch('''
+        SELECT table_name FROM table_storage WHERE schema_name = $1
+        UNION
+        SELECT tablename FROM pg_tables WHERE schemaname = $1
+    ''', schema)]
+    for table_name in table_names:
+        await migrate_table_storage(data_connection, schema, table_name, SHARED_STORAGE)
+
+    async with data_connection.transaction():
+        await data_connection.execute('INSERT INTO shared_projects (schema_name) VALUES ($1) ON CONFLICT DO NOTHING', schema)
+        # Without CASCADE, anything left in the schema makes the migration fail instead of being dropped
+        await data_connection.execute(f'DROP SCHEMA IF EXISTS "{project_id}"')
+
+    if layout != SHARED_LAYOUT:
+        async with user_connection.transaction():
+            await user_connection.execute(f'''
+                INSERT INTO permissions.shared_permissions (project_id, table_id, user_id, start_row, end_row, start_col, end_col, permission)
+                SELECT $1, table_id, user_id, start_row, end_row, start_col, end_col, permission FROM permissions."{project_id}"
+            ''', project_id)
+            await user_connection.execute(f'DROP TABLE permissions."{project_id}"')
+            await user_connection.execute('UPDATE projects SET storage_layout = $1 WHERE project_id = $2', SHARED_LAYOUT, project_id)
+        forget_project_layout(project_id)
+        await permissions_changed(user_connection, project_id)
+    return len(table_names)
+
+def _check_batch(user_ids: list[UUID], roles: list[str] | None = None):
+    if roles is not None and len(roles) != len(user_ids):
+        raise ValueError("Every user needs exactly one role")
+    if len(set(user_ids)) != len(user_ids):
+        raise ValueError("A user can only appear once per batch")
+
+async def _check_protected_members(user_connection:Connection, project_id: UUID, user_ids: list[UUID], caller_role: str | None):
+    # The owner is never changed by a batch, and nobody changes members at or above their own role.
+    # The rows stay locked until the batch is done, so a concurrent promotion can not slip in between.
+    protected = await user_connection.fetch('''
+        SELECT user_id FROM project_members
+        WHERE project_id = $1 AND user_id = ANY($2::uuid[]) AND (role = 'owner' OR role >= $3::project_role)
+        FOR UPDATE
+    ''', project_id, user_ids, caller_role)
+    if protected:
+        raise PermissionError("The batch contains the owner or members at or above your own role")
+
+async def add_members(user_connection:Connection, project_id: UUID, user_ids: list[UUID], roles: list[str]):
+    # The whole batch is added in one statement, or nothing is when one of the users is already a member
+    _check_batch(user_ids, roles)
+    async with user_connection.transaction():
+        await user_connection.execute('''
+            INSERT INTO project_members (project_id, user_id, role)
+            SELECT $1, user_id, role FROM unnest($2::uuid[], $3::project_role[]) AS batch (user_id, role)
+        ''', project_id, user_ids, roles)
+        await refresh_effective_roles(user_connection, user_ids, [project_id])
+
+async def remove_members(user_connection:Connection, project_id: UUID, user_ids: list[UUID], caller_role: str | None = None):
+    # caller_role protects the members at or above it, see _check_protected_members
+    _check_batch(user_ids)
+    async with user_connection.transaction():
+        await _check_protected_members(user_connection, project_id, user_ids, caller_role)
+        result = await user_connection.execute('''
+            DELETE FROM project_members WHERE project_id = $1 AND user_id = ANY($2::uuid[])
+        ''', project_id, user_ids)
+        if int(result.split()[-1]) != len(user_ids):
+            raise ValueError("Not every user is a member of the project")
+        await refresh_effective_roles(user_connection, user_ids, [project_id])
+
+async def change_member_roles(user_connection:Connection, project_id: UUID, user_ids: list[UUID], new_roles: list[str], caller_role: str | None = None):
+    _check_batch(user_ids, new_roles)
+    async with user_connection.transaction():
+        await _check_protected_members(user_connection, project_id, user_ids, caller_role)
+        result = await user_connection.execute('''
+            UPDATE project_members SET role = batch.role
+            FROM unnest($2::uuid[], $3::project_role[]) AS batch (user_id, role)
+            WHERE project_members.project_id = $1 AND project_members.user_id = batch.user_id
+        ''', project_id, user_ids, new_roles)
+        if int(result.split()[-1]) != len(user_ids):
+            raise ValueError("Not every user is a member of the project")
+        await refresh_effective_roles(user_connection, user_ids, [project_id])
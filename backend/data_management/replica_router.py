@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from starlette.requests import Request
+
+from backend.data_management.pool_manager import PoolManager, pool_manager, reading_replica, replica_name
+
+logger = logging.getLogger("api_logger")
+
+# Read-only requests use the replica of a pool while it is at most REPLICA_MAX_LAG seconds behind the primary.
+# With READ_YOUR_WRITES a session reads from the primary until the replica has replayed the session's last write.
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "1"))
+READ_YOUR_WRITES = os.getenv("READ_YOUR_WRITES", "1") == "1"
+
+LAST_WRITE_KEY = "last_write"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# A replica that replayed everything it received is caught up, an instance that is no standby at all has no lag
+LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 'Infinity')
+    END
+'''
+
+
+class ReplicaState:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.healthy = False
+        self.lag = float("inf")
+        # Commits before this wall clock time are visible on the replica
+        self.replayed_until = 0.0
+        self.reads = 0
+        self.fallbacks = 0
+
+
+class ReplicaRouter:
+    # Checks the lag of the configured replicas in the background and picks the pool every read-only request uses
+
+    def __init__(self, manager: PoolManager):
+        self.manager = manager
+        self.replicas: dict[str, ReplicaState] = {}
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        # Opens the replicas of all open primaries that have one configured
+        for name in list(self.manager.pools):
+            if replica_name(name) in self.manager.settings and name not in self.replicas:
+                await self.manager.open(replica_name(name))
+                self.replicas[name] = ReplicaState(replica_name(name))
+        if self.replicas:
+            await self.check()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+            print(f"Replica routing enabled for {', '.join(self.replicas)}.")
+
+    async def stop(self):
+        task, self.task = self.task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for state in self.replicas.values():
+            await self.manager.close(state.name)
+        self.replicas.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+    async def check(self):
+        for state in self.replicas.values():
+            started = time.time()
+            try:
+                async with self.manager.acquire(state.name) as connection:
+                    lag = float(await connection.fetchval(LAG_SQL))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if state.healthy:
+                    logger.warning(f"Replica {state.name} is unreachable, reading from the primary", exc_info=True)
+                state.healthy = False
+                continue
+            state.healthy = True
+            state.lag = lag
+            state.replayed_until = max(state.replayed_until, started - lag)
+
+    def choose(self, name: str, last_write: float | None = None) -> str:
+        state = self.replicas.get(name)
+        if state is None:
+            return name
+        if not state.healthy or time.time() - state.replayed_until > REPLICA_MAX_LAG \
+                or (READ_YOUR_WRITES and last_write is not None and state.replayed_until < last_write):
+            state.fallbacks += 1
+            return name
+        state.reads += 1
+        return state.name
+
+    @asynccontextmanager
+    async def read(self, name: str, last_write: float | None = None):
+        chosen = self.choose(name, last_write)
+        async with self.manager.acquire(chosen) as connection:
+            token = reading_replica.set(chosen != name)
+            try:
+                yield connection
+            finally:
+                reading_replica.reset(token)
+
+    def stats(self) -> dict[str, dict]:
+        return {name: {
+            "replica": state.name,
+            "healthy": state.healthy,
+            "lag": state.lag,
+            "reads": state.reads,
+            "fallbacks": state.fallbacks,
+        } for name, state in self.replicas.items()}
+
+
+replica_router = ReplicaRouter(pool_manager)
+
+
+async def read_your_writes_middleware(request: Request, call_next):
+    # Remembers when the session last changed something, once the request committed, so its next reads see the change
+    response = await call_next(request)
+    if replica_router.replicas and request.method not in SAFE_METHODS and "session" in request.scope:
+        request.session[LAST_WRITE_KEY] = time.time()
+    return response
@@ -0,0 +1,175 @@
+import os
+from typing import Iterable, NamedTuple
+from uuid import UUID
+
+from asyncpg import Connection
+
+from backend.data_management.pool_manager import reading_replica
+
+# Projects in the schema layout get their own data schema and permissions table, projects in the shared layout keep
+# their cells in shared_cells and their permissions in permissions.shared_permissions, both hash partitioned by project
+SCHEMA_LAYOUT = "schema"
+SHARED_LAYOUT = "shared"
+PROJECT_LAYOUTS = (SCHEMA_LAYOUT, SHARED_LAYOUT)
+
+DEFAULT_PROJECT_LAYOUT = os.getenv("PROJECT_STORAGE_LAYOUT", SCHEMA_LAYOUT)
+
+SHARED_PARTITIONS = 16
+
+# Storage layout per project in the user database, it only changes when a project is migrated
+_project_layouts: dict[str, str] = {}
+
+
+def _literal(text: str) -> str:
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _project_literal(schema: str) -> str:
+    # Shared tables are keyed by the project id, which is the name of the project's schema
+    return f"{_literal(str(UUID(schema)))}::uuid"
+
+
+def scope_sql(schema: str, table_name: str) -> str:
+    return f"project_id = {_project_literal(schema)} AND table_name = {_literal(table_name)}"
+
+
+def cells_sql(schema: str, table_name: str) -> str:
+    return f'SELECT row_index, col_index, value FROM shared_cells WHERE {scope_sql(schema, table_name)}'
+
+
+def range_sql(schema: str, table_name: str) -> str:
+    return f'''
+        SELECT row_index, col_index, value FROM shared_cells
+        WHERE {scope_sql(schema, table_name)} AND row_index BETWEEN $1 AND $2 AND col_index BETWEEN $3 AND $4
+    '''
+
+
+def box_sql(schema: str, table_name: str, start_row: str, end_row: str, start_col: str, end_col: str) -> str:
+    return f'''
+        SELECT row_index, col_index, value FROM shared_cells
+        WHERE {scope_sql(schema, table_name)}
+        AND row_index BETWEEN {start_row} AND {end_row} AND col_index BETWEEN {start_col} AND {end_col}
+    '''
+
+
+async def get_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int) -> str | None:
+    return await data_connection.fetchval('''
+        SELECT value FROM shared_cells WHERE project_id = $1 AND table_name = $2 AND row_index = $3 AND col_index = $4
+    ''', UUID(schema), table_name, row, col)
+
+
+async def set_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int, value: str | None):
+    if not value:
+        await data_connection.execute('''
+            DELETE FROM shared_cells WHERE project_id = $1 AND table_name = $2 AND row_index = $3 AND col_index = $4
+        ''', UUID(schema), table_name, row, col)
+    else:
+        await data_connection.execute('''
+            INSERT INTO shared_cells (project_id, table_name, row_index, col_index, value) VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (project_id, table_name, row_index, col_index)
+            DO UPDATE SET value = EXCLUDED.value
+        ''', UUID(schema), table_name, row, col, value)
+
+
+async def set_cell_values(data_connection: Connection, schema: str, table_name: str, cells: Iterable[tuple[int, int, str | None]]) -> int:
+    # Later writes to the same cell win, removals and upserts are then sent as one array each
+    written = 0
+    latest = {}
+    for row, col, value in cells:
+        latest[row, col] = value
+        written += 1
+
+    removals = [position for position, value in latest.items() if not value]
+    updates = [(row, col, value) for (row, col), value in latest.items() if value]
+    async with data_connection.transaction():
+        if removals:
+            await data_connection.execute('''
+                DELETE FROM shared_cells
+                WHERE project_id = $1 AND table_name = $2 AND (row_index, col_index) IN (SELECT * FROM unnest($3::int[], $4::int[]))
+            ''', UUID(schema), table_name, [row for row, _ in removals], [col for _, col in removals])
+        if updates:
+            await data_connection.execute('''
+                INSERT INTO shared_cells (project_id, table_name, row_index, col_index, value)
+                SELECT $1, $2, * FROM unnest($3::int[], $4::int[], $5::text[])
+                ON CONFLICT (project_id, table_name, row_index, col_index)
+                DO UPDATE SET value = EXCLUDED.value
+            ''', UUID(schema), table_name, [cell[0] for cell in updates], [cell[1] for cell in updates], [cell[2] for cell in updates])
+    return written
+
+
+async def get_cells(data_connection: Connection, schema: str, table_name: str, positions: list[tuple[int, int]]) -> dict[tuple[int, int], str]:
+    results = await data_connection.fetch('''
+        SELECT row_index, col_index, value FROM shared_cells
+        WHERE project_id = $1 AND table_name = $2 AND (row_index, col_index) IN (SELECT * FROM unnest($3::int[], $4::int[]))
+    ''', UUID(schema), table_name, [row for row, _ in positions], [col for _, col in positions])
+    return {(record['row_index'], record['col_index']): record['value'] for record in results}
+
+
+async def delete_runs(data_connection: Connection, schema: str, table_name: str, index_column: str, runs: list[tuple[int, int]]):
+    await data_connection.execute(f'''
+        DELETE FROM shared_cells AS target
+        USING unnest($3::int[], $4::int[]) AS removed (first_id, last_id)
+        WHERE target.project_id = $1 AND target.table_name = $2 AND target.{index_column} BETWEEN removed.first_id AND removed.last_id
+    ''', UUID(schema), table_name, [first for first, _ in runs], [last for _, last in runs])
+
+
+async def delete_cells(data_connection: Connection, schema: str, table_name: str | None = None):
+    # Removes the cells of one table, or of the whole project without a table
+    await data_connection.execute('''
+        DELETE FROM shared_cells WHERE project_id = $1 AND ($2::text IS NULL OR table_name = $2)
+    ''', UUID(schema), table_name)
+
+
+async def delete_cells_batch(data_connection: Connection, schema: str, table_name: str | None, limit: int) -> int:
+    # Removes up to limit cells of one table or of the whole project, returns how many were removed
+    result = await data_connection.execute('''
+        DELETE FROM shared_cells WHERE (project_id, table_name, row_index, col_index) IN (
+            SELECT project_id, table_name, row_index, col_index FROM shared_cells
+            WHERE project_id = $1 AND ($2::text IS NULL OR table_name = $2)
+            LIMIT $3
+        )
+    ''', UUID(schema), table_name, limit)
+    return int(result.split()[-1])
+
+
+async def is_shared_project(data_connection: Connection, schema: str) -> bool:
+    return await data_connection.fetchval('SELECT EXISTS (SELECT 1 FROM shared_projects WHERE schema_name = $1)', schema)
+
+
+class PermissionTable(NamedTuple):
+    # SQL fragments addressing the permission rectangles of one project:
+    # relation to read and write, condition selecting the project's rows, and the extra key column and value for inserts
+    relation: str
+    scope: str
+    key: str
+    key_value: str
+
+
+async def get_project_layout(user_connection: Connection, project_id: UUID) -> str:
+    layout = _project_layouts.get(str(project_id))
+    if layout is None:
+        layout = await user_connection.fetchval('SELECT storage_layout FROM projects WHERE project_id = $1', project_id)
+        if layout is None:
+            # Deleted projects are not cached
+            return SCHEMA_LAYOUT
+        if not reading_replica.get():
+            _project_layouts[str(project_id)] = layout
+    return layout
+
+
+def forget_project_layout(project_id: UUID | None = None):
+    if project_id is None:
+        _project_layouts.clear()
+    else:
+        _project_layouts.pop(str(project_id), None)
+
+
+def permission_table(project_id: UUID, layout: str) -> PermissionTable:
+    if layout == SHARED_LAYOUT:
+        project = _project_literal(str(project_id))
+        return PermissionTable('permissions.shared_permissions', f'project_id = {project}', 'project_id, ', f'{project}, ')
+    return PermissionTable(f'permissions."{project_id}"', 'TRUE', '', '')
+
+
+async def get_permission_table(user_connection: Connection, project_id: UUID) -> PermissionTable:
+    return permission_table(project_id, await get_project_layout(user_connection, project_id))
@@ -1,21 +1,129 @@
+import uuid
+from typing import Awaitable, Callable, Iterable
 from uuid import UUID
 
+import asyncpg
 from asyncpg import Connection
 
+from backend.data_management import shared_storage, tile_storage
+from backend.data_management.cell_cache import cell_cache, MAX_CACHED_RANGE_TILES
+from backend.data_management.change_feed import publish_changes, subscribe
+from backend.data_management.change_log import record_changes, delete_change_log, get_changes_since
+from backend.data_management.deletion_queue import queue_deletion, tombstone_name
+from backend.data_management.permission_index import permissions_changed, normalize_rectangles, subtract_rectangle
+from backend.data_management.pool_manager import reading_replica
+from backend.data_management.position_map import AxisMap, AXES, ROW_AXIS, MAX_POSITION, mapped_cells_sql, remap_range
+from backend.data_management.shared_storage import get_permission_table
 
-async def create_table(data_connection: Connection, table_name: str, schema: str):
-    existing_tables = await data_connection.fetch('''
-        SELECT tablename FROM pg_tables WHERE schemaname = $1 AND tablename = $2
-    ''', schema, table_name)
-    if existing_tables:
-        raise ValueError(f"Table {table_name} already exists in schema {schema}")
+CELL_STORAGE = "cell"
+TILE_STORAGE = "tile"
+SHARED_STORAGE = "shared"
+STORAGE_MODES = (CELL_STORAGE, TILE_STORAGE, SHARED_STORAGE)
+
+# Storage mode per (schema, table), tables without a table_storage entry use cell storage
+_storage_modes: dict[tuple[str, str], str] = {}
+STORAGE_MODE_SQL = 'SELECT storage_mode FROM table_storage WHERE schema_name = $1 AND table_name = $2'
+
+# Logical to physical (row, column) maps per (schema, table), cells are stored under their physical ids
+_position_maps: dict[tuple[str, str], tuple[AxisMap, AxisMap]] = {}
+
+STRUCTURE_OPERATIONS = ("insert", "delete", "move")
+
+# Called after cells were written with the written (row, col, value) triples, or None when the whole table was replaced or dropped
+WriteListener = Callable[[Connection, str, str, list[tuple[int, int, str | None]] | None], Awaitable[None]]
+_write_listeners: list[WriteListener] = []
+
+# Plain decimal numbers, the same text Postgres accepts as float8 literal
+NUMBER_PATTERN = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+
+def add_write_listener(listener: WriteListener):
+    _write_listeners.append(listener)
+
+async def _notify_write_listeners(data_connection: Connection, schema: str, table_name: str, cells: list[tuple[int, int, str | None]] | None):
+    # Cached tiles are dropped right away and again in every worker once the change is committed
+    if cells is None:
+        cell_cache.invalidate_table(schema, table_name)
+        await publish_changes(data_connection, schema, table_name, None)
+    else:
+        cell_cache.invalidate_cells(schema, table_name, [(row, col) for row, col, _ in cells])
+        await publish_changes(data_connection, schema, table_name, cells)
+
+    for listener in _write_listeners:
+        await listener(data_connection, schema, table_name, cells)
+
+
+def _on_table_changed(schema: str | None, table_name: str | None, cells: list[tuple[int, int, str | None]] | None, local: bool):
+    if schema is None:
+        cell_cache.clear()
+        _storage_modes.clear()
+        _position_maps.clear()
+    elif cells is None:
+        cell_cache.invalidate_table(schema, table_name)
+        _storage_modes.pop((schema, table_name), None)
+        _position_maps.pop((schema, table_name), None)
+    else:
+        cell_cache.invalidate_cells(schema, table_name, [(row, col) for row, col, _ in cells])
+
+subscribe(_on_table_changed)
+
+async def get_storage_mode(data_connection: Connection, schema: str, table_name: str) -> str:
+    mode = _storage_modes.get((schema, table_name))
+    if mode is None:
+        mode = await data_connection.fetchval(STORAGE_MODE_SQL, schema, table_name)
+        if mode is None:
+            # Not cached, the table may still be created by another worker
+            return CELL_STORAGE
+        if not reading_replica.get():
+            _storage_modes[schema, table_name] = mode
+    return mode
+
+async def _set_storage_mode(data_connection: Connection, schema: str, table_name: str, storage_mode: str):
+    await data_connection.execute('''
+        INSERT INTO table_storage (schema_name, table_name, storage_mode) VALUES ($1, $2, $3)
+        ON CONFLICT (schema_name, table_name)
+        DO UPDATE SET storage_mode = EXCLUDED.storage_mode
+    ''', schema, table_name, storage_mode)
+    _storage_modes[schema, table_name] = storage_mode
+
+async def get_position_maps(data_connection: Connection, schema: str, table_name: str) -> tuple[AxisMap, AxisMap]:
+    maps = _position_maps.get((schema, table_name))
+    if maps is None:
+        result = await data_connection.fetchrow('''
+            SELECT row_map, col_map FROM table_storage WHERE schema_name = $1 AND table_name = $2
+        ''', schema, table_name)
+        maps = (AxisMap.from_json(result['row_map']), AxisMap.from_json(result['col_map'])) if result else (AxisMap(), AxisMap())
+        if not reading_replica.get():
+            _position_maps[schema, table_name] = maps
+    return maps
+
+def _cells_sql(schema: str, table_name: str, storage_mode: str) -> str:
+    # Cells under their physical ids
+    if storage_mode == TILE_STORAGE:
+        return tile_storage.cells_sql(schema, table_name)
+    if storage_mode == SHARED_STORAGE:
+        return shared_storage.cells_sql(schema, table_name)
+    return f'SELECT row_index, col_index, value FROM "{schema}"."{table_name}"'
+
+def _box_sql(schema: str, table_name: str, storage_mode: str) -> Callable[[str, str, str, str], str]:
+    if storage_mode == TILE_STORAGE:
+        return lambda start_row, end_row, start_col, end_col: tile_storage.box_sql(schema, table_name, start_row, end_row, start_col, end_col)
+    if storage_mode == SHARED_STORAGE:
+        return lambda start_row, end_row, start_col, end_col: shared_storage.box_sql(schema, table_name, start_row, end_row, start_col, end_col)
+    return lambda start_row, end_row, start_col, end_col: f'''
+        SELECT row_index, col_index, value FROM "{schema}"."{table_name}"
+        WHERE row_index BETWEEN {start_row} AND {end_row} AND col_index BETWEEN {start_col} AND {end_col}
+    '''
 
-    existing_schema = await data_connection.fetch(f'''
-        SELECT schema_name FROM information_schema.schemata WHERE schema_name = $1
-    ''', schema)
-    if not existing_schema:
-        raise ValueError(f"Schema {schema} does not exist")
+async def get_cells_sql(data_connection: Connection, schema: str, table_name: str) -> str:
+    # Cells under their logical positions
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    row_map, col_map = await get_position_maps(data_connection, schema, table_name)
+    if row_map.identity and col_map.identity:
+        return _cells_sql(schema, table_name, storage_mode)
+    return mapped_cells_sql(_box_sql(schema, table_name, storage_mode), row_map.intervals(0, MAX_POSITION), col_map.intervals(0, MAX_POSITION))
 
+async def _create_cell_table(data_connection: Connection, schema: str, table_name: str):
     await data_connection.execute(f'''CREATE TABLE "{schema}"."{table_name}" (
                                   row_index INT,
                                   col_index INT,
@@ -23,22 +131,287 @@ async def create_table(data_connection: Connection, table_name: str, schema: str
                                   PRIMARY KEY (row_index, col_index)
                                   )''')
 
-async def delete_table(user_connection: Connection, data_connection: Connection, table_name: str, project_id: UUID):
-    await data_connection.execute(f'''DROP TABLE IF EXISTS "{project_id}"."{table_name}" CASCADE''')
-    await user_connection.execute(f'''DELETE FROM permissions."{project_id}" WHERE table_id = $1''', table_name)
+async def create_table(data_connection: Connection, table_name: str, schema: str, storage_mode: str = CELL_STORAGE):
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {storage_mode}")
 
-async def set_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int, value: str):
-    if not value:
-        await data_connection.execute(f'''DELETE FROM "{schema}"."{table_name}" WHERE row_index = $1 AND col_index = $2''', row, col)
+    existing_tables = await data_connection.fetch('''
+        SELECT tablename FROM pg_tables WHERE schemaname = $1 AND tablename = $2
+        UNION ALL
+        SELECT table_name FROM table_storage WHERE schema_name = $1 AND table_name = $2
+    ''', schema, table_name)
+    if existing_tables:
+        raise ValueError(f"Table {table_name} already exists in schema {schema}")
+
+    # Deleted tables in shared storage keep their cells under their name until the deletion worker removed them
+    if await data_connection.fetchval('''
+        SELECT EXISTS (SELECT 1 FROM pending_deletions WHERE schema_name = $1 AND table_name = $2 AND tombstone IS NULL AND finished_at IS NULL)
+    ''', schema, table_name):
+        raise ValueError(f"Table {table_name} in schema {schema} is still being deleted")
+
+    # Projects in the shared layout have no schema, all of their tables use shared storage
+    if await shared_storage.is_shared_project(data_connection, schema):
+        if storage_mode == TILE_STORAGE:
+            raise ValueError(f"Projects in shared storage do not support {storage_mode} tables")
+        storage_mode = SHARED_STORAGE
+    else:
+        existing_schema = await data_connection.fetch(f'''
+            SELECT schema_name FROM information_schema.schemata WHERE schema_name = $1
+        ''', schema)
+        if not existing_schema:
+            raise ValueError(f"Schema {schema} does not exist")
+
+    if storage_mode == TILE_STORAGE:
+        await tile_storage.create_tile_table(data_connection, schema, table_name)
+    elif storage_mode == CELL_STORAGE:
+        await _create_cell_table(data_connection, schema, table_name)
+    await _set_storage_mode(data_connection, schema, table_name, storage_mode)
+    _position_maps.pop((schema, table_name), None)
+    # Other workers drop what they cached under the name, e.g. of a table deleted before
+    await publish_changes(data_connection, schema, table_name, None)
+
+async def _copy_cells(data_connection: Connection, schema: str, table_name: str, storage_mode: str, source_sql: str):
+    # Inserts the (row_index, col_index, value) cells of source_sql into a table, without them leaving Postgres
+    if storage_mode == SHARED_STORAGE:
+        await data_connection.execute(f'''
+            INSERT INTO shared_cells (project_id, table_name, row_index, col_index, value)
+            SELECT $1::uuid, $2, row_index, col_index, value FROM ({source_sql}) AS cells
+        ''', schema, table_name)
+    elif storage_mode == TILE_STORAGE:
+        await data_connection.execute(f'''
+            INSERT INTO "{schema}"."{table_name}" (tile_row, tile_col, cells)
+            {tile_storage.tiles_from_cells_sql(source_sql)}
+        ''')
     else:
         await data_connection.execute(f'''
             INSERT INTO "{schema}"."{table_name}" (row_index, col_index, value)
-            VALUES ($1, $2, $3)
+            SELECT row_index, col_index, value FROM ({source_sql}) AS cells
+        ''')
+
+async def migrate_table_storage(data_connection: Connection, schema: str, table_name: str, storage_mode: str):
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {storage_mode}")
+
+    _storage_modes.pop((schema, table_name), None)
+    current_mode = await get_storage_mode(data_connection, schema, table_name)
+    if current_mode == storage_mode:
+        return
+    if storage_mode != SHARED_STORAGE and await shared_storage.is_shared_project(data_connection, schema):
+        raise ValueError(f"Projects in shared storage do not support {storage_mode} tables")
+
+    # The data is copied into a new table that then takes over the name, all in one transaction.
+    # Shared storage has no table of its own, cells are moved into or out of shared_cells instead.
+    target_name = table_name if SHARED_STORAGE in (current_mode, storage_mode) else f"{table_name}__migrating"
+    source_sql = _cells_sql(schema, table_name, current_mode)
+    try:
+        async with data_connection.transaction():
+            if storage_mode == TILE_STORAGE:
+                await tile_storage.create_tile_table(data_connection, schema, target_name)
+            elif storage_mode == CELL_STORAGE:
+                await _create_cell_table(data_connection, schema, target_name)
+            await _copy_cells(data_connection, schema, target_name, storage_mode, source_sql)
+
+            if current_mode == SHARED_STORAGE:
+                await shared_storage.delete_cells(data_connection, schema, table_name)
+            elif storage_mode == SHARED_STORAGE:
+                await data_connection.execute(f'''DROP TABLE "{schema}"."{table_name}"''')
+            else:
+                primary_key = await data_connection.fetchval('''
+                    SELECT conname FROM pg_constraint WHERE conrelid = format('%I.%I', $1::text, $2::text)::regclass AND contype = 'p'
+                ''', schema, target_name)
+                await data_connection.execute(f'''DROP TABLE "{schema}"."{table_name}"''')
+                await data_connection.execute(f'''ALTER TABLE "{schema}"."{target_name}" RENAME TO "{table_name}"''')
+                await data_connection.execute(f'''ALTER TABLE "{schema}"."{table_name}" RENAME CONSTRAINT "{primary_key}" TO "{table_name}_pkey"''')
+            await _set_storage_mode(data_connection, schema, table_name, storage_mode)
+            await record_changes(data_connection, schema, table_name, None)
+    except Exception:
+        _storage_modes.pop((schema, table_name), None)
+        raise
+    await _notify_write_listeners(data_connection, schema, table_name, None)
+
+async def clone_table(data_connection: Connection, schema: str, table_name: str, target_schema: str, target_name: str):
+    # Copies a table with its cells and row and column maps inside Postgres, into the same or another project.
+    # Cells keep their physical ids, so the maps are copied unchanged.
+    source = await data_connection.fetchrow('''
+        SELECT storage_mode, row_map, col_map FROM table_storage WHERE schema_name = $1 AND table_name = $2
+    ''', schema, table_name)
+    if source is None and not await data_connection.fetchval('''
+        SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = $1 AND tablename = $2)
+    ''', schema, table_name):
+        raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+    storage_mode = source['storage_mode'] if source else CELL_STORAGE
+
+    try:
+        async with data_connection.transaction():
+            # Tables cloned into a project in shared storage use shared storage as well
+            target_mode = SHARED_STORAGE if await shared_storage.is_shared_project(data_connection, target_schema) else storage_mode
+            await create_table(data_connection, target_name, target_schema, target_mode)
+            if target_mode == storage_mode and storage_mode != SHARED_STORAGE:
+                await data_connection.execute(f'''INSERT INTO "{target_schema}"."{target_name}" SELECT * FROM "{schema}"."{table_name}"''')
+            else:
+                await _copy_cells(data_connection, target_schema, target_name, target_mode, _cells_sql(schema, table_name, storage_mode))
+            if source is not None:
+                await data_connection.execute('''
+                    UPDATE table_storage SET row_map = $3, col_map = $4 WHERE schema_name = $1 AND table_name = $2
+                ''', target_schema, target_name, source['row_map'], source['col_map'])
+    finally:
+        _storage_modes.pop((target_schema, target_name), None)
+        _position_maps.pop((target_schema, target_name), None)
+
+async def clone_table_permissions(user_connection: Connection, project_id: UUID, table_id: UUID | None, target_project_id: UUID, target_table_id: UUID | None = None):
+    # Copies the permission rectangles of one table, or of all tables without a table_id, in a single statement
+    source = await get_permission_table(user_connection, project_id)
+    target = await get_permission_table(user_connection, target_project_id)
+    await user_connection.execute(f'''
+        INSERT INTO {target.relation} ({target.key}table_id, user_id, start_row, end_row, start_col, end_col, permission)
+        SELECT {target.key_value}COALESCE($2, table_id), user_id, start_row, end_row, start_col, end_col, permission
+        FROM {source.relation} WHERE {source.scope} AND ($1::uuid IS NULL OR table_id = $1)
+        ON CONFLICT ({target.key}table_id, user_id, start_row, end_row, start_col, end_col) DO NOTHING
+    ''', table_id, target_table_id)
+    await permissions_changed(user_connection, target_project_id, target_table_id)
+
+async def table_exists(data_connection: Connection, schema: str, table_name: str) -> bool:
+    # Tables in the shared layout only have their table_storage row, tables older than table_storage only their cell table
+    return await data_connection.fetchval('''
+        SELECT EXISTS (SELECT 1 FROM table_storage WHERE schema_name = $1 AND table_name = $2)
+            OR EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = $1 AND tablename = $2)
+    ''', schema, table_name)
+
+async def delete_table(user_connection: Connection, data_connection: Connection, table_name: str, project_id: UUID, requested_by: UUID | None = None) -> UUID:
+    # The table is only renamed out of the way here, the deletion worker drops it later. Returns the id of the deletion.
+    schema = str(project_id)
+    deletion_id = uuid.uuid4()
+    if not await table_exists(data_connection, schema, table_name):
+        raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    async with data_connection.transaction():
+        tombstone = None
+        if storage_mode != SHARED_STORAGE and await data_connection.fetchval('''
+            SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = $1 AND tablename = $2)
+        ''', schema, table_name):
+            tombstone = tombstone_name(deletion_id)
+            primary_key = await data_connection.fetchval('''
+                SELECT conname FROM pg_constraint WHERE conrelid = format('%I.%I', $1::text, $2::text)::regclass AND contype = 'p'
+            ''', schema, table_name)
+            await data_connection.execute(f'''ALTER TABLE "{schema}"."{table_name}" RENAME TO "{tombstone}"''')
+            # The primary key index would block a new table with the same name
+            if primary_key is not None:
+                await data_connection.execute(f'''ALTER TABLE "{schema}"."{tombstone}" RENAME CONSTRAINT "{primary_key}" TO "{tombstone}_pkey"''')
+        await data_connection.execute('''DELETE FROM table_storage WHERE schema_name = $1 AND table_name = $2''', schema, table_name)
+        await delete_change_log(data_connection, schema, table_name)
+        await queue_deletion(data_connection, deletion_id, schema, table_name, tombstone, 1, requested_by)
+    _storage_modes.pop((str(project_id), table_name), None)
+    _position_maps.pop((str(project_id), table_name), None)
+    await _notify_write_listeners(data_connection, str(project_id), table_name, None)
+    permissions = await get_permission_table(user_connection, project_id)
+    # Compared as text, table_id is a uuid column while tables are addressed by name
+    await user_connection.execute(f'''DELETE FROM {permissions.relation} WHERE {permissions.scope} AND table_id::text = $1''', table_name)
+    await permissions_changed(user_connection, project_id, table_name)
+    return deletion_id
+
+def _check_positions(cells: list[tuple[int, int, str | None]]):
+    # Logical and physical positions are stored as int4
+    if any(not (0 <= row <= MAX_POSITION and 0 <= col <= MAX_POSITION) for row, col, _ in cells):
+        raise ValueError(f"Cell positions must be between 0 and {MAX_POSITION}")
+
+async def set_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int, value: str):
+    _check_positions([(row, col, value)])
+    row_map, col_map = await get_position_maps(data_connection, schema, table_name)
+    physical_row, physical_col = row_map.physical(row), col_map.physical(col)
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    async with data_connection.transaction():
+        if storage_mode == TILE_STORAGE:
+            await tile_storage.set_cell_value(data_connection, schema, table_name, physical_row, physical_col, value)
+        elif storage_mode == SHARED_STORAGE:
+            await shared_storage.set_cell_value(data_connection, schema, table_name, physical_row, physical_col, value)
+        elif not value:
+            await data_connection.execute(f'''DELETE FROM "{schema}"."{table_name}" WHERE row_index = $1 AND col_index = $2''', physical_row, physical_col)
+        else:
+            await data_connection.execute(f'''
+                INSERT INTO "{schema}"."{table_name}" (row_index, col_index, value)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (row_index, col_index)
+                DO UPDATE SET value = EXCLUDED.value
+            ''', physical_row, physical_col, value)
+        await record_changes(data_connection, schema, table_name, [(row, col, value)])
+    await _notify_write_listeners(data_connection, schema, table_name, [(row, col, value)])
+
+async def set_cell_values(data_connection: Connection, schema: str, table_name: str, cells: Iterable[tuple[int, int, str | None]]) -> int:
+    cells = list(cells)
+    _check_positions(cells)
+    row_map, col_map = await get_position_maps(data_connection, schema, table_name)
+    physical_cells = cells
+    if not (row_map.identity and col_map.identity):
+        physical_cells = [(row_map.physical(row), col_map.physical(col), value) for row, col, value in cells]
+        _check_positions(physical_cells)
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    try:
+        async with data_connection.transaction():
+            if storage_mode == TILE_STORAGE:
+                written = await tile_storage.set_cell_values(data_connection, schema, table_name, physical_cells)
+            elif storage_mode == SHARED_STORAGE:
+                written = await shared_storage.set_cell_values(data_connection, schema, table_name, physical_cells)
+            else:
+                written = await _set_cell_values(data_connection, schema, table_name, physical_cells)
+            if written:
+                await record_changes(data_connection, schema, table_name, cells)
+    except asyncpg.UndefinedTableError:
+        raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+    if written:
+        await _notify_write_listeners(data_connection, schema, table_name, cells)
+    return written
+
+async def _set_cell_values(data_connection: Connection, schema: str, table_name: str, cells: list[tuple[int, int, str | None]]) -> int:
+    # Sequence number keeps the last write when the same cell appears more than once in a batch
+    records = [(seq, row, col, value) for seq, (row, col, value) in enumerate(cells)]
+    if not records:
+        return 0
+
+    async with data_connection.transaction():
+        await data_connection.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS _cell_batch (
+                seq INT,
+                row_index INT,
+                col_index INT,
+                value TEXT
+            ) ON COMMIT DELETE ROWS
+        ''')
+        await data_connection.execute('TRUNCATE _cell_batch')
+        await data_connection.copy_records_to_table('_cell_batch', records=records, columns=['seq', 'row_index', 'col_index', 'value'])
+
+        # Empty values delete the cell, everything else is upserted, both in one statement
+        await data_connection.execute(f'''
+            WITH batch AS (
+                SELECT DISTINCT ON (row_index, col_index) row_index, col_index, value
+                FROM _cell_batch
+                ORDER BY row_index, col_index, seq DESC
+            ), deleted AS (
+                DELETE FROM "{schema}"."{table_name}" AS target
+                USING batch
+                WHERE target.row_index = batch.row_index AND target.col_index = batch.col_index
+                AND (batch.value IS NULL OR batch.value = '')
+            )
+            INSERT INTO "{schema}"."{table_name}" (row_index, col_index, value)
+            SELECT row_index, col_index, value FROM batch WHERE value <> ''
             ON CONFLICT (row_index, col_index)
             DO UPDATE SET value = EXCLUDED.value
-        ''', row, col, value)
+        ''')
+
+    return len(records)
 
 async def get_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int) -> str | None:
+    cached = await _get_cached_range(data_connection, schema, table_name, row, row, col, col)
+    if cached is not None:
+        return cached[0][2] if cached else None
+
+    row_map, col_map = await get_position_maps(data_connection, schema, table_name)
+    row, col = row_map.physical(row), col_map.physical(col)
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    if storage_mode == TILE_STORAGE:
+        return await tile_storage.get_cell_value(data_connection, schema, table_name, row, col)
+    if storage_mode == SHARED_STORAGE:
+        return await shared_storage.get_cell_value(data_connection, schema, table_name, row, col)
+
     result = await data_connection.fetchrow(f'''
         SELECT value FROM "{schema}"."{table_name}" WHERE row_index = $1 AND col_index = $2
     ''', row, col)
@@ -47,20 +420,283 @@ async def get_cell_value(data_connection: Connection, schema: str, table_name: s
     else:
         return None
 
+def _range_query(schema: str, table_name: str, storage_mode: str, maps: tuple[AxisMap, AxisMap], start_row: int, end_row: int, start_col: int, end_col: int) -> tuple[str, list[int]]:
+    row_map, col_map = maps
+    if not (row_map.identity and col_map.identity):
+        # The logical range falls apart into one box per pair of physical row and column runs
+        return mapped_cells_sql(_box_sql(schema, table_name, storage_mode), row_map.intervals(start_row, end_row), col_map.intervals(start_col, end_col)), []
+    if storage_mode == TILE_STORAGE:
+        return tile_storage.range_sql(schema, table_name), tile_storage.range_args(start_row, end_row, start_col, end_col)
+    if storage_mode == SHARED_STORAGE:
+        return shared_storage.range_sql(schema, table_name), [start_row, end_row, start_col, end_col]
+    return f'''
+        SELECT row_index, col_index, value FROM "{schema}"."{table_name}"
+        WHERE row_index BETWEEN $1 AND $2 AND col_index BETWEEN $3 AND $4
+    ''', [start_row, end_row, start_col, end_col]
+
+async def get_range_sql(data_connection: Connection, schema: str, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> tuple[str, list[int]]:
+    # Query and arguments for the (row_index, col_index, value) cells of a logical range, for use as subquery
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    maps = await get_position_maps(data_connection, schema, table_name)
+    return _range_query(schema, table_name, storage_mode, maps, start_row, end_row, start_col, end_col)
+
+async def _get_cached_range(data_connection: Connection, schema: str, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> list[tuple[int, int, str]] | None:
+    # Reads inside a transaction may see uncommitted writes and must neither use nor fill the cache
+    if not cell_cache.enabled or data_connection.is_in_transaction():
+        return None
+
+    tile_rows = range(start_row // tile_storage.TILE_SIZE, end_row // tile_storage.TILE_SIZE + 1)
+    tile_cols = range(start_col // tile_storage.TILE_SIZE, end_col // tile_storage.TILE_SIZE + 1)
+    if len(tile_rows) * len(tile_cols) > MAX_CACHED_RANGE_TILES:
+        return None
+
+    tiles = {(schema, table_name, tile_row, tile_col): None for tile_row in tile_rows for tile_col in tile_cols}
+    for key in tiles:
+        tiles[key] = cell_cache.get(key)
+
+    missing = [key for key, tile in tiles.items() if tile is None]
+    if missing:
+        # All missing tiles are loaded with one query over their bounding box
+        generation = cell_cache.generation(schema, table_name)
+        storage_mode = await get_storage_mode(data_connection, schema, table_name)
+        maps = await get_position_maps(data_connection, schema, table_name)
+        range_sql, args = _range_query(
+            schema, table_name, storage_mode, maps,
+            min(key[2] for key in missing) * tile_storage.TILE_SIZE, (max(key[2] for key in missing) + 1) * tile_storage.TILE_SIZE - 1,
+            min(key[3] for key in missing) * tile_storage.TILE_SIZE, (max(key[3] for key in missing) + 1) * tile_storage.TILE_SIZE - 1,
+        )
+        loaded = {key: {} for key in missing}
+        for record in await data_connection.fetch(range_sql, *args):
+            key = (schema, table_name, record['row_index'] // tile_storage.TILE_SIZE, record['col_index'] // tile_storage.TILE_SIZE)
+            if key in loaded:
+                loaded[key][record['row_index'], record['col_index']] = record['value']
+        for key, tile in loaded.items():
+            cell_cache.put(key, tile, generation)
+            tiles[key] = tile
+
+    return sorted(
+        (row, col, value)
+        for tile in tiles.values()
+        for (row, col), value in tile.items()
+        if start_row <= row <= end_row and start_col <= col <= end_col
+    )
+
+async def get_range(data_connection: Connection, schema: str, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> list[tuple[int, int, str]]:
+    if end_row < start_row or end_col < start_col:
+        raise ValueError("Range end must not be before range start")
+
+    cached = await _get_cached_range(data_connection, schema, table_name, start_row, end_row, start_col, end_col)
+    if cached is not None:
+        return cached
+
+    # Single range scan on the primary key, only non-empty cells are returned
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    maps = await get_position_maps(data_connection, schema, table_name)
+    range_sql, args = _range_query(schema, table_name, storage_mode, maps, start_row, end_row, start_col, end_col)
+    results = await data_connection.fetch(f'''
+        SELECT row_index, col_index, value FROM ({range_sql}) AS cells
+        ORDER BY row_index, col_index
+    ''', *args)
+    return [(record['row_index'], record['col_index'], record['value']) for record in results]
+
+async def get_range_aggregates(data_connection: Connection, schema: str, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> tuple[int, float | None, float | None, float | None]:
+    # Count, sum, min and max of all numeric cells in the range, computed by Postgres without shipping the cells
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    maps = await get_position_maps(data_connection, schema, table_name)
+    range_sql, args = _range_query(schema, table_name, storage_mode, maps, start_row, end_row, start_col, end_col)
+    result = await data_connection.fetchrow(f'''
+        SELECT count(number) AS count, sum(number) AS sum, min(number) AS min, max(number) AS max FROM (
+            SELECT CASE WHEN value ~ ${len(args) + 1} THEN value::float8 END AS number FROM ({range_sql}) AS cells
+        ) AS numbers
+    ''', *args, NUMBER_PATTERN)
+    return result['count'], result['sum'], result['min'], result['max']
+
+async def get_cells(data_connection: Connection, schema: str, table_name: str, positions: Iterable[tuple[int, int]]) -> dict[tuple[int, int], str]:
+    positions = list(positions)
+    if not positions:
+        return {}
+    row_map, col_map = await get_position_maps(data_connection, schema, table_name)
+    logical = {(row_map.physical(row), col_map.physical(col)): (row, col) for row, col in positions}
+    physical_positions = list(logical)
+
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    if storage_mode == TILE_STORAGE:
+        values = await tile_storage.get_cells(data_connection, schema, table_name, physical_positions)
+    elif storage_mode == SHARED_STORAGE:
+        values = await shared_storage.get_cells(data_connection, schema, table_name, physical_positions)
+    else:
+        results = await data_connection.fetch(f'''
+            SELECT row_index, col_index, value FROM "{schema}"."{table_name}"
+            WHERE (row_index, col_index) IN (SELECT * FROM unnest($1::int[], $2::int[]))
+        ''', [row for row, _ in physical_positions], [col for _, col in physical_positions])
+        values = {(record['row_index'], record['col_index']): record['value'] for record in results}
+    return {logical[position]: value for position, value in values.items()}
+
+async def get_table_changes(data_connection: Connection, schema: str, table_name: str, since: int) -> tuple[int, bool, list[tuple[int, int, str | None]]]:
+    # Cells changed after revision since, or all cells as snapshot when the change log cannot cover the gap.
+    # Removed cells are returned with None as value, a snapshot only contains the current cells.
+    if data_connection.is_in_transaction():
+        transaction = data_connection.transaction()
+    else:
+        transaction = data_connection.transaction(isolation='repeatable_read', readonly=True)
+    async with transaction:
+        revision, cells = await get_changes_since(data_connection, schema, table_name, since)
+        if cells is not None:
+            return revision, False, cells
+        results = await data_connection.fetch(f'''
+            SELECT row_index, col_index, value FROM ({await get_cells_sql(data_connection, schema, table_name)}) AS cells
+            ORDER BY row_index, col_index
+        ''')
+        return revision, True, [(record['row_index'], record['col_index'], record['value']) for record in results]
+
+async def _delete_physical_runs(data_connection: Connection, schema: str, table_name: str, storage_mode: str, axis: str, runs: list[tuple[int, int]]):
+    index_column = "row_index" if axis == ROW_AXIS else "col_index"
+    first_ids, last_ids = [first for first, _ in runs], [last for _, last in runs]
+    if storage_mode == TILE_STORAGE:
+        removed = await data_connection.fetch(f'''
+            SELECT row_index, col_index FROM ({tile_storage.cells_sql(schema, table_name)}) AS cells
+            JOIN unnest($1::int[], $2::int[]) AS removed (first_id, last_id) ON cells.{index_column} BETWEEN removed.first_id AND removed.last_id
+        ''', first_ids, last_ids)
+        await tile_storage.set_cell_values(data_connection, schema, table_name, [(record['row_index'], record['col_index'], None) for record in removed])
+    elif storage_mode == SHARED_STORAGE:
+        await shared_storage.delete_runs(data_connection, schema, table_name, index_column, runs)
+    else:
+        await data_connection.execute(f'''
+            DELETE FROM "{schema}"."{table_name}" AS target
+            USING unnest($1::int[], $2::int[]) AS removed (first_id, last_id)
+            WHERE target.{index_column} BETWEEN removed.first_id AND removed.last_id
+        ''', first_ids, last_ids)
+
+async def change_table_structure(data_connection: Connection, schema: str, table_name: str, axis: str, operation: str, position: int, count: int = 1, destination: int | None = None):
+    if axis not in AXES:
+        raise ValueError(f"Unknown axis {axis}")
+    if operation not in STRUCTURE_OPERATIONS:
+        raise ValueError(f"Unknown structure operation {operation}")
+    if position < 0 or count < 1 or (operation == "move") != (destination is not None) or (destination is not None and destination < 0):
+        raise ValueError("Invalid position, count or destination")
+
+    # Only the maps in the catalog change, cells keep their physical ids unless their row or column is deleted
+    storage_mode = await get_storage_mode(data_connection, schema, table_name)
+    try:
+        async with data_connection.transaction():
+            result = await data_connection.fetchrow('''
+                SELECT row_map, col_map FROM table_storage WHERE schema_name = $1 AND table_name = $2 FOR UPDATE
+            ''', schema, table_name)
+            if result is None:
+                raise ValueError(f"Table {table_name} does not exist in schema {schema}")
+            maps = (AxisMap.from_json(result['row_map']), AxisMap.from_json(result['col_map']))
+            axis_map = maps[0] if axis == ROW_AXIS else maps[1]
+
+            if operation == "insert":
+                axis_map.insert(position, count)
+            elif operation == "delete":
+                await _delete_physical_runs(data_connection, schema, table_name, storage_mode, axis, axis_map.delete(position, count))
+            else:
+                axis_map.move(position, count, destination)
+
+            await data_connection.execute('''
+                UPDATE table_storage SET row_map = $3, col_map = $4 WHERE schema_name = $1 AND table_name = $2
+            ''', schema, table_name, maps[0].to_json(), maps[1].to_json())
+            await record_changes(data_connection, schema, table_name, None)
+            _position_maps[schema, table_name] = maps
+    except Exception:
+        _position_maps.pop((schema, table_name), None)
+        raise
+    await _notify_write_listeners(data_connection, schema, table_name, None)
+
+async def _replace_user_permissions(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID, current: list[tuple], rectangles: list[tuple]):
+    # Writes only the difference between the stored and the new rectangles
+    removed = set(current) - set(rectangles)
+    added = set(rectangles) - set(current)
+    permissions = await get_permission_table(user_connection, project_id)
+    if removed:
+        await user_connection.executemany(f'''
+            DELETE FROM {permissions.relation}
+            WHERE {permissions.scope} AND table_id = $1 AND user_id = $2 AND start_row = $3 AND end_row = $4 AND start_col = $5 AND end_col = $6
+        ''', [(table_id, user_id, *rectangle[:4]) for rectangle in removed])
+    if added:
+        await user_connection.executemany(f'''
+            INSERT INTO {permissions.relation} ({permissions.key}table_id, user_id, start_row, end_row, start_col, end_col, permission)
+            VALUES ({permissions.key_value}$1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT ({permissions.key}table_id, user_id, start_row, end_row, start_col, end_col)
+            DO UPDATE SET permission = EXCLUDED.permission
+        ''', [(table_id, user_id, *rectangle) for rectangle in added])
+
+async def _apply_permission_rectangle(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID, rectangle: tuple[int, int, int, int, str]):
+    # The new rectangle replaces whatever was set for its cells before, the result is normalized again
+    async with user_connection.transaction():
+        await user_connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', f"permissions:{project_id}:{table_id}:{user_id}")
+        current = [tuple(record) for record in await get_all_user_permissions(user_connection, project_id, table_id, user_id)]
+        pieces = [piece for existing in current for piece in subtract_rectangle(existing, rectangle)]
+        await _replace_user_permissions(user_connection, project_id, table_id, user_id, current, normalize_rectangles(pieces + [rectangle]))
+    await permissions_changed(user_connection, project_id, table_id, user_id)
+
 async def set_permission(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID, start_row: int, end_row: int, start_col: int, end_col: int, permission: str):
-    await user_connection.execute(f'''
-        INSERT INTO permissions."{project_id}" (table_id, user_id, start_row, end_row, start_col, end_col, permission)
-        VALUES ($1, $2, $3, $4, $5, $6, $7)
-        ON CONFLICT (table_id, user_id, start_row, end_row, start_col, end_col)
-        DO UPDATE SET permission = EXCLUDED.permission
-    ''', table_id, user_id, start_row, end_row, start_col, end_col, permission)
+    await _apply_permission_rectangle(user_connection, project_id, table_id, user_id, (start_row, end_row, start_col, end_col, permission))
 
 async def get_all_user_permissions(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID):
-    permissions = await user_connection.fetch(f'''SELECT start_row, end_row, start_col, end_col, permission FROM permissions."{project_id}" where table_id = $1 AND user_id = $2''', table_id, user_id)
-    return permissions
+    permissions = await get_permission_table(user_connection, project_id)
+    return await user_connection.fetch(f'''SELECT start_row, end_row, start_col, end_col, permission FROM {permissions.relation} where {permissions.scope} AND table_id = $1 AND user_id = $2''', table_id, user_id)
 
 async def delete_all_user_permissions(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID):
-    await user_connection.execute(f'''DELETE FROM permissions."{project_id}" WHERE table_id = $1 AND user_id = $2''', table_id, user_id)
+    permissions = await get_permission_table(user_connection, project_id)
+    await user_connection.execute(f'''DELETE FROM {permissions.relation} WHERE {permissions.scope} AND table_id = $1 AND user_id = $2''', table_id, user_id)
+    await permissions_changed(user_connection, project_id, table_id, user_id)
 
 async def delete_permission_range(user_connection: Connection, project_id: UUID, table_id: UUID, user_id: UUID, start_row: int, end_row: int, start_col: int, end_col: int):
-    await user_connection.execute(f'''DELETE FROM permissions."{project_id}" WHERE table_id = $1 AND user_id = $2 AND start_row = $3 AND end_row = $4 AND start_col = $5 AND end_col = $6''', table_id, user_id, start_row, end_row, start_col, end_col)
\ No newline at end of file
+    await _apply_permission_rectangle(user_connection, project_id, table_id, user_id, (start_row, end_row, start_col, end_col, "none"))
+
+async def normalize_project_permissions(user_connection: Connection, project_id: UUID) -> tuple[int, int]:
+    # Maintenance for rectangles stored before normalization on write, returns the number of rectangles before and after
+    permissions = await get_permission_table(user_connection, project_id)
+    async with user_connection.transaction():
+        if permissions.key:
+            # The shared table is not locked as a whole, only the rows of the project
+            results = await user_connection.fetch(f'''SELECT table_id, user_id, start_row, end_row, start_col, end_col, permission FROM {permissions.relation} WHERE {permissions.scope} FOR UPDATE''')
+        else:
+            await user_connection.execute(f'''LOCK TABLE {permissions.relation} IN SHARE ROW EXCLUSIVE MODE''')
+            results = await user_connection.fetch(f'''SELECT table_id, user_id, start_row, end_row, start_col, end_col, permission FROM {permissions.relation}''')
+        grouped = {}
+        for record in results:
+            grouped.setdefault((record['table_id'], record['user_id']), []).append(tuple(record)[2:])
+        after = 0
+        for (table_id, user_id), current in grouped.items():
+            normalized = normalize_rectangles(current)
+            after += len(normalized)
+            await _replace_user_permissions(user_connection, project_id, table_id, user_id, current, normalized)
+    await permissions_changed(user_connection, project_id)
+    return len(results), after
+
+def table_id_of(table_name: str) -> UUID | None:
+    # Tables are addressed by name, their permissions by the uuid the table is named after. Other names have none.
+    try:
+        return UUID(table_name)
+    except ValueError:
+        return None
+
+
+async def remap_permission_ranges(user_connection: Connection, project_id: UUID, table_id: UUID | str, axis: str, operation: str, position: int, count: int = 1, destination: int | None = None):
+    # Permission ranges stay in logical positions and follow the rows and columns they cover,
+    # ranges that end before the first changed position are not touched
+    start_column, end_column = ("start_row", "end_row") if axis == ROW_AXIS else ("start_col", "end_col")
+    first_changed = position if destination is None else min(position, destination)
+    permissions = await get_permission_table(user_connection, project_id)
+    # Compared as text like in delete_table, a table name that is no uuid simply has no ranges
+    table_id = str(table_id)
+    async with user_connection.transaction():
+        ranges = await user_connection.fetch(f'''
+            DELETE FROM {permissions.relation} WHERE {permissions.scope} AND table_id::text = $1 AND {end_column} >= $2
+            RETURNING user_id, start_row, end_row, start_col, end_col, permission
+        ''', table_id, first_changed)
+        remapped_ranges = {}
+        for record in ranges:
+            for start, end in remap_range(operation, position, count, destination, record[start_column], record[end_column]):
+                remapped = {**record, start_column: start, end_column: end}
+                remapped_ranges.setdefault(record['user_id'], []).append((remapped['start_row'], remapped['end_row'], remapped['start_col'], remapped['end_col'], remapped['permission']))
+        # Remapped ranges of a user can touch each other and are normalized again
+        await user_connection.executemany(f'''
+            INSERT INTO {permissions.relation} ({permissions.key}table_id, user_id, start_row, end_row, start_col, end_col, permission)
+            VALUES ({permissions.key_value}$1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT ({permissions.key}table_id, user_id, start_row, end_row, start_col, end_col) DO NOTHING
+        ''', [(table_id, user_id, *rectangle) for user_id, rectangles in remapped_ranges.items() for rectangle in normalize_rectangles(rectangles)])
+        await permissions_changed(user_connection, project_id, table_id)
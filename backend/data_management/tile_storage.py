@@ -0,0 +1,150 @@
+import json
+from typing import Iterable
+
+from asyncpg import Connection
+
+# Tables in tile mode store TILE_SIZE x TILE_SIZE cells per row in a jsonb object keyed by "row:col" inside the tile
+TILE_SIZE = 64
+
+
+def tile_of(row: int, col: int) -> tuple[int, int, str]:
+    return row // TILE_SIZE, col // TILE_SIZE, f"{row % TILE_SIZE}:{col % TILE_SIZE}"
+
+
+def cells_sql(schema: str, table_name: str) -> str:
+    return f'''
+        SELECT tile_row * {TILE_SIZE} + split_part(cell.key, ':', 1)::int AS row_index,
+               tile_col * {TILE_SIZE} + split_part(cell.key, ':', 2)::int AS col_index,
+               cell.value AS value,
+               tile_row, tile_col
+        FROM "{schema}"."{table_name}", jsonb_each_text(cells) AS cell
+    '''
+
+
+def tiles_from_cells_sql(source_sql: str) -> str:
+    return f'''
+        SELECT tile_row, tile_col,
+               jsonb_object_agg((row_index - tile_row * {TILE_SIZE}) || ':' || (col_index - tile_col * {TILE_SIZE}), value) AS cells
+        FROM (
+            SELECT floor(row_index::numeric / {TILE_SIZE})::int AS tile_row,
+                   floor(col_index::numeric / {TILE_SIZE})::int AS tile_col,
+                   row_index, col_index, value
+            FROM ({source_sql}) AS source
+        ) AS located
+        GROUP BY tile_row, tile_col
+    '''
+
+
+async def create_tile_table(data_connection: Connection, schema: str, table_name: str):
+    await data_connection.execute(f'''CREATE TABLE "{schema}"."{table_name}" (
+                                  tile_row INT,
+                                  tile_col INT,
+                                  cells JSONB NOT NULL,
+                                  PRIMARY KEY (tile_row, tile_col)
+                                  )''')
+
+
+async def get_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int) -> str | None:
+    tile_row, tile_col, key = tile_of(row, col)
+    return await data_connection.fetchval(f'''
+        SELECT cells ->> $3 FROM "{schema}"."{table_name}" WHERE tile_row = $1 AND tile_col = $2
+    ''', tile_row, tile_col, key)
+
+
+async def set_cell_value(data_connection: Connection, schema: str, table_name: str, row: int, col: int, value: str | None):
+    tile_row, tile_col, key = tile_of(row, col)
+    if not value:
+        async with data_connection.transaction():
+            await data_connection.execute(f'''
+                UPDATE "{schema}"."{table_name}" SET cells = cells - $3 WHERE tile_row = $1 AND tile_col = $2
+            ''', tile_row, tile_col, key)
+            await data_connection.execute(f'''
+                DELETE FROM "{schema}"."{table_name}" WHERE tile_row = $1 AND tile_col = $2 AND cells = '{{}}'
+            ''', tile_row, tile_col)
+    else:
+        await data_connection.execute(f'''
+            INSERT INTO "{schema}"."{table_name}" AS target (tile_row, tile_col, cells)
+            VALUES ($1, $2, jsonb_build_object($3::text, $4::text))
+            ON CONFLICT (tile_row, tile_col)
+            DO UPDATE SET cells = target.cells || EXCLUDED.cells
+        ''', tile_row, tile_col, key, value)
+
+
+def range_sql(schema: str, table_name: str) -> str:
+    # Only the tiles overlapping the range are read, the cells are unpacked and filtered in the same query
+    return f'''
+        SELECT row_index, col_index, value FROM ({cells_sql(schema, table_name)}
+            WHERE tile_row BETWEEN $5 AND $6 AND tile_col BETWEEN $7 AND $8
+        ) AS tile_cells
+        WHERE row_index BETWEEN $1 AND $2 AND col_index BETWEEN $3 AND $4
+    '''
+
+
+def box_sql(schema: str, table_name: str, start_row: str, end_row: str, start_col: str, end_col: str) -> str:
+    # Same as range_sql with the bounds given as SQL expressions, the overlapping tiles are computed by Postgres
+    return f'''
+        SELECT row_index, col_index, value FROM ({cells_sql(schema, table_name)}
+            WHERE tile_row BETWEEN floor({start_row}::numeric / {TILE_SIZE})::int AND floor({end_row}::numeric / {TILE_SIZE})::int
+            AND tile_col BETWEEN floor({start_col}::numeric / {TILE_SIZE})::int AND floor({end_col}::numeric / {TILE_SIZE})::int
+        ) AS tile_cells
+        WHERE row_index BETWEEN {start_row} AND {end_row} AND col_index BETWEEN {start_col} AND {end_col}
+    '''
+
+
+def range_args(start_row: int, end_row: int, start_col: int, end_col: int) -> list[int]:
+    return [start_row, end_row, start_col, end_col,
+            start_row // TILE_SIZE, end_row // TILE_SIZE, start_col // TILE_SIZE, end_col // TILE_SIZE]
+
+
+async def get_cells(data_connection: Connection, schema: str, table_name: str, positions: list[tuple[int, int]]) -> dict[tuple[int, int], str]:
+    tiles = {tile_of(row, col)[:2] for row, col in positions}
+    results = await data_connection.fetch(f'''
+        SELECT row_index, col_index, value FROM ({cells_sql(schema, table_name)}
+            WHERE (tile_row, tile_col) IN (SELECT * FROM unnest($3::int[], $4::int[]))
+        ) AS tile_cells
+        WHERE (row_index, col_index) IN (SELECT * FROM unnest($1::int[], $2::int[]))
+    ''', [row for row, _ in positions], [col for _, col in positions], [tile[0] for tile in tiles], [tile[1] for tile in tiles])
+    return {(record['row_index'], record['col_index']): record['value'] for record in results}
+
+
+async def set_cell_values(data_connection: Connection, schema: str, table_name: str, cells: Iterable[tuple[int, int, str | None]]) -> int:
+    # Later writes to the same cell win, the batch is then grouped into one patch per tile
+    written = 0
+    latest = {}
+    for row, col, value in cells:
+        latest[row, col] = value
+        written += 1
+
+    updates = {}
+    removals = {}
+    for (row, col), value in latest.items():
+        tile_row, tile_col, key = tile_of(row, col)
+        if value:
+            updates.setdefault((tile_row, tile_col), {})[key] = value
+        else:
+            removals.setdefault((tile_row, tile_col), []).append(key)
+
+    async with data_connection.transaction():
+        if updates:
+            await data_connection.execute(f'''
+                INSERT INTO "{schema}"."{table_name}" AS target (tile_row, tile_col, cells)
+                SELECT * FROM unnest($1::int[], $2::int[], $3::jsonb[])
+                ON CONFLICT (tile_row, tile_col)
+                DO UPDATE SET cells = target.cells || EXCLUDED.cells
+            ''', [tile[0] for tile in updates], [tile[1] for tile in updates], [json.dumps(patch) for patch in updates.values()])
+
+        if removals:
+            tile_rows = [tile[0] for tile in removals]
+            tile_cols = [tile[1] for tile in removals]
+            await data_connection.execute(f'''
+                UPDATE "{schema}"."{table_name}" AS target
+                SET cells = target.cells - ARRAY(SELECT jsonb_array_elements_text(removal.keys))
+                FROM unnest($1::int[], $2::int[], $3::jsonb[]) AS removal (tile_row, tile_col, keys)
+                WHERE target.tile_row = removal.tile_row AND target.tile_col = removal.tile_col
+            ''', tile_rows, tile_cols, [json.dumps(keys) for keys in removals.values()])
+            await data_connection.execute(f'''
+                DELETE FROM "{schema}"."{table_name}"
+                WHERE cells = '{{}}' AND (tile_row, tile_col) IN (SELECT * FROM unnest($1::int[], $2::int[]))
+            ''', tile_rows, tile_cols)
+
+    return written
@@ -1,8 +1,12 @@
 from fastapi import APIRouter
-from backend.routes.api_routes import users, dev
+from backend.routes.api_routes import users, dev, tables, projects, deletions, teams
 
 
 api_router = APIRouter(prefix="/api", tags=["api"])
 
 api_router.include_router(users.router)
-api_router.include_router(dev.router)
\ No newline at end of file
+api_router.include_router(dev.router)
+api_router.include_router(tables.router)
+api_router.include_router(projects.router)
+api_router.include_router(deletions.router)
+api_router.include_router(teams.router)
\ No newline at end of file
@@ -0,0 +1,67 @@
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException
+from asyncpg import Connection
+
+from backend.data_management.deletion_queue import get_deletion, list_deletions, retry_deletion
+from backend.data_management.pool_handler import get_data_pool
+from backend.routes.api_routes.tables import require_login
+from backend.user_management.effective_roles import has_project_role, projects_with_role
+from backend.user_management.pool_handler import get_user_pool
+
+
+router = APIRouter(prefix="/deletions", tags=["deletions"])
+
+
+async def require_deletion_access(user_conn: Connection, user_id: str, deletion: dict):
+    # Project admins see the deletions of their project, the requester keeps access after the project itself is gone
+    if deletion["requested_by"] == user_id:
+        return
+    try:
+        project_id = UUID(deletion["project_id"])
+    except ValueError:
+        project_id = None
+    if project_id is None or not await has_project_role(user_conn, UUID(user_id), project_id, "admin"):
+        raise HTTPException(status_code=403, detail="Keine Berechtigung für diese Löschung.")
+
+
+@router.get("")
+async def api_deletions_get(
+    project_id: str | None = None,
+    include_finished: bool = False,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    visible_schemas = [str(project) for project in await projects_with_role(user_conn, UUID(user_id), "admin")]
+    return {"deletions": await list_deletions(conn, project_id, include_finished, visible_schemas, UUID(user_id))}
+
+
+@router.get("/{deletion_id}")
+async def api_deletion_get(
+    deletion_id: UUID,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    try:
+        deletion = await get_deletion(conn, deletion_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    await require_deletion_access(user_conn, user_id, deletion)
+    return deletion
+
+
+@router.post("/{deletion_id}/retry")
+async def api_deletion_retry_post(
+    deletion_id: UUID,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    try:
+        await require_deletion_access(user_conn, user_id, await get_deletion(conn, deletion_id))
+        await retry_deletion(conn, deletion_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return await get_deletion(conn, deletion_id)
@@ -6,9 +6,14 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import FileResponse
 from dataclasses import dataclass
+import os
 import time
-from backend.user_management.pool_handler import user_pool, get_user_pool
+from backend.user_management.pool_handler import get_user_pool
 from backend.user_management.user_handler import *
+from backend.data_management.pool_manager import pool_manager
+from backend.data_management.replica_router import replica_router
+from backend.user_management.login_guard import login_guard
+from backend.routes.api_routes.tables import require_login
 from starlette.middleware.sessions import SessionMiddleware
 templates = Jinja2Templates(directory="templates")
 # END STANDARD IMPORT
@@ -16,7 +21,31 @@ templates = Jinja2Templates(directory="templates")
 router = APIRouter(tags=["dev_routes"])
 
 
+def require_development():
+    # The stats expose internals of the server, they are only served in development and only to logged in users
+    if os.getenv("APP_ENV", "development") != "development":
+        raise HTTPException(status_code=404)
+
+
 
 @router.get("/get_session")
 def api_get_session_get(request: Request):
-    return {"session": request.session}
\ No newline at end of file
+    return {"session": request.session}
+
+
+@router.get("/login_stats", dependencies=[Depends(require_development), Depends(require_login)])
+def api_login_stats_get():
+    # Counters of the login rate limiter, load shedding and password hashing workers
+    return login_guard.stats()
+
+
+@router.get("/pool_stats", dependencies=[Depends(require_development), Depends(require_login)])
+def api_pool_stats_get():
+    # Size, connections in use, acquire wait and connection churn per database pool
+    return pool_manager.stats()
+
+
+@router.get("/replica_stats", dependencies=[Depends(require_development), Depends(require_login)])
+def api_replica_stats_get():
+    # Lag and routed reads per replica
+    return replica_router.stats()
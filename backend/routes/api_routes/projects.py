@@ -0,0 +1,110 @@
+from uuid import UUID
+
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException
+from asyncpg import Connection
+from pydantic import BaseModel
+
+from backend.data_management.pool_handler import get_data_pool
+from backend.data_management.project_handler import add_members, change_member_roles, delete_project, project_exists, remove_members
+from backend.routes.api_routes.tables import require_login
+from backend.user_management.effective_roles import get_effective_role, has_project_role
+from backend.user_management.pool_handler import get_user_pool
+
+
+router = APIRouter(prefix="/projects", tags=["projects"])
+
+
+class MemberRole(BaseModel):
+    user_id: UUID
+    role: str
+
+
+class MemberBatch(BaseModel):
+    members: list[MemberRole]
+
+
+class UserBatch(BaseModel):
+    user_ids: list[UUID]
+
+
+async def require_project_admin(user_conn: Connection, user_id: str, project_id: UUID) -> str:
+    # Returns the role of the caller, members at or above it are out of their reach
+    if not await project_exists(user_conn, project_id):
+        raise HTTPException(status_code=404, detail="Projekt nicht gefunden.")
+    if not await has_project_role(user_conn, UUID(user_id), project_id, "admin"):
+        raise HTTPException(status_code=403, detail="Keine Berechtigung, die Mitglieder zu verwalten.")
+    return await get_effective_role(user_conn, UUID(user_id), project_id)
+
+
+@router.delete("/{project_id}", status_code=202)
+async def api_projects_delete(
+    project_id: UUID,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    if not await project_exists(user_conn, project_id):
+        raise HTTPException(status_code=404, detail="Projekt nicht gefunden.")
+    if not await has_project_role(user_conn, UUID(user_id), project_id, "owner"):
+        raise HTTPException(status_code=403, detail="Nur der Besitzer darf das Projekt löschen.")
+    # The data is dropped in the background, progress is available under /api/deletions/{deletion_id}
+    deletion_id = await delete_project(user_conn, conn, project_id, UUID(user_id))
+    return {"deletion_id": str(deletion_id)}
+
+
+# The batch endpoints are atomic, when one entry fails none of the changes are applied
+
+@router.post("/{project_id}/members/batch")
+async def api_projects_add_members(
+    project_id: UUID,
+    batch: MemberBatch,
+    user_id = Depends(require_login),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    await require_project_admin(user_conn, user_id, project_id)
+    if any(member.role == "owner" for member in batch.members):
+        raise HTTPException(status_code=400, detail="Die Besitzer-Rolle kann nicht vergeben werden.")
+    try:
+        await add_members(user_conn, project_id, [member.user_id for member in batch.members], [member.role for member in batch.members])
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(status_code=409, detail="Mindestens ein Benutzer ist bereits Mitglied.")
+    except (ValueError, asyncpg.DataError, asyncpg.ForeignKeyViolationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"added": len(batch.members)}
+
+
+@router.patch("/{project_id}/members/batch")
+async def api_projects_change_member_roles(
+    project_id: UUID,
+    batch: MemberBatch,
+    user_id = Depends(require_login),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    caller_role = await require_project_admin(user_conn, user_id, project_id)
+    if any(member.role == "owner" for member in batch.members):
+        raise HTTPException(status_code=400, detail="Die Besitzer-Rolle kann nicht vergeben werden.")
+    try:
+        await change_member_roles(user_conn, project_id, [member.user_id for member in batch.members], [member.role for member in batch.members], caller_role)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Der Besitzer und Mitglieder mit gleicher oder höherer Rolle können nicht geändert werden.")
+    except (ValueError, asyncpg.DataError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"changed": len(batch.members)}
+
+
+@router.post("/{project_id}/members/batch_remove")
+async def api_projects_remove_members(
+    project_id: UUID,
+    batch: UserBatch,
+    user_id = Depends(require_login),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    caller_role = await require_project_admin(user_conn, user_id, project_id)
+    try:
+        await remove_members(user_conn, project_id, batch.user_ids, caller_role)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Der Besitzer und Mitglieder mit gleicher oder höherer Rolle können nicht entfernt werden.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"removed": len(batch.user_ids)}
@@ -0,0 +1,318 @@
+import json
+import logging
+from dataclasses import asdict
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from asyncpg import Connection
+from pydantic import BaseModel
+
+from backend.data_management.change_log import get_revision
+from backend.data_management.collab_hub import collab_hub
+from backend.data_management.export_handler import export_table, EXPORT_FORMATS
+from backend.data_management.formula_engine import get_computed_range
+from backend.data_management.import_handler import ImportProgress, file_cells, stream_import, IMPORT_FORMATS
+from backend.data_management.permission_index import PermissionIndex, get_permission_index
+from backend.data_management.permission_mirror import get_masked_range
+from backend.data_management.pool_handler import get_data_pool, get_data_read_pool
+from backend.data_management.pool_manager import DATA_POOL, USER_POOL, pool_manager
+from backend.data_management.position_map import MAX_POSITION
+from backend.data_management.table_handler import get_range, set_cell_values, change_table_structure, remap_permission_ranges, \
+    get_table_changes, delete_table, table_exists, table_id_of
+from backend.user_management.effective_roles import has_project_role
+from backend.user_management.pool_handler import get_user_pool
+
+
+logger = logging.getLogger("api_logger")
+
+router = APIRouter(prefix="/tables", tags=["tables"])
+
+
+class CellBatch(BaseModel):
+    cells: list[tuple[int, int, str | None]]
+
+
+class StructureChange(BaseModel):
+    axis: str
+    operation: str
+    position: int
+    count: int = 1
+    destination: int | None = None
+
+
+def require_login(request: Request):
+    if "logged_in" in request.session and request.session["logged_in"] == True and "user" in request.session:
+        return request.session["user"]
+    raise HTTPException(status_code=401, detail="Nicht angemeldet.")
+
+
+async def project_role_allowed(user_id: str, project_id: UUID, minimum_role: str) -> bool:
+    # A short lived connection, so streaming responses do not hold a user connection for their whole duration
+    async with pool_manager.acquire(USER_POOL) as user_conn:
+        return await has_project_role(user_conn, UUID(user_id), project_id, minimum_role)
+
+
+def parse_project_id(project_id: str) -> UUID:
+    try:
+        return UUID(project_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Ungültige Projekt-ID.")
+
+
+async def cell_permissions(user_id: str, project_id: UUID, table_name: str) -> PermissionIndex | None:
+    # The compiled permission rectangles of the user on the table, tables that are not named after a uuid have none
+    table_id = table_id_of(table_name)
+    if table_id is None:
+        return None
+    async with pool_manager.acquire(USER_POOL) as user_conn:
+        return await get_permission_index(user_conn, project_id, table_id, UUID(user_id))
+
+
+async def range_allowed(user_id: str, project_id: UUID, table_name: str, start_row: int, end_row: int, start_col: int, end_col: int) -> bool:
+    # Cell permissions grant access beyond the project role, here read access on the whole range
+    index = await cell_permissions(user_id, project_id, table_name)
+    return index is not None and index.viewport_permission(start_row, end_row, start_col, end_col) != "none"
+
+
+async def cells_writable(user_id: str, project_id: UUID, table_name: str, cells: list[tuple[int, int, str | None]]) -> bool:
+    # Cell permissions grant access beyond the project role, here write access on every cell of the batch
+    index = await cell_permissions(user_id, project_id, table_name)
+    return index is not None and bool(cells) and all(index.cell(row, col) == "write" for row, col, _ in cells)
+
+
+def require_project_role(minimum_role: str):
+    # Dependency for routes with a project_id path parameter, returns the id of the logged in user
+    async def check_project_role(project_id: str, user_id = Depends(require_login)):
+        project_uuid = parse_project_id(project_id)
+        if not await project_role_allowed(user_id, project_uuid, minimum_role):
+            raise HTTPException(status_code=403, detail="Keine Berechtigung für dieses Projekt.")
+        return user_id
+    return check_project_role
+
+
+@router.get("/{project_id}/{table_name}/range")
+async def api_tables_range_get(
+    project_id: str,
+    table_name: str,
+    start_row: int,
+    end_row: int,
+    start_col: int,
+    end_col: int,
+    computed: bool = False,
+    masked: bool = False,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_read_pool)
+):
+    # Masked reads only return cells the user has a permission on, other reads need the viewer role or read access on the range.
+    # Formula results can depend on cells outside the range, so computed reads always need the role.
+    project_uuid = parse_project_id(project_id)
+    if not masked and not await project_role_allowed(user_id, project_uuid, "viewer"):
+        if computed or not await range_allowed(user_id, project_uuid, table_name, start_row, end_row, start_col, end_col):
+            raise HTTPException(status_code=403, detail="Keine Berechtigung für diesen Bereich.")
+    try:
+        if masked:
+            # Only cells the user may read, each with the user's permission on it
+            table_id = table_id_of(table_name)
+            cells = [] if table_id is None else \
+                await get_masked_range(conn, project_id, table_name, table_id, UUID(user_id), start_row, end_row, start_col, end_col)
+        elif computed:
+            cells = await get_computed_range(conn, project_id, table_name, start_row, end_row, start_col, end_col)
+        else:
+            cells = await get_range(conn, project_id, table_name, start_row, end_row, start_col, end_col)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"cells": cells}
+
+
+@router.get("/{project_id}/{table_name}/changes")
+async def api_tables_changes_get(
+    project_id: str,
+    table_name: str,
+    since: int,
+    user_id = Depends(require_project_role("viewer")),
+    conn: Connection = Depends(get_data_read_pool)
+):
+    try:
+        revision, snapshot, cells = await get_table_changes(conn, project_id, table_name, since)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"revision": revision, "snapshot": snapshot, "cells": cells}
+
+
+@router.post("/{project_id}/{table_name}/cells")
+async def api_tables_cells_post(
+    project_id: str,
+    table_name: str,
+    batch: CellBatch,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool)
+):
+    project_uuid = parse_project_id(project_id)
+    if not await project_role_allowed(user_id, project_uuid, "editor") and not await cells_writable(user_id, project_uuid, table_name, batch.cells):
+        raise HTTPException(status_code=403, detail="Keine Berechtigung, diese Zellen zu bearbeiten.")
+    try:
+        written = await set_cell_values(conn, project_id, table_name, batch.cells)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"written": written}
+
+
+@router.post("/{project_id}/{table_name}/structure")
+async def api_tables_structure_post(
+    project_id: str,
+    table_name: str,
+    change: StructureChange,
+    user_id = Depends(require_project_role("editor")),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    try:
+        await change_table_structure(conn, project_id, table_name, change.axis, change.operation, change.position, change.count, change.destination)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The structure change is already committed on the data database, a failed remap is reported, not turned into a 500
+    try:
+        await remap_permission_ranges(user_conn, project_id, table_name, change.axis, change.operation, change.position, change.count, change.destination)
+    except Exception:
+        logger.error(f"Remapping the permission ranges of {project_id}.{table_name} after a structure change failed", exc_info=True)
+        return {"changed": True, "permissions_remapped": False}
+    return {"changed": True, "permissions_remapped": True}
+
+
+@router.delete("/{project_id}/{table_name}", status_code=202)
+async def api_tables_delete(
+    project_id: str,
+    table_name: str,
+    user_id = Depends(require_login),
+    conn: Connection = Depends(get_data_pool),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    try:
+        allowed = await has_project_role(user_conn, UUID(user_id), UUID(project_id), "admin")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not allowed:
+        raise HTTPException(status_code=403, detail="Keine Berechtigung, Tabellen zu löschen.")
+    # The table is dropped in the background, progress is available under /api/deletions/{deletion_id}
+    try:
+        deletion_id = await delete_table(user_conn, conn, table_name, project_id, UUID(user_id))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"deletion_id": str(deletion_id)}
+
+
+@router.post("/{project_id}/{table_name}/import")
+async def api_tables_import_post(
+    project_id: str,
+    table_name: str,
+    file: UploadFile = File(...),
+    file_format: str | None = None,
+    start_row: int = 0,
+    start_col: int = 0,
+    user_id = Depends(require_project_role("editor")),
+    conn: Connection = Depends(get_data_pool)
+):
+    if file_format is None:
+        file_format = (file.filename or "").rsplit(".", 1)[-1].lower()
+    if file_format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported import format {file_format}")
+    # Once the stream started the status is sent, so a missing table is reported before
+    if not await table_exists(conn, project_id, table_name):
+        raise HTTPException(status_code=404, detail=f"Table {table_name} does not exist in schema {project_id}")
+
+    progress = ImportProgress()
+    cells = file_cells(file.file, file_format, progress, start_row, start_col)
+
+    async def progress_lines():
+        # Failures after the first line end the stream with an error line, the batches written so far stay committed
+        try:
+            async for update in stream_import(conn, project_id, table_name, cells, progress):
+                yield json.dumps(asdict(update)) + "\n"
+        except ValueError as e:
+            yield json.dumps({**asdict(progress), "error": str(e), "done": True}) + "\n"
+        except Exception:
+            logger.error(f"Importing into {project_id}.{table_name} failed", exc_info=True)
+            yield json.dumps({**asdict(progress), "error": "Import fehlgeschlagen.", "done": True}) + "\n"
+        else:
+            yield json.dumps({**asdict(progress), "done": True}) + "\n"
+
+    return StreamingResponse(progress_lines(), media_type="application/x-ndjson")
+
+
+@router.get("/{project_id}/{table_name}/export")
+async def api_tables_export_get(
+    project_id: str,
+    table_name: str,
+    export_format: str = "csv",
+    user_id = Depends(require_project_role("viewer")),
+    conn: Connection = Depends(get_data_read_pool)
+):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format {export_format}")
+
+    extension = "arrows" if export_format == "arrow" else export_format
+    return StreamingResponse(
+        export_table(conn, project_id, table_name, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{table_name}.{extension}"'},
+    )
+
+
+@router.websocket("/{project_id}/{table_name}/ws")
+async def api_tables_ws(websocket: WebSocket, project_id: str, table_name: str):
+    session = websocket.session
+    if not (session.get("logged_in") == True and "user" in session):
+        await websocket.close(code=1008)
+        return
+    user_id = session["user"]
+    try:
+        project_uuid = UUID(project_id)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    if not await project_role_allowed(user_id, project_uuid, "viewer"):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    collab_hub.join(project_id, table_name, websocket)
+    try:
+        # Clients that reconnect catch up with /changes?since= this revision
+        async with pool_manager.acquire(DATA_POOL) as conn:
+            try:
+                revision = await get_revision(conn, project_id, table_name)
+            except ValueError:
+                await websocket.close(code=1008)
+                return
+        await websocket.send_json({"type": "ready", "revision": revision})
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (json.JSONDecodeError, KeyError):
+                # KeyError is raised for binary frames, which carry no text
+                await websocket.send_json({"type": "error", "detail": "Invalid message"})
+                continue
+            if not isinstance(message, dict):
+                await websocket.send_json({"type": "error", "detail": "Invalid message"})
+                continue
+            if message.get("type") != "edit":
+                continue
+            try:
+                edits = [(int(row), int(col), None if value is None else str(value)) for row, col, value in message["cells"]]
+                # Checked here, one bad cell would fail the whole coalesced batch of every editor
+                if any(not (0 <= row <= MAX_POSITION and 0 <= col <= MAX_POSITION) for row, col, _ in edits):
+                    raise ValueError("Cell position out of range")
+            except (KeyError, TypeError, ValueError):
+                await websocket.send_json({"type": "error", "detail": "Invalid edit"})
+                continue
+            # Checked on every edit, a user demoted while connected loses write access right away
+            if not await project_role_allowed(user_id, project_uuid, "editor") \
+                    and not await cells_writable(user_id, project_uuid, table_name, edits):
+                await websocket.send_json({"type": "error", "detail": "Keine Berechtigung, Zellen zu bearbeiten."})
+                continue
+            collab_hub.submit(project_id, table_name, edits)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        collab_hub.leave(project_id, table_name, websocket)
@@ -0,0 +1,73 @@
+from uuid import UUID
+
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException
+from asyncpg import Connection
+from pydantic import BaseModel
+
+from backend.routes.api_routes.tables import require_login
+from backend.user_management.pool_handler import get_user_pool
+from backend.user_management.team_handler import get_team_role
+from backend.user_management.user_handler import add_users_to_team, remove_users_from_team
+
+
+router = APIRouter(prefix="/teams", tags=["teams"])
+
+
+class TeamMemberRole(BaseModel):
+    user_id: UUID
+    role: str = "member"
+
+
+class TeamMemberBatch(BaseModel):
+    members: list[TeamMemberRole]
+
+
+class TeamUserBatch(BaseModel):
+    user_ids: list[UUID]
+
+
+async def require_team_admin(user_conn: Connection, user_id: str, team_id: UUID) -> str:
+    # Returns the role of the caller, members at or above it are out of their reach
+    role = await get_team_role(user_conn, team_id, UUID(user_id))
+    if role not in ("moderator", "admin"):
+        raise HTTPException(status_code=403, detail="Keine Berechtigung, die Mitglieder des Teams zu verwalten.")
+    return role
+
+
+# The batch endpoints are atomic, when one entry fails none of the changes are applied
+
+@router.post("/{team_id}/members/batch")
+async def api_teams_add_members(
+    team_id: UUID,
+    batch: TeamMemberBatch,
+    user_id = Depends(require_login),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    caller_role = await require_team_admin(user_conn, user_id, team_id)
+    try:
+        await add_users_to_team(user_conn, team_id, [member.user_id for member in batch.members], [member.role for member in batch.members], caller_role)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Rollen über der eigenen Rolle können nicht vergeben werden.")
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(status_code=409, detail="Mindestens ein Benutzer ist bereits im Team.")
+    except (ValueError, asyncpg.DataError, asyncpg.ForeignKeyViolationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"added": len(batch.members)}
+
+
+@router.post("/{team_id}/members/batch_remove")
+async def api_teams_remove_members(
+    team_id: UUID,
+    batch: TeamUserBatch,
+    user_id = Depends(require_login),
+    user_conn: Connection = Depends(get_user_pool)
+):
+    caller_role = await require_team_admin(user_conn, user_id, team_id)
+    try:
+        await remove_users_from_team(user_conn, team_id, batch.user_ids, caller_role)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Mitglieder mit gleicher oder höherer Rolle können nicht entfernt werden.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"removed": len(batch.user_ids)}
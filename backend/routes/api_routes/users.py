@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Form, Depends
+from fastapi import APIRouter, Form, Depends, HTTPException
 from dataclasses import dataclass
 
+from backend.user_management.password_hashing import PasswordHashingBusy
 from backend.user_management.pool_handler import get_user_pool
 from backend.user_management.user_handler import *
 
@@ -25,6 +26,9 @@ async def api_users_create_user_post(
     conn: Connection = Depends(get_user_pool)
 ):
     user = User(userName, firstName, lastName, email, password)
-    usr_id = await create_user(conn, userName=userName, firstName=firstName, lastName=lastName, email=email, password=password)
+    try:
+        usr_id = await create_user(conn, userName=userName, firstName=firstName, lastName=lastName, email=email, password=password)
+    except PasswordHashingBusy:
+        raise HTTPException(status_code=503, detail="Der Server ist ausgelastet. Bitte versuchen Sie es später erneut.")
     print(usr_id)
     return {"created_user": user.__dict__}
\ No newline at end of file
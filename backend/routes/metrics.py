@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from backend.data_management.cell_cache import cell_cache
+from backend.data_management.permission_index import permission_index_stats
+from backend.data_management.pool_manager import pool_manager
+from backend.data_management.replica_router import replica_router
+from backend.user_management.login_guard import login_guard
+from backend.user_management.password_hashing import password_hasher
+from backend.user_management.profile_cache import profile_cache
+
+logger = logging.getLogger("api_logger")
+
+# With several uvicorn workers every worker writes its metrics to a file in METRICS_MULTIPROC_DIR and /metrics adds
+# the files up. Like with prometheus_client the directory has to be emptied before the server starts.
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR") or os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "5"))
+# Gauges of workers that did not write for this long are left out, their counters keep counting towards the totals
+METRICS_STALE_AFTER = 3 * METRICS_WRITE_INTERVAL
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Requests no route matched share one label, so scanners can not create a series per path
+UNMATCHED_ROUTE = "unmatched"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# (kind, name, labels, value) as produced by the collectors
+Sample = tuple[str, str, dict[str, str], float]
+
+METRIC_HELP = {
+    "http_requests_total": (COUNTER, "HTTP requests by method, route template and status class"),
+    "http_request_duration_seconds": (HISTOGRAM, "HTTP request latency by method and route template"),
+    "db_pool_size": (GAUGE, "Open connections of the database pool"),
+    "db_pool_in_use": (GAUGE, "Connections of the database pool in use"),
+    "db_pool_max_size": (GAUGE, "Maximum connections of the database pool"),
+    "db_pool_wait_recent_seconds": (GAUGE, "Smoothed recent wait for a connection of the database pool"),
+    "db_pool_acquires_total": (COUNTER, "Connections acquired from the database pool"),
+    "db_pool_wait_seconds_total": (COUNTER, "Time spent waiting for connections of the database pool"),
+    "db_pool_connections_opened_total": (COUNTER, "Connections opened by the database pool"),
+    "db_pool_connections_closed_total": (COUNTER, "Connections of the database pool that were closed"),
+    "cache_entries": (GAUGE, "Entries held by the in-process cache"),
+    "cache_hits_total": (COUNTER, "Lookups answered by the in-process cache"),
+    "cache_misses_total": (COUNTER, "Lookups the in-process cache could not answer"),
+    "cache_hit_ratio": (GAUGE, "Share of the lookups answered by the in-process cache"),
+    "replica_healthy": (GAUGE, "Whether the read replica of the pool answered its last lag check"),
+    "replica_lag_seconds": (GAUGE, "Replication lag of the read replica of the pool"),
+    "replica_reads_total": (COUNTER, "Read-only requests served by the read replica of the pool"),
+    "replica_fallbacks_total": (COUNTER, "Read-only requests sent to the primary instead of the replica"),
+    "login_in_flight": (GAUGE, "Login attempts currently being checked"),
+    "login_shed_total": (COUNTER, "Login attempts rejected because of overload"),
+    "login_rate_limited_total": (COUNTER, "Login attempts rejected by the rate limiter"),
+    "password_hash_running": (GAUGE, "Password hashes being computed"),
+    "password_hash_queued": (GAUGE, "Password hashes waiting for a hashing worker"),
+    "password_hash_rejected_total": (COUNTER, "Password hashes rejected because the workers were busy"),
+}
+
+
+class MetricsRegistry:
+    # Request counters and latency histograms recorded by the logging middleware, everything else is collected
+    # from the existing stats when the metrics are scraped
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.requests: dict[tuple[str, str, str], int] = {}
+        # Count per bucket with a last +Inf bucket, followed by the sum of the observed latencies
+        self.latencies: dict[tuple[str, str], list[float]] = {}
+        self.collectors: list[Callable[[], Iterable[Sample]]] = []
+
+    def observe_request(self, method: str, route: str, status_code: int, seconds: float):
+        key = (method, route, f"{status_code // 100}xx")
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.latencies.get((method, route))
+        if histogram is None:
+            histogram = self.latencies[(method, route)] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def register_collector(self, collector: Callable[[], Iterable[Sample]]):
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        counters = [["http_requests_total", {"method": method, "route": route, "status": status}, count]
+                    for (method, route, status), count in self.requests.items()]
+        gauges = []
+        for collector in self.collectors:
+            try:
+                for kind, name, labels, value in collector():
+                    (counters if kind == COUNTER else gauges).append([name, labels, value])
+            except Exception:
+                logger.warning(f"Collecting metrics from {collector.__name__} failed", exc_info=True)
+        histograms = [["http_request_duration_seconds", {"method": method, "route": route}, histogram[:-1], histogram[-1]]
+                      for (method, route), histogram in self.latencies.items()]
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "exited": False,
+            "buckets": list(self.buckets),
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+
+metrics_registry = MetricsRegistry()
+
+
+def _route_templates(routes: list, prefix: str = "") -> dict[int, str]:
+    # Full path template of every route, keyed by the id of the route object the router puts into the scope.
+    # FastAPI before 0.126 copies the routes of included routers with the full path, later versions include the
+    # routers lazily and keep the prefix of the including routers in their include context.
+    templates = {}
+    for route in routes:
+        included = getattr(route, "original_router", None)
+        if included is not None:
+            templates.update(_route_templates(included.routes, route.include_context.prefix))
+        elif isinstance(getattr(route, "path", None), str):
+            templates.setdefault(id(route), prefix + route.path)
+    return templates
+
+
+_templates_by_app: dict[int, dict[int, str]] = {}
+
+
+def route_label(scope: dict) -> str:
+    # The route template, e.g. /api/projects/{project_id}/members/batch, keeps the number of series bounded
+    route = scope.get("route")
+    if route is None:
+        return UNMATCHED_ROUTE
+    app = scope.get("app")
+    templates = _templates_by_app.get(id(app))
+    if templates is None:
+        templates = _templates_by_app[id(app)] = _route_templates(getattr(app, "routes", []))
+    return templates.get(id(route)) or getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    # Counters and histograms are added up, gauges stay per worker with a pid label once there are several
+    counters: dict[tuple, list] = {}
+    histograms: dict[tuple, list] = {}
+    gauges = []
+    now = time.time()
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(sorted(labels.items())))
+            counters.setdefault(key, [name, labels, 0])[2] += value
+        for name, labels, counts, total in snapshot["histograms"]:
+            key = (name, tuple(sorted(labels.items())))
+            merged = histograms.setdefault(key, [name, labels, [0] * len(counts), 0.0])
+            merged[2] = [a + b for a, b in zip(merged[2], counts)]
+            merged[3] += total
+        if snapshot["exited"] or now - snapshot["time"] > METRICS_STALE_AFTER:
+            continue
+        for name, labels, value in snapshot["gauges"]:
+            gauges.append([name, {**labels, "pid": str(snapshot["pid"])} if len(snapshots) > 1 else labels, value])
+    return {
+        "buckets": snapshots[0]["buckets"] if snapshots else list(LATENCY_BUCKETS),
+        "counters": list(counters.values()),
+        "gauges": gauges,
+        "histograms": list(histograms.values()),
+    }
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def render(snapshot: dict) -> str:
+    # Prometheus text exposition format 0.0.4
+    series: dict[str, list[str]] = {}
+
+    def add(name: str, labels: dict[str, str], value: float, metric: str | None = None):
+        series.setdefault(metric or name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    for name, labels, value in snapshot["counters"] + snapshot["gauges"]:
+        add(name, labels, value)
+
+    # Hit ratios over the added up counters, the share of one worker alone says little
+    lookups: dict[str, list[float]] = {}
+    for name, labels, value in snapshot["counters"]:
+        if name in ("cache_hits_total", "cache_misses_total"):
+            lookups.setdefault(labels["cache"], [0, 0])[name == "cache_misses_total"] += value
+    for cache, (hits, misses) in lookups.items():
+        add("cache_hit_ratio", {"cache": cache}, hits / (hits + misses) if hits + misses else 0.0)
+
+    bounds = [_format_value(bound) for bound in snapshot["buckets"]] + ["+Inf"]
+    for name, labels, counts, total in snapshot["histograms"]:
+        cumulative = 0
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            add(f"{name}_bucket", {**labels, "le": bound}, cumulative, name)
+        add(f"{name}_sum", labels, total, name)
+        add(f"{name}_count", labels, cumulative, name)
+
+    lines = []
+    for name, samples in series.items():
+        kind, description = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(directory: str, snapshot: dict):
+    # Written to a temporary file first, so a scrape never reads half a file
+    path = os.path.join(directory, f"{snapshot['pid']}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(snapshot, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_snapshots(directory: str) -> list[dict]:
+    snapshots = []
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            logger.warning(f"Skipping unreadable metrics file {file_name}", exc_info=True)
+    return snapshots
+
+
+def _collect_and_render(snapshot: dict) -> str:
+    if METRICS_MULTIPROC_DIR is None:
+        return render(merge_snapshots([snapshot]))
+    write_snapshot(METRICS_MULTIPROC_DIR, snapshot)
+    return render(merge_snapshots(read_snapshots(METRICS_MULTIPROC_DIR)))
+
+
+# -- Collectors --
+
+def pool_samples() -> Iterable[Sample]:
+    for name, stats in pool_manager.stats().items():
+        labels = {"pool": name}
+        yield GAUGE, "db_pool_size", labels, stats["size"]
+        yield GAUGE, "db_pool_in_use", labels, stats["in_use"]
+        yield GAUGE, "db_pool_max_size", labels, stats["max_size"]
+        yield GAUGE, "db_pool_wait_recent_seconds", labels, stats["wait_recent"]
+        yield COUNTER, "db_pool_acquires_total", labels, stats["acquires"]
+        yield COUNTER, "db_pool_wait_seconds_total", labels, pool_manager.stats_by_pool[name].wait_total
+        yield COUNTER, "db_pool_connections_opened_total", labels, stats["connections_opened"]
+        yield COUNTER, "db_pool_connections_closed_total", labels, stats["connections_closed"]
+
+
+def cache_samples() -> Iterable[Sample]:
+    for cache, stats, entries in (
+        ("cells", cell_cache.stats(), "tiles"),
+        ("profiles", profile_cache.stats(), "profiles"),
+        ("permission_indexes", permission_index_stats(), "indexes"),
+    ):
+        labels = {"cache": cache}
+        yield GAUGE, "cache_entries", labels, stats[entries]
+        yield COUNTER, "cache_hits_total", labels, stats["hits"]
+        yield COUNTER, "cache_misses_total", labels, stats["misses"]
+
+
+def replica_samples() -> Iterable[Sample]:
+    for name, stats in replica_router.stats().items():
+        labels = {"pool": name}
+        yield GAUGE, "replica_healthy", labels, int(stats["healthy"])
+        yield GAUGE, "replica_lag_seconds", labels, stats["lag"]
+        yield COUNTER, "replica_reads_total", labels, stats["reads"]
+        yield COUNTER, "replica_fallbacks_total", labels, stats["fallbacks"]
+
+
+def login_samples() -> Iterable[Sample]:
+    yield GAUGE, "login_in_flight", {}, login_guard.in_flight
+    yield COUNTER, "login_shed_total", {}, login_guard.shed
+    yield COUNTER, "login_rate_limited_total", {"by": "ip"}, login_guard.by_ip.limited
+    yield COUNTER, "login_rate_limited_total", {"by": "user"}, login_guard.by_user.limited
+    yield GAUGE, "password_hash_running", {}, password_hasher.running
+    yield GAUGE, "password_hash_queued", {}, password_hasher.queued
+    yield COUNTER, "password_hash_rejected_total", {}, password_hasher.rejected
+
+
+for _collector in (pool_samples, cache_samples, replica_samples, login_samples):
+    metrics_registry.register_collector(_collector)
+
+
+# -- Multiprocess writer --
+
+_writer: asyncio.Task | None = None
+
+
+async def _write_periodically():
+    while True:
+        await asyncio.sleep(METRICS_WRITE_INTERVAL)
+        try:
+            await asyncio.to_thread(write_snapshot, METRICS_MULTIPROC_DIR, metrics_registry.snapshot())
+        except OSError:
+            logger.warning("Writing the metrics of this worker failed", exc_info=True)
+
+
+async def start_metrics_writer():
+    # Keeps the file of this worker current, so scrapes answered by another worker see its counters
+    global _writer
+    if METRICS_MULTIPROC_DIR is None or _writer is not None:
+        return
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    _writer = asyncio.get_running_loop().create_task(_write_periodically())
+    print(f"Writing metrics to {METRICS_MULTIPROC_DIR}.")
+
+
+async def stop_metrics_writer():
+    # The last snapshot keeps the counters of the worker in the totals, its gauges are dropped
+    global _writer
+    writer, _writer = _writer, None
+    if writer is None:
+        return
+    writer.cancel()
+    try:
+        await writer
+    except asyncio.CancelledError:
+        pass
+    snapshot = metrics_registry.snapshot()
+    snapshot["exited"] = True
+    write_snapshot(METRICS_MULTIPROC_DIR, snapshot)
+
+
+metrics_router = APIRouter(tags=["metrics"])
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics_get():
+    # The snapshot is taken on the event loop, the files of the other workers are read off it
+    snapshot = metrics_registry.snapshot()
+    return PlainTextResponse(await asyncio.to_thread(_collect_and_render, snapshot), media_type=CONTENT_TYPE)
@@ -7,7 +7,7 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import FileResponse
 from dataclasses import dataclass
 import time
-from backend.user_management.pool_handler import user_pool, get_user_pool
+from backend.user_management.pool_handler import get_user_read_pool
 from backend.user_management.user_handler import *
 from starlette.middleware.sessions import SessionMiddleware
 templates = Jinja2Templates(directory="templates")
@@ -16,9 +16,13 @@ templates = Jinja2Templates(directory="templates")
 router = APIRouter(tags=["dashboard"])
 
 @router.get("/dashboard", response_class=HTMLResponse)
-async def user_dashboard_get(request: Request, conn: Connection = Depends(get_user_pool)):
+async def user_dashboard_get(request: Request, conn: Connection = Depends(get_user_read_pool)):
     if "logged_in" in request.session and request.session["logged_in"] == True and "user" in request.session:
-        user = await get_user_by_id(conn, request.session["user"])
+        user = await get_user_profile(conn, request.session["user"])
+        if user is None:
+            # The account was deleted since the login
+            request.session.clear()
+            return '<script>window.location.replace("/login");</script>'
         firstName = user["firstname"]
     else:
         return '<script>window.location.replace("/login");</script>'  
@@ -7,7 +7,9 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import FileResponse
 from dataclasses import dataclass
 import time
-from backend.user_management.pool_handler import user_pool, get_user_pool
+from backend.user_management.login_guard import LoginOverloaded, LoginRateLimited, login_guard
+from backend.user_management.password_hashing import PasswordHashingBusy
+from backend.user_management.pool_handler import get_user_pool
 from backend.user_management.user_handler import *
 from starlette.middleware.sessions import SessionMiddleware
 templates = Jinja2Templates(directory="templates")
@@ -27,10 +29,27 @@ async def user_login_get_route(request: Request):
         {"request": request, "cache_buster": int(time.time())} 
     )
     
+async def guard_login(request: Request, username: str = Form(...)):
+    # Runs before a connection is taken from the pool, so rejected attempts cost neither a connection nor bcrypt
+    try:
+        login_guard.enter(request.client.host if request.client else "unknown", username)
+    except LoginRateLimited as e:
+        raise HTTPException(status_code=429, detail="Zu viele Anmeldeversuche.", headers={"Retry-After": str(max(1, round(e.retry_after)))})
+    except LoginOverloaded:
+        raise HTTPException(status_code=503, detail="Der Server ist ausgelastet. Bitte versuchen Sie es später erneut.", headers={"Retry-After": "1"})
+    try:
+        yield
+    finally:
+        login_guard.leave()
+
+
 @router.post("/login", response_class=HTMLResponse)
-async def user_login_post_route(request: Request, username: str = Form(...), password: str = Form(...), conn: Connection = Depends(get_user_pool)):
+async def user_login_post_route(request: Request, username: str = Form(...), password: str = Form(...), _ = Depends(guard_login), conn: Connection = Depends(get_user_pool)):
     message = "Not Valid"
-    user_valid = await valid_password(user_connection=conn, userKey=username, password=password)
+    try:
+        user_valid = await valid_password(user_connection=conn, userKey=username, password=password)
+    except PasswordHashingBusy:
+        raise HTTPException(status_code=503, detail="Der Server ist ausgelastet. Bitte versuchen Sie es später erneut.")
     message = f"{user_valid} | username: {username} | password: {password}"
 
 
@@ -39,7 +58,7 @@ async def user_login_post_route(request: Request, username: str = Form(...), pas
         user = await get_user_by_username(conn, username)
         message = f"User Valid | User Id: {user}"
         request.session["logged_in"] = True
-        request.session["user"] = user["user_id"]
+        request.session["user"] = str(user["user_id"])
 
     return '<script>window.location.replace("/dashboard");</script>'
 
@@ -0,0 +1,69 @@
+from uuid import UUID
+
+from asyncpg import Connection
+
+PROJECT_ROLES = ("viewer", "editor", "moderator", "admin", "owner")
+
+EFFECTIVE_ROLE_SQL = 'SELECT role FROM effective_roles WHERE user_id = $1 AND project_id = $2'
+
+# effective_roles holds the highest role every user has in a project, either as a direct member or through one of
+# their teams. It is refreshed by every handler that changes memberships, so authorization is a primary key lookup.
+
+
+async def refresh_effective_roles(user_connection: Connection, user_ids: list[UUID] | None = None, project_ids: list[UUID] | None = None):
+    # Recomputes the roles of the given users in the given projects, None matches everything
+    await user_connection.execute('''
+        WITH computed AS (
+            SELECT user_id, project_id, max(role) AS role FROM (
+                SELECT user_id, project_id, role FROM project_members
+                UNION ALL
+                SELECT team_members.user_id, project_teams.project_id, project_teams.role
+                FROM project_teams JOIN team_members USING (team_id)
+            ) AS sources
+            WHERE ($1::uuid[] IS NULL OR user_id = ANY($1)) AND ($2::uuid[] IS NULL OR project_id = ANY($2))
+            GROUP BY user_id, project_id
+        ), removed AS (
+            DELETE FROM effective_roles
+            WHERE ($1::uuid[] IS NULL OR user_id = ANY($1)) AND ($2::uuid[] IS NULL OR project_id = ANY($2))
+            AND NOT EXISTS (
+                SELECT 1 FROM computed WHERE computed.user_id = effective_roles.user_id AND computed.project_id = effective_roles.project_id
+            )
+        )
+        INSERT INTO effective_roles (user_id, project_id, role) SELECT user_id, project_id, role FROM computed
+        ON CONFLICT (user_id, project_id) DO UPDATE SET role = EXCLUDED.role WHERE effective_roles.role <> EXCLUDED.role
+    ''', user_ids, project_ids)
+
+
+async def refresh_team_roles(user_connection: Connection, team_id: UUID, user_ids: list[UUID] | None = None):
+    # Recomputes the roles a team grants in its projects, for all of its members unless users are given
+    project_ids = [record['project_id'] for record in await user_connection.fetch(
+        'SELECT project_id FROM project_teams WHERE team_id = $1', team_id
+    )]
+    if not project_ids:
+        return
+    if user_ids is None:
+        user_ids = [record['user_id'] for record in await user_connection.fetch(
+            'SELECT user_id FROM team_members WHERE team_id = $1', team_id
+        )]
+    if user_ids:
+        await refresh_effective_roles(user_connection, user_ids, project_ids)
+
+
+async def get_effective_role(user_connection: Connection, user_id: UUID, project_id: UUID) -> str | None:
+    return await user_connection.fetchval(EFFECTIVE_ROLE_SQL, user_id, project_id)
+
+
+async def projects_with_role(user_connection: Connection, user_id: UUID, minimum_role: str) -> list[UUID]:
+    if minimum_role not in PROJECT_ROLES:
+        raise ValueError(f"Invalid project role {minimum_role}")
+    results = await user_connection.fetch(
+        'SELECT project_id FROM effective_roles WHERE user_id = $1 AND role >= $2::project_role', user_id, minimum_role
+    )
+    return [record['project_id'] for record in results]
+
+
+async def has_project_role(user_connection: Connection, user_id: UUID, project_id: UUID, minimum_role: str) -> bool:
+    if minimum_role not in PROJECT_ROLES:
+        raise ValueError(f"Invalid project role {minimum_role}")
+    role = await get_effective_role(user_connection, user_id, project_id)
+    return role is not None and PROJECT_ROLES.index(role) >= PROJECT_ROLES.index(minimum_role)
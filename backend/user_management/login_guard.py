@@ -0,0 +1,108 @@
+import os
+import time
+from collections import OrderedDict
+
+from backend.data_management.pool_manager import USER_POOL, pool_manager
+from backend.user_management.password_hashing import password_hasher
+
+# Every login attempt costs a bcrypt run, so attempts are limited per client ip and per username,
+# and shed early while the hashing workers or the user pool are already backed up
+LOGIN_IP_RATE = float(os.getenv("LOGIN_IP_RATE", "0.5"))
+LOGIN_IP_BURST = float(os.getenv("LOGIN_IP_BURST", "10"))
+LOGIN_USER_RATE = float(os.getenv("LOGIN_USER_RATE", "0.1"))
+LOGIN_USER_BURST = float(os.getenv("LOGIN_USER_BURST", "5"))
+LOGIN_MAX_IN_FLIGHT = int(os.getenv("LOGIN_MAX_IN_FLIGHT", "64"))
+LOGIN_MAX_HASH_QUEUE = int(os.getenv("LOGIN_MAX_HASH_QUEUE", str(4 * password_hasher.workers)))
+LOGIN_MAX_POOL_WAIT = float(os.getenv("LOGIN_MAX_POOL_WAIT", "0.5"))
+MAX_TRACKED_KEYS = 100000
+
+
+class TokenBucketLimiter:
+    # One bucket of burst tokens per key, refilled with rate tokens per second. Full buckets carry no information,
+    # so the least recently used keys are dropped once more than max_keys are tracked.
+
+    def __init__(self, rate: float, burst: float, max_keys: int = MAX_TRACKED_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+
+    def _tokens(self, key: str, now: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def retry_after(self, key: str) -> float:
+        # Seconds until the next attempt of the key is allowed
+        tokens = self._tokens(key, time.monotonic())
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def acquire(self, key: str) -> bool:
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        if tokens < 1:
+            self.limited += 1
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        self.allowed += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"tracked": len(self.buckets), "allowed": self.allowed, "limited": self.limited}
+
+
+class LoginRateLimited(Exception):
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many login attempts, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class LoginOverloaded(Exception):
+    pass
+
+
+class LoginGuard:
+
+    def __init__(self):
+        self.by_ip = TokenBucketLimiter(LOGIN_IP_RATE, LOGIN_IP_BURST)
+        self.by_user = TokenBucketLimiter(LOGIN_USER_RATE, LOGIN_USER_BURST)
+        self.in_flight = 0
+        self.shed = 0
+
+    def enter(self, client_ip: str, username: str):
+        # Raises instead of admitting the attempt, leave must be called for every admitted attempt
+        if (self.in_flight >= LOGIN_MAX_IN_FLIGHT
+                or password_hasher.queued >= LOGIN_MAX_HASH_QUEUE
+                or pool_manager.recent_wait(USER_POOL) >= LOGIN_MAX_POOL_WAIT):
+            self.shed += 1
+            raise LoginOverloaded("Login is overloaded")
+        if not self.by_ip.acquire(client_ip):
+            raise LoginRateLimited(self.by_ip.retry_after(client_ip))
+        username = username.strip().lower()
+        if not self.by_user.acquire(username):
+            raise LoginRateLimited(self.by_user.retry_after(username))
+        self.in_flight += 1
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "shed": self.shed,
+            "pool_wait": pool_manager.recent_wait(USER_POOL),
+            "by_ip": self.by_ip.stats(),
+            "by_user": self.by_user.stats(),
+            "password_hashing": password_hasher.stats(),
+        }
+
+
+login_guard = LoginGuard()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+# bcrypt releases the GIL while hashing, so a few threads keep the event loop free during a burst of logins.
+# Calls beyond the worker count wait for a free worker and give up after the queue timeout.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+
+T = TypeVar("T")
+
+
+class PasswordHashingBusy(Exception):
+    # Raised when no hashing worker became free within the queue timeout
+    pass
+
+
+class PasswordHasher:
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_timeout: float = PASSWORD_HASH_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.executor: ThreadPoolExecutor | None = None
+        # One semaphore per event loop, tests and benchmarks run several loops in one process
+        self._slots: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+
+    def _slot(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        slot = self._slots.get(loop)
+        if slot is None:
+            slot = self._slots[loop] = asyncio.Semaphore(self.workers)
+        return slot
+
+    async def run(self, function: Callable[..., T], *args) -> T:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        slot = self._slot()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(slot.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PasswordHashingBusy(f"No password hashing worker free within {self.queue_timeout}s")
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.running -= 1
+            slot.release()
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "running": self.running, "queued": self.queued, "rejected": self.rejected}
+
+    def shutdown(self):
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher()
+
+
+def hash_rounds(hashed_password: str) -> int:
+    # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+    return int(hashed_password.split("$")[2])
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    return hash_rounds(hashed_password) != BCRYPT_ROUNDS
@@ -1,41 +1,29 @@
-import asyncpg
-from dotenv import load_dotenv
-import os
+from starlette.requests import Request
 
-# noinspection PyTypeChecker
-user_pool : asyncpg.Pool = None
+from backend.data_management.permission_index import start_permission_feed, stop_permission_feed
+from backend.data_management.pool_manager import USER_POOL, pool_manager
+from backend.data_management.replica_router import LAST_WRITE_KEY, replica_router
+from backend.user_management.effective_roles import EFFECTIVE_ROLE_SQL
+from backend.user_management.profile_cache import PROFILE_SQL, start_profile_feed, stop_profile_feed
 
-async def init_user_pool():
+pool_manager.register_warmup(USER_POOL, EFFECTIVE_ROLE_SQL)
+pool_manager.register_warmup(USER_POOL, PROFILE_SQL)
 
-    print("Initializing user database pool...")
+async def start_user_services():
+    # Background services on the user database, its pool is opened by the pool manager first
+    user_pool = pool_manager.get(USER_POOL)
+    await start_permission_feed(user_pool)
+    await start_profile_feed(user_pool)
 
-    load_dotenv('.env.deployment')
-    host = os.getenv('POSTGRES_HOST')
-    port = os.getenv('POSTGRES_PORT')
-    database = os.getenv('USER_DB_NAME')
-    user = os.getenv('POSTGRES_USER')
-    password = os.getenv('POSTGRES_PASSWORD')
-
-    global user_pool
-    # noinspection PyUnresolvedReferences
-    user_pool = await asyncpg.create_pool(
-        host=host,
-        port=port,
-        database=database,
-        user=user,
-        password=password,
-    )
-
-    print("User database pool initialized.")
-
-async def close_user_pool():
-    global user_pool
-    if user_pool is not None:
-        await user_pool.close()
-        user_pool = None
-
-        print("User database pool closed.")
+async def stop_user_services():
+    await stop_profile_feed()
+    await stop_permission_feed()
 
 async def get_user_pool():
-    async with user_pool.acquire() as conn:
-        yield conn
\ No newline at end of file
+    async with pool_manager.acquire(USER_POOL) as conn:
+        yield conn
+
+async def get_user_read_pool(request: Request):
+    # For handlers that only read, served by the user replica when one is configured and recent enough
+    async with replica_router.read(USER_POOL, request.session.get(LAST_WRITE_KEY)) as conn:
+        yield conn
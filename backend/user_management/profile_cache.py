@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from uuid import UUID
+
+import asyncpg
+from asyncpg import Connection
+
+from backend.data_management.change_feed import NotificationListener, PROCESS_ID
+from backend.data_management.pool_manager import reading_replica
+
+logger = logging.getLogger("api_logger")
+
+PROFILE_CHANNEL = "flowtables_profiles"
+
+# Only columns that are safe to keep in memory, the password hash is never cached
+PROFILE_COLUMNS = ("user_id", "username", "email", "lastname", "firstname")
+PROFILE_SQL = f'SELECT {", ".join(PROFILE_COLUMNS)} FROM users WHERE user_id = $1'
+
+
+class ProfileCache:
+    # LRU of user profiles keyed by user id, entries expire after ttl seconds even without an invalidation
+
+    def __init__(self, max_profiles: int, ttl: float):
+        self.max_profiles = max_profiles
+        self.ttl = ttl
+        self.profiles: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_profiles > 0 and self.ttl > 0
+
+    def get(self, user_id: str) -> dict | None:
+        entry = self.profiles.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, profile = entry
+        if expires <= time.monotonic():
+            del self.profiles[user_id]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.profiles.move_to_end(user_id)
+        self.hits += 1
+        return profile
+
+    def put(self, user_id: str, profile: dict, generation: int):
+        # Profiles read before an invalidation may be outdated and are not stored
+        if not self.enabled or generation != self.generation:
+            return
+        self.profiles[user_id] = (time.monotonic() + self.ttl, profile)
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: str | None = None):
+        # None drops every profile
+        self.generation += 1
+        if user_id is None:
+            self.invalidations += len(self.profiles)
+            self.profiles.clear()
+        elif self.profiles.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "profiles": len(self.profiles),
+            "max_profiles": self.max_profiles,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+profile_cache = ProfileCache(int(os.getenv("PROFILE_CACHE_SIZE", "10000")), float(os.getenv("PROFILE_CACHE_TTL", "60")))
+
+
+async def get_cached_profile(user_connection: Connection, user_id: UUID | str) -> dict | None:
+    key = str(user_id)
+    profile = profile_cache.get(key)
+    if profile is not None:
+        return profile
+
+    generation = profile_cache.generation
+    record = await user_connection.fetchrow(PROFILE_SQL, UUID(key))
+    if record is None:
+        return None
+    profile = dict(record)
+    # Inside a transaction the profile may still be rolled back, a replica may not have the latest change yet
+    if not user_connection.is_in_transaction() and not reading_replica.get():
+        profile_cache.put(key, profile, generation)
+    return profile
+
+
+async def profile_changed(user_connection: Connection, user_id: UUID):
+    # Drops the profile here right away and in the other workers once the change is committed
+    profile_cache.invalidate(str(user_id))
+    await user_connection.execute("SELECT pg_notify($1, $2)", PROFILE_CHANNEL, json.dumps({
+        "origin": PROCESS_ID,
+        "user": str(user_id),
+    }))
+
+
+def _on_notification(payload: str):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning("Ignoring malformed profile notification", exc_info=True)
+        return
+    profile_cache.invalidate(message["user"])
+
+
+_listener = NotificationListener(PROFILE_CHANNEL, _on_notification, profile_cache.invalidate)
+
+
+async def start_profile_feed(pool: asyncpg.Pool):
+    await _listener.start(pool)
+    print("Profile feed listening.")
+
+
+async def stop_profile_feed():
+    if await _listener.stop():
+        print("Profile feed stopped.")
@@ -4,6 +4,8 @@ from uuid import UUID
 import asyncpg
 from asyncpg import Connection
 
+from backend.user_management.effective_roles import refresh_effective_roles
+
 async def create_team(user_connection:Connection, team_name: str) -> UUID:
 
     team_id = uuid.uuid4()
@@ -31,7 +33,18 @@ async def get_team_by_name(user_connection:Connection, team_name: str):
 
 async def delete_team(user_connection:Connection, team_id: int):
 
+    # Memberships and project access of the team are removed by the cascade, the roles it granted are recomputed
+    user_ids = [record['user_id'] for record in await user_connection.fetch('SELECT user_id FROM team_members WHERE team_id = $1', team_id)]
+    project_ids = [record['project_id'] for record in await user_connection.fetch('SELECT project_id FROM project_teams WHERE team_id = $1', team_id)]
     await user_connection.execute(
         'DELETE FROM teams WHERE team_id = $1',
         team_id
-    )
\ No newline at end of file
+    )
+    if user_ids and project_ids:
+        await refresh_effective_roles(user_connection, user_ids, project_ids)
+
+async def get_team_role(user_connection:Connection, team_id: UUID, user_id: UUID) -> str | None:
+    return await user_connection.fetchval(
+        'SELECT role FROM team_members WHERE team_id = $1 AND user_id = $2',
+        team_id, user_id
+    )
@@ -1,16 +1,23 @@
+import logging
 import uuid
 from uuid import UUID
 
 import bcrypt
 from asyncpg import Connection
 
-# help functions
+from backend.user_management.effective_roles import refresh_team_roles
+from backend.user_management.password_hashing import BCRYPT_ROUNDS, PasswordHashingBusy, needs_rehash, password_hasher
+from backend.user_management.profile_cache import get_cached_profile, profile_changed
+
+logger = logging.getLogger("api_logger")
+
+# help functions, they block for the whole bcrypt run and are called through password_hasher in async code
 
 def verify_password(plain_password, hashed_password):
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 # async functions
 
@@ -23,7 +30,7 @@ async def create_user(user_connection:Connection,  userName: str, email: str, pa
     if existing_user:
         raise ValueError("Username or email already exists.")
 
-    hashed_pw = hash_password(password)
+    hashed_pw = await password_hasher.run(hash_password, password)
 
     user_id = uuid.uuid4()
 
@@ -43,9 +50,22 @@ async def valid_password(user_connection:Connection, userKey: str, password: str
     else:
         user = await user_connection.fetchrow('SELECT * FROM users WHERE userName = $1', userKey)
 
-    if user and verify_password(password, user['password']):
-        return True
-    return False
+    if not user or not await password_hasher.run(verify_password, password, user['password']):
+        return False
+
+    # Hashes made with a different cost are replaced while the plain password is at hand
+    if needs_rehash(user['password']):
+        try:
+            new_hash = await password_hasher.run(hash_password, password)
+        except PasswordHashingBusy:
+            # The login is valid anyway, the upgrade is retried on the next login
+            logger.warning(f"Skipped password rehash for user {user['user_id']}, hashing workers busy")
+            return True
+        await user_connection.execute(
+            'UPDATE users SET password = $3 WHERE user_id = $1 AND password = $2',
+            user['user_id'], user['password'], new_hash
+        )
+    return True
 
 async def get_user_by_id(user_connection:Connection, user_id: int):
     user = await user_connection.fetchrow(
@@ -54,6 +74,29 @@ async def get_user_by_id(user_connection:Connection, user_id: int):
     )
     return user
 
+async def get_user_profile(user_connection:Connection, user_id: UUID | str) -> dict | None:
+    # Profile without the password hash, served from the profile cache for the pages of logged in users
+    return await get_cached_profile(user_connection, user_id)
+
+async def update_user_profile(user_connection:Connection, user_id: UUID, userName: str | None = None, email: str | None = None,
+                              lastName: str | None = None, firstName: str | None = None):
+    # Fields left at None are kept
+    if userName is not None or email is not None:
+        existing_user = await user_connection.fetchrow(
+            'SELECT user_id FROM users WHERE (userName = $2 OR email = $3) AND user_id <> $1', user_id, userName, email
+        )
+        if existing_user:
+            raise ValueError("Username or email already exists.")
+
+    result = await user_connection.execute('''
+        UPDATE users SET userName = COALESCE($2, userName), email = COALESCE($3, email),
+                         lastName = COALESCE($4, lastName), firstName = COALESCE($5, firstName)
+        WHERE user_id = $1
+    ''', user_id, userName, email, lastName, firstName)
+    if result == "UPDATE 0":
+        raise ValueError(f"User {user_id} does not exist")
+    await profile_changed(user_connection, user_id)
+
 async def get_user_by_username(user_connection:Connection, username: str):
     user = await user_connection.fetchrow(
         'SELECT * FROM users WHERE username = $1',
@@ -66,16 +109,57 @@ async def delete_user(user_connection:Connection, user_id: int):
         'DELETE FROM users WHERE user_id = $1',
         user_id
     )
+    await profile_changed(user_connection, user_id)
 
 async def add_user_to_team(user_connection:Connection, user_id: int, team_id: int, role: str):
     await user_connection.execute(
         'INSERT INTO team_members (user_id, team_id, role) VALUES ($1, $2, $3)',
         user_id, team_id, role
     )
+    await refresh_team_roles(user_connection, team_id, [user_id])
 
 async def remove_user_from_team(user_connection:Connection, user_id: int, team_id: int):
     await user_connection.execute(
         'DELETE FROM team_members WHERE user_id = $1 AND team_id = $2',
         user_id, team_id
     )
-
+    await refresh_team_roles(user_connection, team_id, [user_id])
+
+async def _check_team_roles(user_connection:Connection, team_id: UUID, user_ids: list[UUID], caller_role: str | None, new_roles: list[str] | None = None):
+    # Nobody hands out a role above their own or changes members at or above it.
+    # The rows stay locked until the batch is done, so a concurrent promotion can not slip in between.
+    if new_roles is not None and await user_connection.fetchval('''
+        SELECT bool_or(role > $2::team_role) FROM unnest($1::team_role[]) AS batch (role)
+    ''', new_roles, caller_role):
+        raise PermissionError("The batch hands out a role above your own")
+    protected = await user_connection.fetch('''
+        SELECT user_id FROM team_members
+        WHERE team_id = $1 AND user_id = ANY($2::uuid[]) AND role >= $3::team_role
+        FOR UPDATE
+    ''', team_id, user_ids, caller_role)
+    if protected:
+        raise PermissionError("The batch contains members at or above your own role")
+
+async def add_users_to_team(user_connection:Connection, team_id: UUID, user_ids: list[UUID], roles: list[str], caller_role: str | None = None):
+    # The whole batch is added in one statement, or nothing is when one of the users is already in the team.
+    # caller_role limits the roles handed out, see _check_team_roles
+    if len(roles) != len(user_ids):
+        raise ValueError("Every user needs exactly one role")
+    async with user_connection.transaction():
+        await _check_team_roles(user_connection, team_id, user_ids, caller_role, roles)
+        await user_connection.execute('''
+            INSERT INTO team_members (team_id, user_id, role)
+            SELECT $1, user_id, role FROM unnest($2::uuid[], $3::team_role[]) AS batch (user_id, role)
+        ''', team_id, user_ids, roles)
+        await refresh_team_roles(user_connection, team_id, user_ids)
+
+async def remove_users_from_team(user_connection:Connection, team_id: UUID, user_ids: list[UUID], caller_role: str | None = None):
+    # caller_role protects the members at or above it, see _check_team_roles
+    async with user_connection.transaction():
+        await _check_team_roles(user_connection, team_id, user_ids, caller_role)
+        result = await user_connection.execute('''
+            DELETE FROM team_members WHERE team_id = $1 AND user_id = ANY($2::uuid[])
+        ''', team_id, user_ids)
+        if int(result.split()[-1]) != len(set(user_ids)):
+            raise ValueError("Not every user is a member of the team")
+        await refresh_team_roles(user_connection, team_id, user_ids)
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import asyncpg
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.data_management.table_handler import create_table, set_cell_value, set_cell_values
+
+
+async def bench_cell_writes(rows: int = 100, cols: int = 50):
+    if os.getenv('CI') is None:
+        load_dotenv('.env.deployment')
+
+    conn = await asyncpg.connect(
+        host=os.getenv('POSTGRES_HOST'),
+        port=os.getenv('POSTGRES_PORT'),
+        database=os.getenv('DATA_DB_NAME'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+    )
+
+    schema = f"bench_{uuid.uuid4()}"
+    await conn.execute(f'CREATE SCHEMA "{schema}"')
+    try:
+        await create_table(conn, "per_cell", schema)
+        await create_table(conn, "batch", schema)
+        cells = [(row, col, f"{row}:{col}") for row in range(rows) for col in range(cols)]
+
+        start = time.perf_counter()
+        for row, col, value in cells:
+            await set_cell_value(conn, schema, "per_cell", row, col, value)
+        per_cell = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await set_cell_values(conn, schema, "batch", cells)
+        batch = time.perf_counter() - start
+
+        print(f"{len(cells)} cells")
+        print(f"set_cell_value loop: {per_cell:.3f}s ({len(cells) / per_cell:,.0f} cells/s)")
+        print(f"set_cell_values:     {batch:.3f}s ({len(cells) / batch:,.0f} cells/s)")
+        print(f"speedup:             {per_cell / batch:.1f}x")
+    finally:
+        await conn.execute(f'DROP SCHEMA "{schema}" CASCADE')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(bench_cell_writes())
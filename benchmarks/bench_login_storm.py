@@ -0,0 +1,90 @@
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import asyncpg
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.user_management import user_handler
+from backend.user_management.password_hashing import BCRYPT_ROUNDS, PasswordHashingBusy, password_hasher
+from backend.user_management.user_handler import create_user, delete_user, get_user_by_id, valid_password
+
+
+class InlineHasher:
+    # How the handlers hashed before, bcrypt runs directly on the event loop
+    async def run(self, function, *args):
+        return function(*args)
+
+
+async def login_storm(pool: asyncpg.Pool, username: str, logins: int, concurrency: int, probe_user_id: uuid.UUID) -> tuple[list[float], int]:
+    # Runs the logins while an unrelated lookup is requested every 10ms,
+    # returns the latencies of the lookups and how many logins were turned away
+    latencies = []
+    rejected = 0
+    done = asyncio.Event()
+
+    async def login_worker(count: int):
+        nonlocal rejected
+        for _ in range(count):
+            async with pool.acquire() as conn:
+                try:
+                    await valid_password(conn, username, "benchpassword")
+                except PasswordHashingBusy:
+                    rejected += 1
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            async with pool.acquire() as conn:
+                await get_user_by_id(conn, probe_user_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+            await asyncio.sleep(0.01)
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.gather(*(login_worker(logins // concurrency) for _ in range(concurrency)))
+    done.set()
+    await probe_task
+    return sorted(latencies), rejected
+
+
+async def bench_login_storm(logins: int = 64, concurrency: int = 16):
+    if os.getenv('CI') is None:
+        load_dotenv('.env.deployment')
+
+    pool = await asyncpg.create_pool(
+        host=os.getenv('POSTGRES_HOST'),
+        port=os.getenv('POSTGRES_PORT'),
+        database=os.getenv('USER_DB_NAME'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+        max_size=concurrency + 2,
+    )
+    name = f"bench_{uuid.uuid4().hex[:8]}"
+    async with pool.acquire() as conn:
+        user_id = await create_user(conn, name, f"{name}@bench.local", "benchpassword", "Bench", "Login")
+    print(f"{logins} logins from {concurrency} clients, bcrypt cost {BCRYPT_ROUNDS}, {password_hasher.workers} hashing workers")
+    try:
+        for mode, hasher in (("inline", InlineHasher()), ("worker pool", password_hasher)):
+            user_handler.password_hasher = hasher
+            start = time.perf_counter()
+            latencies, rejected = await login_storm(pool, name, logins, concurrency, user_id)
+            total = time.perf_counter() - start
+            print(f"{mode}:")
+            print(f"  logins:         {total:.2f}s, {(logins - rejected) / total:.1f}/s, {rejected} rejected as busy")
+            print(f"  other requests: p50 {statistics.median(latencies):.1f}ms, "
+                  f"p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)]:.1f}ms, max {latencies[-1]:.1f}ms")
+    finally:
+        user_handler.password_hasher = password_hasher
+        async with pool.acquire() as conn:
+            await delete_user(conn, user_id)
+        await pool.close()
+        password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(bench_login_storm())
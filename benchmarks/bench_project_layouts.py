@@ -0,0 +1,90 @@
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+import asyncpg
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.data_management.cell_cache import cell_cache
+from backend.data_management.project_handler import create_project, delete_project
+from backend.data_management.shared_storage import PROJECT_LAYOUTS
+from backend.data_management.table_handler import create_table, get_range, set_cell_values
+from backend.user_management.user_handler import create_user, delete_user
+
+
+async def catalog_size(conn: asyncpg.Connection) -> tuple[int, int]:
+    # Number of relations and bytes of the catalogs that grow with every table and index
+    return await conn.fetchrow('''
+        SELECT (SELECT count(*) FROM pg_class),
+               pg_total_relation_size('pg_class') + pg_total_relation_size('pg_attribute')
+               + pg_total_relation_size('pg_index') + pg_total_relation_size('pg_depend') + pg_total_relation_size('pg_type')
+    ''')
+
+
+async def bench_project_layouts(projects: int = 200, tables: int = 3, reads: int = 500):
+    if os.getenv('CI') is None:
+        load_dotenv('.env.deployment')
+
+    connection_args = dict(
+        host=os.getenv('POSTGRES_HOST'),
+        port=os.getenv('POSTGRES_PORT'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+    )
+    # Every read goes to Postgres
+    cell_cache.max_tiles = 0
+
+    user_conn = await asyncpg.connect(database=os.getenv('USER_DB_NAME'), **connection_args)
+    data_conn = await asyncpg.connect(database=os.getenv('DATA_DB_NAME'), **connection_args)
+
+    name = f"bench_{uuid.uuid4().hex[:8]}"
+    owner_id = await create_user(user_conn, name, f"{name}@bench.local", "benchpassword", "Bench", "Layouts")
+    cells = [(row, col, f"{row}:{col}") for row in range(20) for col in range(10)]
+    created = []
+    try:
+        for layout in PROJECT_LAYOUTS:
+            data_before, user_before = await catalog_size(data_conn), await catalog_size(user_conn)
+
+            start = time.perf_counter()
+            project_ids = []
+            for index in range(projects):
+                project_id = await create_project(user_conn, data_conn, f"{name} {index}", owner_id, layout)
+                project_ids.append(project_id)
+                created.append(project_id)
+                for table in range(tables):
+                    await create_table(data_conn, f"table_{table}", project_id)
+                    await set_cell_values(data_conn, project_id, f"table_{table}", cells)
+            setup = time.perf_counter() - start
+
+            data_after, user_after = await catalog_size(data_conn), await catalog_size(user_conn)
+            await data_conn.execute('ANALYZE')
+
+            latencies = []
+            for _ in range(reads):
+                project_id = random.choice(project_ids)
+                start = time.perf_counter()
+                await get_range(data_conn, project_id, f"table_{random.randrange(tables)}", 5, 15, 2, 8)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+
+            print(f"{layout} layout, {projects} projects with {tables} tables each")
+            print(f"  setup:          {setup:.2f}s")
+            print(f"  data catalog:   +{data_after[0] - data_before[0]} relations, +{(data_after[1] - data_before[1]) / 1024:,.0f} KiB")
+            print(f"  user catalog:   +{user_after[0] - user_before[0]} relations, +{(user_after[1] - user_before[1]) / 1024:,.0f} KiB")
+            print(f"  get_range:      p50 {statistics.median(latencies):.3f}ms, p99 {latencies[int(len(latencies) * 0.99) - 1]:.3f}ms")
+    finally:
+        for project_id in created:
+            await delete_project(user_conn, data_conn, project_id)
+        await delete_user(user_conn, owner_id)
+        await user_conn.close()
+        await data_conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(bench_project_layouts())
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import logging.config
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI, Request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("APP_ENV", "production")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.chdir(ROOT)
+
+import Main
+
+# The benchmark configures the logging again below, with logs/app.log relative to a scratch directory
+os.chdir(tempfile.mkdtemp())
+
+logger = logging.getLogger("api_logger")
+
+
+async def legacy_logging_middleware(request: Request, call_next):
+    # The middleware as it was before the queue based logging, for comparison
+    start_time = time.time()
+    request_id = str(uuid.uuid4())
+    correlation_id = request.headers.get("X-Correlation-ID", request_id)
+    log_dict = {
+        "request_id": request_id,
+        "correlation_id": correlation_id,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "http": {
+            "request": {
+                "method": request.method,
+                "url": str(request.url),
+                "headers": {k: v for k, v in request.headers.items() if k.lower() not in ["authorization", "cookie"]},
+                "client_ip": request.client.host if request.client else "unknown",
+            }
+        },
+        "event": {"kind": "event", "category": "web", "type": "start"},
+    }
+    logger.info(f"Request started: {request.method} {request.url}", extra=log_dict)
+    response = await call_next(request)
+    process_time = time.time() - start_time
+    log_dict["http"]["response"] = {"status_code": response.status_code, "headers": {k: v for k, v in response.headers.items()}}
+    log_dict["event"]["duration"] = process_time
+    log_dict["event"]["outcome"] = "success"
+    log_dict["event"]["type"] = "end"
+    logger.info(f"Request finished successfully: {request.method} {request.url}", extra=log_dict)
+    response.headers["X-Process-Time"] = str(process_time)
+    response.headers["X-Request-ID"] = correlation_id
+    return response
+
+
+async def passthrough_middleware(request: Request, call_next):
+    return await call_next(request)
+
+
+def bench_app(middleware=None) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    if middleware is not None:
+        app.middleware("http")(middleware)
+    return app
+
+
+async def per_request(app: FastAPI, requests: int, rounds: int = 3) -> float:
+    # Microseconds per request through the whole ASGI stack, best of a few rounds
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for _ in range(50):
+            await client.get("/ping")
+        results = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(requests):
+                await client.get("/ping", headers={"User-Agent": "bench", "Accept": "application/json"})
+            results.append((time.perf_counter() - start) / requests * 1e6)
+        return min(results)
+
+
+def report(name: str, result: float, baseline: float, extra: str = ""):
+    print(f"{name:<40}{result:8.1f}us (+{result - baseline:.1f}us){extra}")
+
+
+async def bench_request_logging(requests: int = 1000):
+    env = os.environ["APP_ENV"]
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    print(f"{requests} requests per round, {env} logging config")
+    baseline = await per_request(bench_app(), requests)
+    print(f"{'no middleware':<40}{baseline:8.1f}us")
+    report("pass-through http middleware", await per_request(bench_app(passthrough_middleware), requests), baseline)
+
+    # Before: handlers write on the event loop thread
+    Main.stop_logging()
+    logging.config.dictConfig(Main.get_logging_config(env))
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report("before, synchronous handlers", await per_request(bench_app(legacy_logging_middleware), requests), baseline)
+
+    for rate in (1.0, 0.1):
+        Main.LOG_SUCCESS_SAMPLE_RATE = rate
+        Main.setup_logging(env)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        result = await per_request(bench_app(Main.professional_logging_middleware), requests)
+        # Records still queued when the requests finished are written afterwards
+        start = time.perf_counter()
+        Main.stop_logging()
+        report(f"after, queue handler, sample rate {rate:.1f}", result, baseline, f", {time.perf_counter() - start:.2f}s to drain the queue")
+
+
+if __name__ == '__main__':
+    asyncio.run(bench_request_logging())
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import asyncpg
+import asyncio
+
+from dotenv import load_dotenv
+
+from backend.data_management.project_handler import migrate_project_to_shared
+from backend.data_management.shared_storage import SHARED_LAYOUT
+
+
+async def migrate_shared_storage(project_ids: list[str]):
+    #Load environment variables from .env.deployment file if not in CI environment
+    if os.getenv('CI') is None:
+        load_dotenv('.env.deployment')
+
+    connection_args = dict(
+        host=os.getenv('POSTGRES_HOST'),
+        port=os.getenv('POSTGRES_PORT'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+    )
+    user_conn = await asyncpg.connect(database=os.getenv('USER_DB_NAME'), **connection_args)
+    data_conn = await asyncpg.connect(database=os.getenv('DATA_DB_NAME'), **connection_args)
+
+    #Without arguments every project that still has its own schema is migrated
+    if not project_ids:
+        project_ids = [record['project_id'] for record in await user_conn.fetch('SELECT project_id FROM projects WHERE storage_layout <> $1', SHARED_LAYOUT)]
+
+    migrated = 0
+    for project_id in project_ids:
+        try:
+            tables = await migrate_project_to_shared(user_conn, data_conn, project_id)
+        except Exception as e:
+            print(f"Project {project_id}: migration failed, {e}")
+            continue
+        migrated += 1
+        print(f"Project {project_id}: moved {tables} tables into shared storage")
+    print(f"Migrated {migrated} of {len(project_ids)} projects")
+
+    await user_conn.close()
+    await data_conn.close()
+
+if __name__ == '__main__':
+    asyncio.run(migrate_shared_storage(sys.argv[1:]))
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import asyncpg
+import asyncio
+
+from dotenv import load_dotenv
+
+from backend.data_management.table_handler import normalize_project_permissions
+
+
+async def normalize_permissions(project_ids: list[str]):
+    #Load environment variables from .env.deployment file if not in CI environment
+    if os.getenv('CI') is None:
+        load_dotenv('.env.deployment')
+
+    conn = await asyncpg.connect(
+        host=os.getenv('POSTGRES_HOST'),
+        port=os.getenv('POSTGRES_PORT'),
+        database=os.getenv('USER_DB_NAME'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+    )
+
+    #Without arguments every project is normalized
+    if not project_ids:
+        project_ids = [record['project_id'] for record in await conn.fetch('SELECT project_id FROM projects')]
+
+    total_before = total_after = 0
+    for project_id in project_ids:
+        before, after = await normalize_project_permissions(conn, project_id)
+        total_before += before
+        total_after += after
+        print(f"Project {project_id}: {before} -> {after} permission rectangles")
+    print(f"Normalized {len(project_ids)} projects: {total_before} -> {total_after} permission rectangles")
+
+    await conn.close()
+
+if __name__ == '__main__':
+    asyncio.run(normalize_permissions(sys.argv[1:]))
@@ -5,6 +5,9 @@ import asyncio
 
 from dotenv import load_dotenv
 
+from backend.data_management.shared_storage import SHARED_PARTITIONS
+from backend.user_management.effective_roles import refresh_effective_roles
+
 
 async def setup_databases():
     #Load environment variables from .env.deployment file if not in CI environment
@@ -97,8 +100,12 @@ async def setup_databases():
     await conn.execute('''CREATE TABLE IF NOT EXISTS projects (
         project_id UUID PRIMARY KEY,
         project_name VARCHAR(50) NOT NULL,
-        owner_id UUID REFERENCES users ("user_id") ON DELETE SET NULL
+        owner_id UUID REFERENCES users ("user_id") ON DELETE SET NULL,
+        storage_layout VARCHAR(10) NOT NULL DEFAULT 'schema'
         )''')
+    # Projects created before the shared layout keep one schema each
+    await conn.execute('''ALTER TABLE projects ADD COLUMN IF NOT EXISTS storage_layout VARCHAR(10) NOT NULL DEFAULT 'schema'
+        ''')
     print("Created 'projects' table in 'users' database")
 
     # Creating 'project_role' enum type
@@ -130,6 +137,17 @@ async def setup_databases():
         )''')
     print("Created 'project_teams' table in 'users' database")
 
+    #Create 'effective_roles' table, the highest role of every user per project through membership or teams
+    await conn.execute('''CREATE TABLE IF NOT EXISTS effective_roles (
+        user_id UUID REFERENCES users ("user_id") ON DELETE CASCADE,
+        project_id UUID REFERENCES projects ("project_id") ON DELETE CASCADE,
+        role project_role NOT NULL,
+        PRIMARY KEY (user_id, project_id)
+        )''')
+    # Backfills roles of memberships that existed before the table
+    await refresh_effective_roles(conn)
+    print("Created 'effective_roles' table in 'users' database")
+
     #CCreate 'permissions' schema
     await conn.execute('''CREATE SCHEMA IF NOT EXISTS permissions''')
     print("Created 'permissions' schema in 'users' database")
@@ -145,8 +163,118 @@ async def setup_databases():
                     ''')
     print("Created 'table_permission' enum type in 'users' database")
 
+    #Create 'shared_permissions' table for projects in the shared storage layout, hash partitioned by project
+    await conn.execute('''CREATE TABLE IF NOT EXISTS permissions.shared_permissions (
+        project_id UUID NOT NULL,
+        table_id UUID,
+        user_id UUID REFERENCES users ("user_id") ON DELETE CASCADE,
+        start_row INT NOT NULL,
+        end_row INT NOT NULL,
+        start_col INT NOT NULL,
+        end_col INT NOT NULL,
+        permission table_permission NOT NULL DEFAULT 'none',
+        PRIMARY KEY (project_id, table_id, user_id, start_row, end_row, start_col, end_col),
+        CONSTRAINT valid_row_range CHECK (end_row >= start_row),
+        CONSTRAINT valid_col_range CHECK (end_col >= start_col)
+        ) PARTITION BY HASH (project_id)''')
+    for remainder in range(SHARED_PARTITIONS):
+        await conn.execute(f'''CREATE TABLE IF NOT EXISTS permissions.shared_permissions_{remainder}
+            PARTITION OF permissions.shared_permissions FOR VALUES WITH (MODULUS {SHARED_PARTITIONS}, REMAINDER {remainder})''')
+    print("Created 'shared_permissions' table in 'users' database")
+
     #Close the connection to the 'users' database
     await conn.close()
 
+    #Connect to the 'data' database
+
+    print("Connecting to 'data' database with authentication")
+    conn = await asyncpg.connect(host=host, port=port, database=data_db_name, user=user, password=password)
+
+    #Create 'table_storage' table
+    await conn.execute('''CREATE TABLE IF NOT EXISTS table_storage (
+        schema_name TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        storage_mode TEXT NOT NULL DEFAULT 'cell',
+        row_map JSONB,
+        col_map JSONB,
+        revision BIGINT NOT NULL DEFAULT 0,
+        log_start BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (schema_name, table_name)
+        )''')
+    # Backfills the catalog rows of cell tables created before the table existed, without them the tables have no revision
+    await conn.execute('''
+        INSERT INTO table_storage (schema_name, table_name, storage_mode)
+        SELECT schemaname, tablename, 'cell' FROM pg_tables
+        WHERE schemaname ~ '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$' AND tablename NOT LIKE 'deleted\\_%'
+        ON CONFLICT (schema_name, table_name) DO NOTHING
+    ''')
+    print("Created 'table_storage' table in 'data' database")
+
+    #Create 'table_changes' table
+    await conn.execute('''CREATE TABLE IF NOT EXISTS table_changes (
+        schema_name TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        revision BIGINT NOT NULL,
+        cells JSONB,
+        PRIMARY KEY (schema_name, table_name, revision)
+        )''')
+    print("Created 'table_changes' table in 'data' database")
+
+    #Create 'permission_mirror' table
+    await conn.execute('''CREATE TABLE IF NOT EXISTS permission_mirror (
+        schema_name TEXT NOT NULL,
+        table_id TEXT NOT NULL,
+        user_id UUID NOT NULL,
+        start_row INT NOT NULL,
+        end_row INT NOT NULL,
+        start_col INT NOT NULL,
+        end_col INT NOT NULL,
+        permission TEXT NOT NULL,
+        PRIMARY KEY (schema_name, table_id, user_id, start_row, start_col)
+        )''')
+    print("Created 'permission_mirror' table in 'data' database")
+
+    #Create 'shared_cells' table for projects in the shared storage layout, hash partitioned by project
+    await conn.execute('''CREATE TABLE IF NOT EXISTS shared_cells (
+        project_id UUID NOT NULL,
+        table_name TEXT NOT NULL,
+        row_index INT NOT NULL,
+        col_index INT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (project_id, table_name, row_index, col_index)
+        ) PARTITION BY HASH (project_id)''')
+    for remainder in range(SHARED_PARTITIONS):
+        await conn.execute(f'''CREATE TABLE IF NOT EXISTS shared_cells_{remainder}
+            PARTITION OF shared_cells FOR VALUES WITH (MODULUS {SHARED_PARTITIONS}, REMAINDER {remainder})''')
+    print("Created 'shared_cells' table in 'data' database")
+
+    #Create 'shared_projects' table, the projects without a schema of their own
+    await conn.execute('''CREATE TABLE IF NOT EXISTS shared_projects (
+        schema_name TEXT PRIMARY KEY
+        )''')
+    print("Created 'shared_projects' table in 'data' database")
+
+    #Create 'pending_deletions' table, the work queue of the background deletion worker
+    await conn.execute('''CREATE TABLE IF NOT EXISTS pending_deletions (
+        deletion_id UUID PRIMARY KEY,
+        schema_name TEXT NOT NULL,
+        table_name TEXT,
+        tombstone TEXT,
+        tables_total INT NOT NULL DEFAULT 0,
+        tables_dropped INT NOT NULL DEFAULT 0,
+        attempts INT NOT NULL DEFAULT 0,
+        last_error TEXT,
+        requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        next_attempt TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at TIMESTAMPTZ
+        )''')
+    # The user who requested the deletion may follow it even once their project role is gone with the project
+    await conn.execute('''ALTER TABLE pending_deletions ADD COLUMN IF NOT EXISTS requested_by UUID''')
+    await conn.execute('''CREATE INDEX IF NOT EXISTS pending_deletions_due ON pending_deletions (requested_at) WHERE finished_at IS NULL''')
+    print("Created 'pending_deletions' table in 'data' database")
+
+    #Close the connection to the 'data' database
+    await conn.close()
+
 if __name__ == '__main__':
     asyncio.run(setup_databases())
\ No newline at end of file
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from backend.data_management.cell_cache import TileCache, cell_cache
+from backend.data_management.change_feed import start_change_feed, stop_change_feed, CHANNEL
+from backend.data_management.table_handler import create_table, set_cell_value, get_range, get_cell_value
+
+
+@pytest.mark.data_db
+def test_tile_cache_lru():
+    cache = TileCache(max_tiles=2)
+
+    cache.put(("s", "t", 0, 0), {(0, 0): "a"}, cache.generation("s", "t"))
+    cache.put(("s", "t", 0, 1), {(0, 64): "b"}, cache.generation("s", "t"))
+    assert cache.get(("s", "t", 0, 0)) == {(0, 0): "a"}
+    cache.put(("s", "t", 1, 0), {}, cache.generation("s", "t"))
+    assert cache.get(("s", "t", 0, 1)) is None
+    assert cache.stats()["evictions"] == 1
+
+    # A tile read before an invalidation of its table is not stored
+    generation = cache.generation("s", "t")
+    cache.invalidate_cells("s", "t", [(0, 0)])
+    cache.put(("s", "t", 2, 2), {}, generation)
+    assert cache.get(("s", "t", 2, 2)) is None
+
+    cache.invalidate_table("s", "t")
+    assert cache.get(("s", "t", 1, 0)) is None
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_cached_reads(data_db_pool):
+    schema = f"cache_test_{uuid.uuid4()}"
+    async with data_db_pool.acquire() as connection:
+        await connection.execute(f'CREATE SCHEMA "{schema}"')
+        await start_change_feed(data_db_pool)
+        try:
+            await create_table(connection, "cached", schema)
+            await set_cell_value(connection, schema, "cached", 1, 1, "first")
+            # Wait for the own notification of the write, it invalidates the cell once more
+            await asyncio.sleep(0.1)
+
+            hits = cell_cache.hits
+            assert await get_range(connection, schema, "cached", 0, 10, 0, 10) == [(1, 1, "first")]
+            assert await get_cell_value(connection, schema, "cached", 1, 1) == "first"
+            assert cell_cache.hits == hits + 1
+
+            await set_cell_value(connection, schema, "cached", 1, 1, "second")
+            assert await get_cell_value(connection, schema, "cached", 1, 1) == "second"
+
+            # A write by another worker arrives as notification and drops the cached tile
+            await connection.execute(f'UPDATE "{schema}"."cached" SET value = $1', "third")
+            await connection.execute("SELECT pg_notify($1, $2)", CHANNEL, json.dumps({"origin": "other", "schema": schema, "table": "cached", "cells": [[1, 1, "third"]]}))
+            for _ in range(50):
+                if cell_cache.get((schema, "cached", 0, 0)) is None:
+                    break
+                await asyncio.sleep(0.01)
+            assert await get_cell_value(connection, schema, "cached", 1, 1) == "third"
+        finally:
+            await stop_change_feed()
+            await connection.execute(f'DROP SCHEMA "{schema}" CASCADE')
+            await connection.execute('DELETE FROM table_storage WHERE schema_name = $1', schema)
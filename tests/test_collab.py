@@ -0,0 +1,62 @@
+import asyncio
+import uuid
+
+import pytest
+
+from backend.data_management.pool_manager import DATA_POOL, pool_manager
+from backend.data_management.change_feed import start_change_feed, stop_change_feed, subscribe, unsubscribe
+from backend.data_management.collab_hub import CollabHub
+from backend.data_management.table_handler import create_table, get_range
+
+
+class RecordingSocket:
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_json(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_collab_edits_are_coalesced_and_broadcast(data_db_pool):
+    schema = f"collab_test_{uuid.uuid4()}"
+    hub = CollabHub()
+    subscribe(hub.on_table_changed)
+    pool_manager.attach(DATA_POOL, data_db_pool)
+    async with data_db_pool.acquire() as connection:
+        await connection.execute(f'CREATE SCHEMA "{schema}"')
+        await start_change_feed(data_db_pool)
+        try:
+            await create_table(connection, "shared", schema)
+            editor, viewer = RecordingSocket(), RecordingSocket()
+            hub.join(schema, "shared", editor)
+            hub.join(schema, "shared", viewer)
+
+            # Keystrokes on one cell collapse into a single write of the final value
+            for text in ["h", "he", "hel", "hello"]:
+                hub.submit(schema, "shared", [(0, 0, text)])
+            hub.submit(schema, "shared", [(0, 1, "x")])
+
+            # Creating the table was announced as well, its resync may still arrive after the sockets joined
+            for _ in range(100):
+                if any(message["type"] == "cells" for message in viewer.messages):
+                    break
+                await asyncio.sleep(0.01)
+
+            assert await get_range(connection, schema, "shared", 0, 0, 0, 1) == [(0, 0, "hello"), (0, 1, "x")]
+            assert [message for message in viewer.messages if message["type"] != "resync"] == [
+                {"type": "cells", "cells": [[0, 0, "hello"], [0, 1, "x"]]}
+            ]
+            assert editor.messages == viewer.messages
+
+            hub.leave(schema, "shared", editor)
+            hub.leave(schema, "shared", viewer)
+            assert hub.sessions == {}
+        finally:
+            unsubscribe(hub.on_table_changed)
+            pool_manager.detach(DATA_POOL)
+            await stop_change_feed()
+            await connection.execute(f'DROP SCHEMA "{schema}" CASCADE')
+            await connection.execute('DELETE FROM table_storage WHERE schema_name = $1', schema)
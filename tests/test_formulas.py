@@ -0,0 +1,68 @@
+import uuid
+
+import pytest
+
+from backend.data_management.formula_engine import parse_formula, references, get_computed_range, \
+    get_table_formulas, discard_table_formulas, FormulaError
+from backend.data_management.table_handler import create_table, set_cell_values, CELL_STORAGE, TILE_STORAGE
+
+
+@pytest.mark.data_db
+def test_parse_formula():
+    assert parse_formula("=A1+2*B$3") == ("binary", "+", ("cell", 0, 0), ("binary", "*", ("value", 2.0), ("cell", 2, 1)))
+    assert parse_formula("=SUM(B10:A1)") == ("call", "SUM", (("range", 0, 9, 0, 1),))
+    assert references(parse_formula("=IF(A1>0, SUM(A2:A9), C3)")) == ({(0, 0), (2, 2)}, {(1, 8, 0, 0)})
+
+    with pytest.raises(FormulaError):
+        parse_formula("=1+")
+    with pytest.raises(FormulaError):
+        parse_formula("=(1")
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_mode", [CELL_STORAGE, TILE_STORAGE])
+async def test_formula_recalculation(data_db_pool, storage_mode):
+    # Writes inside an open transaction drop the engine, so this test works on committed data in its own schema
+    schema = f"formula_test_{uuid.uuid4()}"
+    async with data_db_pool.acquire() as connection:
+        await connection.execute(f'CREATE SCHEMA "{schema}"')
+        try:
+            await create_table(connection, "formulas", schema, storage_mode=storage_mode)
+            await set_cell_values(connection, schema, "formulas", [
+                (0, 0, "1"), (1, 0, "2"), (2, 0, "3"), (3, 0, "text"),
+                (0, 1, "=SUM(A1:A4)"),
+                (1, 1, "=B1*2"),
+                (2, 1, "=A1/0"),
+                (3, 1, '=B4+1'),
+                (4, 1, '=IF(B2>10, "big", "small") & "!"'),
+                (5, 1, "=AVERAGE(A1:B2)"),
+                (6, 1, "=B7"),
+                (7, 1, "=1+"),
+            ])
+
+            computed = await get_computed_range(connection, schema, "formulas", 0, 10, 1, 1)
+            assert computed == [
+                (0, 1, "6"), (1, 1, "12"), (2, 1, "#DIV/0!"), (3, 1, "#CYCLE!"),
+                (4, 1, "big!"), (5, 1, "5.25"), (6, 1, "#CYCLE!"), (7, 1, "#ERROR!"),
+            ]
+            formulas = await get_table_formulas(connection, schema, "formulas")
+
+            # A committed write is applied to the loaded engine by the write listener instead of reloading it
+            await set_cell_values(connection, schema, "formulas", [(0, 0, "-4"), (8, 1, "=A1*10")])
+            assert await get_table_formulas(connection, schema, "formulas") is formulas
+            computed = await get_computed_range(connection, schema, "formulas", 0, 10, 1, 1)
+            assert computed == [
+                (0, 1, "1"), (1, 1, "2"), (2, 1, "#DIV/0!"), (3, 1, "#CYCLE!"),
+                (4, 1, "small!"), (5, 1, "0.25"), (6, 1, "#CYCLE!"), (7, 1, "#ERROR!"), (8, 1, "-40"),
+            ]
+
+            # Replacing a formula with a plain value removes it from the engine
+            await set_cell_values(connection, schema, "formulas", [(1, 1, "7")])
+            assert await get_computed_range(connection, schema, "formulas", 1, 5, 1, 1) == [
+                (1, 1, "7"), (2, 1, "#DIV/0!"), (3, 1, "#CYCLE!"), (4, 1, "small!"), (5, 1, "1.5"),
+            ]
+        finally:
+            discard_table_formulas(schema, "formulas")
+            await connection.execute(f'DROP SCHEMA "{schema}" CASCADE')
+            await connection.execute('DELETE FROM table_storage WHERE schema_name = $1', schema)
@@ -0,0 +1,71 @@
+import io
+
+import json
+
+import pytest
+
+from backend.data_management.export_handler import export_table
+from backend.data_management.import_handler import import_file
+from backend.data_management.table_handler import get_range, set_cell_values, CELL_STORAGE, TILE_STORAGE
+from test_tables import setup_table
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_import_csv(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+
+    file = io.BytesIO("name,amount\nfoo,1\n,\nbar,\"2,5\"\n".encode("utf-8"))
+    progress = await import_file(data_db_transaction, project_id, "test_table", file, "csv", start_row=1, batch_size=2)
+
+    assert progress.cells == 6
+    assert progress.rows == 4
+    assert progress.bytes_read == progress.total_bytes
+    assert not file.closed
+
+    cells = await get_range(data_db_transaction, project_id, "test_table", 0, 10, 0, 10)
+    assert cells == [(1, 0, "name"), (1, 1, "amount"), (2, 0, "foo"), (2, 1, "1"), (4, 0, "bar"), (4, 1, "2,5")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_import_xlsx(user_db_transaction, data_db_transaction):
+    openpyxl = pytest.importorskip("openpyxl")
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["a", 1])
+    workbook.active.append([None, 2.5])
+    file = io.BytesIO()
+    workbook.save(file)
+    file.seek(0)
+
+    progress = await import_file(data_db_transaction, project_id, "test_table", file, "xlsx")
+    assert progress.cells == 3
+    assert progress.rows == 2
+    assert 0 < progress.bytes_read == progress.total_bytes
+
+    cells = await get_range(data_db_transaction, project_id, "test_table", 0, 10, 0, 10)
+    assert cells == [(0, 0, "a"), (0, 1, "1"), (1, 1, "2.5")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_mode", [CELL_STORAGE, TILE_STORAGE])
+async def test_export(user_db_transaction, data_db_transaction, storage_mode):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=storage_mode)
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 0, "a"), (0, 2, "c"), (2, 1, "x,y")])
+
+    csv_export = "".join([chunk async for chunk in export_table(data_db_transaction, project_id, "test_table", "csv")])
+    assert csv_export == 'a,,c\r\n\r\n,"x,y",\r\n'
+
+    ndjson_export = "".join([chunk async for chunk in export_table(data_db_transaction, project_id, "test_table", "ndjson")])
+    assert [json.loads(line) for line in ndjson_export.splitlines()] == [
+        {"row": 0, "values": ["a", None, "c"]},
+        {"row": 2, "values": [None, "x,y", None]},
+    ]
+
+    pa = pytest.importorskip("pyarrow")
+    arrow_export = b"".join([chunk async for chunk in export_table(data_db_transaction, project_id, "test_table", "arrow")])
+    table = pa.ipc.open_stream(arrow_export).read_all()
+    assert table.to_pydict() == {"row_index": [0, 2], "c0": ["a", None], "c1": [None, "x,y"], "c2": ["c", None]}
@@ -0,0 +1,69 @@
+import pytest
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+
+from backend.routes import metrics
+from backend.routes.metrics import MetricsRegistry, merge_snapshots, read_snapshots, render, route_label, write_snapshot
+
+
+@pytest.mark.unit
+def test_metrics_exposition(tmp_path, monkeypatch):
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    registry.register_collector(lambda: [("gauge", "db_pool_size", {"pool": "data"}, 4)])
+    registry.observe_request("GET", "/api/projects/{project_id}", 200, 0.05)
+    registry.observe_request("GET", "/api/projects/{project_id}", 503, 2.0)
+    text = render(merge_snapshots([registry.snapshot()]))
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert 'http_requests_total{method="GET",route="/api/projects/{project_id}",status="5xx"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/projects/{project_id}",le="0.1"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/projects/{project_id}",le="+Inf"} 2' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/projects/{project_id}"} 2' in text
+    assert 'db_pool_size{pool="data"} 4' in text
+
+    # Two workers: counters and histograms add up, gauges stay per worker, an exited worker only keeps its counters
+    first, second = registry.snapshot(), registry.snapshot()
+    second["pid"] = first["pid"] + 1
+    write_snapshot(str(tmp_path), first)
+    write_snapshot(str(tmp_path), second)
+    text = render(merge_snapshots(read_snapshots(str(tmp_path))))
+    assert 'http_requests_total{method="GET",route="/api/projects/{project_id}",status="2xx"} 2' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/projects/{project_id}"} 4' in text
+    assert f'db_pool_size{{pool="data",pid="{second["pid"]}"}} 4' in text
+    second["exited"] = True
+    write_snapshot(str(tmp_path), second)
+    text = render(merge_snapshots(read_snapshots(str(tmp_path))))
+    assert f'pid="{second["pid"]}"' not in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/projects/{project_id}"} 4' in text
+
+    cache = {"hits": 3, "misses": 1}
+    monkeypatch.setattr(metrics, "permission_index_stats", lambda: {**cache, "indexes": 1})
+    text = render(merge_snapshots([metrics.metrics_registry.snapshot()]))
+    assert 'cache_hit_ratio{cache="permission_indexes"} 0.75' in text
+
+
+@pytest.mark.unit
+def test_route_label():
+    # Path parameters that look like other segments of the path must not change the template
+    tables = APIRouter(prefix="/tables")
+    labels = []
+
+    @tables.get("/{project_id}/{table_name}/range")
+    async def table_range(project_id: str, table_name: str):
+        return {}
+
+    api = APIRouter(prefix="/api")
+    api.include_router(tables)
+    app = FastAPI()
+    app.include_router(api)
+
+    @app.middleware("http")
+    async def record_label(request, call_next):
+        response = await call_next(request)
+        labels.append(route_label(request.scope))
+        return response
+
+    with TestClient(app) as client:
+        client.get("/api/tables/p/range/range")
+        client.get("/api/tables/api/API/range")
+        client.get("/api/tables/p/t/nothing")
+    assert labels == ["/api/tables/{project_id}/{table_name}/range"] * 2 + [metrics.UNMATCHED_ROUTE]
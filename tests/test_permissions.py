@@ -0,0 +1,137 @@
+import random
+import uuid
+
+import pytest
+
+from backend.data_management import permission_index
+from backend.data_management.permission_index import PermissionIndex, PERMISSION_LEVELS, get_permission_index, normalize_rectangles
+from backend.data_management.permission_mirror import sync_permission_mirror, get_masked_range
+from backend.data_management.pool_manager import DATA_POOL, pool_manager
+from backend.data_management.table_handler import set_permission, delete_permission_range, set_cell_values, \
+    get_all_user_permissions, normalize_project_permissions, table_id_of
+from test_tables import setup_table
+
+
+@pytest.mark.data_db
+def test_permission_index():
+    index = PermissionIndex([(0, 9, 0, 9, "read"), (5, 14, 5, 14, "write"), (20, 20, 0, 0, "none")])
+
+    assert index.cell(0, 0) == "read"
+    assert index.cell(7, 7) == "write"
+    assert index.cell(12, 2) == "none"
+    assert index.cell(20, 0) == "none"
+    assert index.viewport(8, 10, 3, 6) == [(8, 9, 3, 4, "read"), (8, 9, 5, 6, "write"), (10, 10, 5, 6, "write")]
+    assert index.viewport_permission(0, 9, 0, 9) == "read"
+    assert index.viewport_permission(5, 14, 5, 14) == "write"
+    assert index.viewport_permission(0, 14, 0, 14) == "none"
+    assert index.viewport_permission(9, 0, 0, 9) == "none"
+
+    # Compiled rectangles never overlap and resolve every cell like the highest covering rectangle
+    rectangles = []
+    for _ in range(30):
+        start_row, start_col = random.randint(0, 40), random.randint(0, 40)
+        rectangles.append((start_row, start_row + random.randint(0, 10), start_col, start_col + random.randint(0, 10), random.choice(PERMISSION_LEVELS)))
+    index = PermissionIndex(rectangles)
+    normalized = PermissionIndex(normalize_rectangles(rectangles))
+    for row in range(55):
+        for col in range(55):
+            covering = [PERMISSION_LEVELS.index(r[4]) for r in rectangles if r[0] <= row <= r[1] and r[2] <= col <= r[3]]
+            assert index.cell(row, col) == PERMISSION_LEVELS[max(covering, default=0)]
+            assert normalized.cell(row, col) == index.cell(row, col)
+    compiled = index.rectangles()
+    assert sum((r[1] - r[0] + 1) * (r[3] - r[2] + 1) for r in compiled) == len({
+        (row, col) for r in compiled for row in range(r[0], r[1] + 1) for col in range(r[2], r[3] + 1)
+    })
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_permission_index_invalidation(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    table_id = uuid.uuid4()
+    key = (str(project_id), str(table_id), str(user_id))
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 4, 0, 4, "read")
+
+    # Indexes read inside a transaction are not cached, the test puts it in place itself
+    index = await get_permission_index(user_db_transaction, project_id, table_id, user_id)
+    permission_index._indexes[key] = index
+    assert await get_permission_index(user_db_transaction, project_id, table_id, user_id) is index
+
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 4, 0, 4, "write")
+    assert key not in permission_index._indexes
+    assert (await get_permission_index(user_db_transaction, project_id, table_id, user_id)).cell(2, 2) == "write"
+
+    permission_index._indexes[key] = index
+    await delete_permission_range(user_db_transaction, project_id, table_id, user_id, 0, 4, 0, 4)
+    assert (await get_permission_index(user_db_transaction, project_id, table_id, user_id)).cell(2, 2) == "none"
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_masked_range(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    table_id = uuid.uuid4()
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(row, col, f"{row}:{col}") for row in range(4) for col in range(4)])
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 1, 0, 3, "read")
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 1, 2, 2, 2, "write")
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 0, 0, 0, "none")
+    await sync_permission_mirror(user_db_transaction, data_db_transaction, project_id, table_id, user_id)
+
+    assert await get_masked_range(data_db_transaction, project_id, "test_table", table_id, user_id, 0, 3, 1, 2) == [
+        (0, 1, "0:1", "read"), (0, 2, "0:2", "read"),
+        (1, 1, "1:1", "read"), (1, 2, "1:2", "write"),
+        (2, 2, "2:2", "write"),
+    ]
+    assert await get_masked_range(data_db_transaction, project_id, "test_table", table_id, uuid.uuid4(), 0, 3, 0, 3) == []
+    # The routes address tables by name, the permissions belong to the uuid the table is named after
+    assert table_id_of(str(table_id).upper()) == table_id
+    assert table_id_of("test_table") is None
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_masked_range_fails_closed(user_db_transaction, data_db_transaction, data_db_pool):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    table_id = uuid.uuid4()
+    pool_manager.attach(DATA_POOL, data_db_pool)
+    try:
+        async with data_db_pool.acquire() as connection:
+            await connection.execute('''
+                INSERT INTO permission_mirror (schema_name, table_id, user_id, start_row, end_row, start_col, end_col, permission)
+                VALUES ($1, $2, $3, 0, 9, 0, 9, 'write')
+            ''', str(project_id), str(table_id), user_id)
+
+        # The revocation is not committed yet, its mirrored rows are removed right away instead of after the commit
+        await delete_permission_range(user_db_transaction, project_id, table_id, user_id, 0, 4, 0, 4)
+        async with data_db_pool.acquire() as connection:
+            assert await connection.fetchval('SELECT count(*) FROM permission_mirror WHERE schema_name = $1', str(project_id)) == 0
+    finally:
+        pool_manager.detach(DATA_POOL)
+        async with data_db_pool.acquire() as connection:
+            await connection.execute('DELETE FROM permission_mirror WHERE schema_name = $1', str(project_id))
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_permission_normalization(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    table_id = uuid.uuid4()
+
+    # Adjacent selections of the same permission end up as one rectangle, a conflicting one splits it
+    for row in range(4):
+        await set_permission(user_db_transaction, project_id, table_id, user_id, row, row, 0, 9, "read")
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 3, 10, 19, "read")
+    assert [tuple(record) for record in await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)] == [(0, 3, 0, 19, "read")]
+
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 1, 2, 5, 25, "write")
+    await delete_permission_range(user_db_transaction, project_id, table_id, user_id, 3, 3, 0, 19)
+    assert sorted(tuple(record) for record in await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)) == [
+        (0, 0, 0, 19, "read"), (1, 2, 0, 4, "read"), (1, 2, 5, 25, "write"),
+    ]
+
+    # Overlapping rectangles stored before normalization on write are merged by the maintenance job
+    await user_db_transaction.executemany(f'''
+        INSERT INTO permissions."{project_id}" (table_id, user_id, start_row, end_row, start_col, end_col, permission) VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ''', [(table_id, user_id, 10, 20, 0, 5, "read"), (table_id, user_id, 15, 30, 0, 5, "read"), (table_id, user_id, 12, 12, 0, 5, "none")])
+    assert await normalize_project_permissions(user_db_transaction, project_id) == (6, 4)
+    assert (10, 30, 0, 5, "read") in [tuple(record) for record in await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)]
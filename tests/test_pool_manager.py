@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from backend.data_management.pool_manager import PoolManager, PoolSettings
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_pool_manager(monkeypatch):
+    monkeypatch.setenv("TEST_POOL_MAX_SIZE", "3")
+    monkeypatch.setenv("TEST_POOL_COMMAND_TIMEOUT", "0")
+    settings = PoolSettings.from_env("TEST", os.getenv('USER_DB_NAME'))
+    assert settings.max_size == 3 and settings.min_size == 2 and settings.command_timeout is None
+
+    manager = PoolManager()
+    manager.settings["test"] = settings
+    manager.register_warmup("test", 'SELECT role FROM effective_roles WHERE user_id = $1 AND project_id = $2')
+    await manager.open("test")
+    try:
+        async with manager.acquire("test") as connection:
+            # The warm-up statement is already in the statement cache of every pooled connection
+            assert len(connection._stmt_cache) >= 1
+            # and was prepared only once
+            assert await connection.fetchval(
+                'SELECT count(*) FROM pg_prepared_statements WHERE statement LIKE $1', 'SELECT role FROM effective_roles%'
+            ) == 1
+            assert manager.stats()["test"]["in_use"] == 1
+        stats = manager.stats()["test"]
+        assert stats["acquires"] == 1 and stats["in_use"] == 0
+        assert stats["connections_opened"] == 2 and stats["connections_closed"] == 0
+    finally:
+        await manager.close("test")
+    assert manager.stats()["test"]["connections_closed"] == 2
+    with pytest.raises(RuntimeError):
+        async with manager.acquire("test"):
+            pass
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_replica_routing():
+    import time
+    from backend.data_management.pool_manager import reading_replica, replica_name
+    from backend.data_management.replica_router import ReplicaRouter
+
+    # Point REPLICA_TEST_HOST/REPLICA_TEST_PORT at a second instance, by default the primary stands in for it
+    manager = PoolManager()
+    manager.settings["test"] = PoolSettings(os.getenv('DATA_DB_NAME'), min_size=1, max_size=2)
+    manager.settings[replica_name("test")] = PoolSettings(
+        os.getenv('DATA_DB_NAME'), os.getenv("REPLICA_TEST_HOST"), os.getenv("REPLICA_TEST_PORT"), min_size=1, max_size=2
+    )
+    router = ReplicaRouter(manager)
+    await manager.open("test")
+    await router.start()
+    try:
+        state = router.replicas["test"]
+        assert state.healthy and state.lag == 0
+        assert router.choose("test") == "test_replica"
+        assert router.choose("other") == "other"
+
+        async with router.read("test") as connection:
+            assert reading_replica.get()
+            assert await connection.fetchval('SELECT 1') == 1
+        assert not reading_replica.get()
+
+        # A session that wrote after the last check reads from the primary until the replica caught up
+        last_write = time.time()
+        assert router.choose("test", last_write) == "test"
+        await router.check()
+        assert router.choose("test", last_write) == "test_replica"
+
+        # Replicas too far behind are skipped
+        state.replayed_until = time.time() - 3600
+        async with router.read("test") as connection:
+            assert not reading_replica.get()
+        assert state.fallbacks == 2 and state.reads == 3
+    finally:
+        await router.stop()
+        await manager.close("test")
+
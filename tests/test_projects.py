@@ -1,12 +1,17 @@
 import json
 
+import asyncpg
+
 import pytest
 
 from conftest import user_db_transaction
-from backend.user_management.team_handler import create_team
+from backend.user_management.effective_roles import get_effective_role, has_project_role
+from backend.user_management.team_handler import create_team, delete_team
 from backend.data_management.project_handler import create_project, get_project_name, project_exists, add_member, \
-    list_project_members, change_member_role, remove_member, delete_project, list_user_projects
-from backend.user_management.user_handler import create_user
+    list_project_members, change_member_role, remove_member, delete_project, list_user_projects, add_team, \
+    change_team_role, add_members, change_member_roles, remove_members
+from backend.user_management.user_handler import create_user, add_user_to_team, remove_user_from_team, add_users_to_team, \
+    remove_users_from_team
 
 
 @pytest.mark.data_db
@@ -56,4 +61,95 @@ async def test_setup_project(user_db_transaction, data_db_transaction):
     assert all(project['project_id'] != project_id for project in projects)
 
     await delete_project(user_connection=user_db_transaction, data_connection=data_db_transaction, project_id=project_id)
-    assert not await project_exists(user_connection=user_db_transaction, project_id=project_id)
\ No newline at end of file
+    assert not await project_exists(user_connection=user_db_transaction, project_id=project_id)
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_effective_roles(user_db_transaction, data_db_transaction):
+    owner_id = await create_user(user_db_transaction, "roles_owner", "roles_owner@mail.com", "securepassword", "Owner", "Roles")
+    member_id = await create_user(user_db_transaction, "roles_member", "roles_member@mail.com", "securepassword", "Member", "Roles")
+    project_id = await create_project(user_db_transaction, data_db_transaction, "Roles Project", owner_id)
+    team_id = await create_team(user_db_transaction, "Roles Team")
+
+    assert await get_effective_role(user_db_transaction, owner_id, project_id) == "owner"
+    assert await get_effective_role(user_db_transaction, member_id, project_id) is None
+
+    await add_user_to_team(user_db_transaction, member_id, team_id, "member")
+    await add_team(user_db_transaction, project_id, team_id, "editor")
+    assert await get_effective_role(user_db_transaction, member_id, project_id) == "editor"
+
+    # The highest role of membership and teams wins
+    await add_member(user_db_transaction, project_id, member_id, "viewer")
+    assert await get_effective_role(user_db_transaction, member_id, project_id) == "editor"
+    await change_member_role(user_db_transaction, project_id, member_id, "admin")
+    assert await has_project_role(user_db_transaction, member_id, project_id, "moderator")
+    await remove_member(user_db_transaction, project_id, member_id)
+    assert await get_effective_role(user_db_transaction, member_id, project_id) == "editor"
+
+    await change_team_role(user_db_transaction, project_id, team_id, "viewer")
+    assert not await has_project_role(user_db_transaction, member_id, project_id, "editor")
+    await remove_user_from_team(user_db_transaction, member_id, team_id)
+    assert await get_effective_role(user_db_transaction, member_id, project_id) is None
+
+    await add_user_to_team(user_db_transaction, member_id, team_id, "member")
+    assert await get_effective_role(user_db_transaction, member_id, project_id) == "viewer"
+    await delete_team(user_db_transaction, team_id)
+    assert await get_effective_role(user_db_transaction, member_id, project_id) is None
+
+    await delete_project(user_db_transaction, data_db_transaction, project_id)
+    assert await get_effective_role(user_db_transaction, owner_id, project_id) is None
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_batch_members(user_db_transaction, data_db_transaction):
+    owner_id = await create_user(user_db_transaction, "batch_owner", "batch_owner@mail.com", "securepassword", "Owner", "Batch")
+    user_ids = [
+        await create_user(user_db_transaction, f"batch_user_{index}", f"batch_user_{index}@mail.com", "securepassword", "User", "Batch")
+        for index in range(3)
+    ]
+    project_id = await create_project(user_db_transaction, data_db_transaction, "Batch Project", owner_id)
+    team_id = await create_team(user_db_transaction, "Batch Team")
+
+    await add_members(user_db_transaction, project_id, user_ids[:2], ["viewer", "editor"])
+    assert [await get_effective_role(user_db_transaction, user_id, project_id) for user_id in user_ids] == ["viewer", "editor", None]
+
+    # A batch with one existing member is rejected as a whole
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await add_members(user_db_transaction, project_id, user_ids[1:], ["viewer", "viewer"])
+    assert await get_effective_role(user_db_transaction, user_ids[2], project_id) is None
+
+    await change_member_roles(user_db_transaction, project_id, user_ids[:2], ["admin", "viewer"])
+    assert [await get_effective_role(user_db_transaction, user_id, project_id) for user_id in user_ids[:2]] == ["admin", "viewer"]
+    with pytest.raises(ValueError):
+        await change_member_roles(user_db_transaction, project_id, user_ids, ["editor"] * 3)
+    assert await get_effective_role(user_db_transaction, user_ids[0], project_id) == "admin"
+
+    # The owner and members at or above the role of the caller are out of reach of a batch
+    with pytest.raises(PermissionError):
+        await change_member_roles(user_db_transaction, project_id, [owner_id, user_ids[1]], ["viewer", "editor"])
+    with pytest.raises(PermissionError):
+        await remove_members(user_db_transaction, project_id, [user_ids[0]], "admin")
+    await change_member_roles(user_db_transaction, project_id, [user_ids[1]], ["editor"], "admin")
+    with pytest.raises(PermissionError):
+        await remove_members(user_db_transaction, project_id, [owner_id], "owner")
+    assert await get_effective_role(user_db_transaction, owner_id, project_id) == "owner"
+
+    with pytest.raises(ValueError):
+        await remove_members(user_db_transaction, project_id, user_ids)
+    await remove_members(user_db_transaction, project_id, user_ids[:2])
+    assert await get_effective_role(user_db_transaction, user_ids[0], project_id) is None
+
+    await add_team(user_db_transaction, project_id, team_id, "editor")
+    await add_users_to_team(user_db_transaction, team_id, user_ids, ["member", "member", "admin"])
+    assert [await get_effective_role(user_db_transaction, user_id, project_id) for user_id in user_ids] == ["editor"] * 3
+    await remove_users_from_team(user_db_transaction, team_id, user_ids[1:])
+    assert [await get_effective_role(user_db_transaction, user_id, project_id) for user_id in user_ids] == ["editor", None, None]
+
+    # Team batches stop at the role of the caller as well
+    with pytest.raises(PermissionError):
+        await add_users_to_team(user_db_transaction, team_id, user_ids[1:], ["member", "admin"], "moderator")
+    await add_users_to_team(user_db_transaction, team_id, user_ids[1:], ["member", "moderator"], "moderator")
+    with pytest.raises(PermissionError):
+        await remove_users_from_team(user_db_transaction, team_id, user_ids[1:], "moderator")
+    await remove_users_from_team(user_db_transaction, team_id, user_ids[1:2], "moderator")
+    assert [await get_effective_role(user_db_transaction, user_id, project_id) for user_id in user_ids] == ["editor", None, "editor"]
@@ -0,0 +1,352 @@
+import pytest
+
+from backend.data_management import deletion_queue
+from backend.data_management.deletion_queue import get_deletion, list_deletions, process_deletion_step, retry_deletion, tombstone_name
+from backend.data_management.project_handler import create_project, migrate_project_to_shared, delete_project, clone_project
+import uuid
+
+from backend.data_management.table_handler import create_table, set_cell_value, get_cell_value, get_range, \
+    set_cell_values, migrate_table_storage, get_storage_mode, CELL_STORAGE, TILE_STORAGE, SHARED_STORAGE, change_table_structure, \
+    get_cells, get_cells_sql, set_permission, get_all_user_permissions, remap_permission_ranges, get_table_changes, delete_table, \
+    clone_table, clone_table_permissions
+from backend.data_management.change_log import compact_change_log
+from backend.data_management.shared_storage import SHARED_LAYOUT, get_project_layout
+from backend.user_management.user_handler import create_user
+
+
+async def setup_table(user_db_transaction, data_db_transaction, table_name="test_table", storage_mode=CELL_STORAGE):
+    user_id = await create_user(
+        user_connection=user_db_transaction,
+        userName="table_tester",
+        email="table@tester.com",
+        password="securepassword",
+        lastName="Tester",
+        firstName="Table"
+    )
+    project_id = await create_project(user_connection=user_db_transaction, data_connection=data_db_transaction, project_name="Table Project", owner_id=user_id)
+    await create_table(data_connection=data_db_transaction, table_name=table_name, schema=project_id, storage_mode=storage_mode)
+    return user_id, project_id
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_mode", [CELL_STORAGE, TILE_STORAGE, SHARED_STORAGE])
+async def test_get_range(user_db_transaction, data_db_transaction, storage_mode):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=storage_mode)
+
+    for row in range(5):
+        for col in range(5):
+            await set_cell_value(data_db_transaction, project_id, "test_table", row, col, f"{row}:{col}")
+    await set_cell_value(data_db_transaction, project_id, "test_table", 2, 2, "")
+
+    cells = await get_range(data_db_transaction, project_id, "test_table", 1, 3, 2, 3)
+    assert cells == [(1, 2, "1:2"), (1, 3, "1:3"), (2, 3, "2:3"), (3, 2, "3:2"), (3, 3, "3:3")]
+    assert await get_cell_value(data_db_transaction, project_id, "test_table", 2, 2) is None
+
+    with pytest.raises(ValueError):
+        await get_range(data_db_transaction, project_id, "test_table", 3, 1, 0, 0)
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_mode", [CELL_STORAGE, TILE_STORAGE, SHARED_STORAGE])
+async def test_set_cell_values(user_db_transaction, data_db_transaction, storage_mode):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=storage_mode)
+
+    await set_cell_value(data_db_transaction, project_id, "test_table", 0, 0, "old")
+    await set_cell_value(data_db_transaction, project_id, "test_table", 0, 1, "removed")
+
+    written = await set_cell_values(data_db_transaction, project_id, "test_table", [
+        (0, 0, "new"),
+        (0, 1, ""),
+        (1, 0, "first"),
+        (1, 0, "last"),
+        (2, 2, None),
+    ])
+    assert written == 5
+
+    cells = await get_range(data_db_transaction, project_id, "test_table", 0, 2, 0, 2)
+    assert cells == [(0, 0, "new"), (1, 0, "last")]
+
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(5, 5, "again")])
+    assert await get_cell_value(data_db_transaction, project_id, "test_table", 5, 5) == "again"
+
+    with pytest.raises(ValueError):
+        await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 0, "x"), (-1, 0, "x")])
+    with pytest.raises(ValueError):
+        await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 2 ** 31, "x")])
+    with pytest.raises(ValueError):
+        await set_cell_values(data_db_transaction, project_id, "missing_table", [(0, 0, "x")])
+    assert await get_cell_value(data_db_transaction, project_id, "test_table", 0, 0) == "new"
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_migrate_table_storage(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+
+    cells = [(0, 0, "a"), (63, 64, "b"), (64, 63, "c"), (200, 5, "d")]
+    await set_cell_values(data_db_transaction, project_id, "test_table", cells)
+
+    await migrate_table_storage(data_db_transaction, project_id, "test_table", TILE_STORAGE)
+    assert await get_storage_mode(data_db_transaction, project_id, "test_table") == TILE_STORAGE
+    assert await data_db_transaction.fetchval(f'''SELECT count(*) FROM "{project_id}"."test_table"''') == 4
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 300, 0, 300) == cells
+
+    await set_cell_value(data_db_transaction, project_id, "test_table", 64, 63, "")
+    assert await data_db_transaction.fetchval(f'''SELECT count(*) FROM "{project_id}"."test_table"''') == 3
+
+    await migrate_table_storage(data_db_transaction, project_id, "test_table", CELL_STORAGE)
+    assert await get_storage_mode(data_db_transaction, project_id, "test_table") == CELL_STORAGE
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 300, 0, 300) == [(0, 0, "a"), (63, 64, "b"), (200, 5, "d")]
+
+    # A name without a table is not cached as a cell table, another worker may create it in any mode
+    assert await get_storage_mode(data_db_transaction, project_id, "later_table") == CELL_STORAGE
+    await data_db_transaction.execute('''
+        INSERT INTO table_storage (schema_name, table_name, storage_mode) VALUES ($1, 'later_table', $2)
+    ''', project_id, TILE_STORAGE)
+    assert await get_storage_mode(data_db_transaction, project_id, "later_table") == TILE_STORAGE
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_mode", [CELL_STORAGE, TILE_STORAGE])
+async def test_change_table_structure(user_db_transaction, data_db_transaction, storage_mode):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=storage_mode)
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(row, col, f"{row}:{col}") for row in range(3) for col in range(3)])
+    stored = await data_db_transaction.fetch(f'''SELECT * FROM "{project_id}"."test_table" ORDER BY 1, 2''')
+
+    # Inserting only changes the mapping, the stored cells stay untouched
+    await change_table_structure(data_db_transaction, project_id, "test_table", "row", "insert", 0, 2)
+    assert await data_db_transaction.fetch(f'''SELECT * FROM "{project_id}"."test_table" ORDER BY 1, 2''') == stored
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 2, 0, 0) == [(2, 0, "0:0")]
+
+    await set_cell_value(data_db_transaction, project_id, "test_table", 1, 1, "new")
+    await change_table_structure(data_db_transaction, project_id, "test_table", "col", "delete", 0)
+    await change_table_structure(data_db_transaction, project_id, "test_table", "row", "move", 4, 1, 0)
+
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 10, 0, 10) == [
+        (0, 0, "2:1"), (0, 1, "2:2"),
+        (2, 0, "new"),
+        (3, 0, "0:1"), (3, 1, "0:2"),
+        (4, 0, "1:1"), (4, 1, "1:2"),
+    ]
+    assert await get_cells(data_db_transaction, project_id, "test_table", [(2, 0), (4, 1), (5, 5)]) == {(2, 0): "new", (4, 1): "1:2"}
+    cells_sql = await get_cells_sql(data_db_transaction, project_id, "test_table")
+    assert await data_db_transaction.fetchval(f'''SELECT count(*) FROM ({cells_sql}) AS cells''') == 7
+
+    with pytest.raises(ValueError):
+        await change_table_structure(data_db_transaction, project_id, "test_table", "row", "move", 0)
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_remap_permission_ranges(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    table_id = uuid.uuid4()
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 2, 5, 0, 3, "write")
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 10, 10, 0, 0, "read")
+
+    await remap_permission_ranges(user_db_transaction, project_id, table_id, "row", "insert", 3, 2)
+    await remap_permission_ranges(user_db_transaction, project_id, table_id, "row", "delete", 12)
+    await remap_permission_ranges(user_db_transaction, project_id, table_id, "col", "move", 0, 1, 5)
+
+    permissions = await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)
+    assert sorted(tuple(record) for record in permissions) == [(2, 7, 0, 2, "write"), (2, 7, 5, 5, "write")]
+
+    # Tables are addressed by name, a name that is no uuid has no ranges to remap
+    await remap_permission_ranges(user_db_transaction, project_id, "test_table", "row", "insert", 0)
+    await remap_permission_ranges(user_db_transaction, project_id, str(table_id), "row", "insert", 0)
+    permissions = await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)
+    assert sorted(tuple(record) for record in permissions) == [(3, 8, 0, 2, "write"), (3, 8, 5, 5, "write")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_get_table_changes(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    await set_cell_value(data_db_transaction, project_id, "test_table", 0, 0, "a")
+    revision, snapshot, cells = await get_table_changes(data_db_transaction, project_id, "test_table", 0)
+    assert (revision, snapshot, cells) == (1, False, [(0, 0, "a")])
+
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(1, 1, "b"), (1, 1, "c"), (2, 2, "d")])
+    await set_cell_value(data_db_transaction, project_id, "test_table", 0, 0, "")
+    assert await get_table_changes(data_db_transaction, project_id, "test_table", 1) == (3, False, [(1, 1, "c"), (2, 2, "d"), (0, 0, None)])
+
+    # Structural changes and compacted revisions can only be caught up with a snapshot
+    await change_table_structure(data_db_transaction, project_id, "test_table", "row", "insert", 0)
+    assert await get_table_changes(data_db_transaction, project_id, "test_table", 3) == (4, True, [(2, 1, "c"), (3, 2, "d")])
+    assert await get_table_changes(data_db_transaction, project_id, "test_table", 4) == (4, False, [])
+
+    await compact_change_log(data_db_transaction, project_id, "test_table", 4)
+    assert (await get_table_changes(data_db_transaction, project_id, "test_table", 3))[1]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_shared_project(user_db_transaction, data_db_transaction):
+    user_id = await create_user(user_db_transaction, "shared_tester", "shared@tester.com", "securepassword", "Tester", "Shared")
+    project_id = await create_project(user_db_transaction, data_db_transaction, "Shared Project", user_id, storage_layout=SHARED_LAYOUT)
+    assert not await data_db_transaction.fetchval('SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = $1)', project_id)
+
+    await create_table(data_db_transaction, "test_table", project_id)
+    assert await get_storage_mode(data_db_transaction, project_id, "test_table") == SHARED_STORAGE
+    with pytest.raises(ValueError):
+        await create_table(data_db_transaction, "test_table", project_id)
+    with pytest.raises(ValueError):
+        await create_table(data_db_transaction, "tiles", project_id, TILE_STORAGE)
+
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 0, "a"), (1, 1, "b")])
+    await change_table_structure(data_db_transaction, project_id, "test_table", "row", "insert", 0)
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 5, 0, 5) == [(1, 0, "a"), (2, 1, "b")]
+
+    table_id = uuid.uuid4()
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 3, 0, 3, "read")
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 1, 0, 3, "write")
+    permissions = await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)
+    assert sorted(tuple(record) for record in permissions) == [(0, 1, 0, 3, "write"), (2, 3, 0, 3, "read")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_migrate_project_to_shared(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=TILE_STORAGE)
+    await create_table(data_db_transaction, "second_table", project_id)
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 0, "a"), (70, 70, "b")])
+    await set_cell_value(data_db_transaction, project_id, "second_table", 3, 4, "c")
+    table_id = uuid.uuid4()
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 9, 0, 9, "write")
+
+    assert await migrate_project_to_shared(user_db_transaction, data_db_transaction, project_id) == 2
+    assert await get_project_layout(user_db_transaction, project_id) == SHARED_LAYOUT
+    assert not await data_db_transaction.fetchval('SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = $1)', project_id)
+    assert not await user_db_transaction.fetchval(f"""SELECT to_regclass('permissions."{project_id}"') IS NOT NULL""")
+
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 100, 0, 100) == [(0, 0, "a"), (70, 70, "b")]
+    assert await get_cell_value(data_db_transaction, project_id, "second_table", 3, 4) == "c"
+    permissions = await get_all_user_permissions(user_db_transaction, project_id, table_id, user_id)
+    assert [tuple(record) for record in permissions] == [(0, 9, 0, 9, "write")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_background_deletion(user_db_transaction, data_db_transaction, monkeypatch):
+    monkeypatch.setattr(deletion_queue, "DELETION_BATCH_SIZE", 2)
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    await create_table(data_db_transaction, "shared_table", project_id, SHARED_STORAGE)
+    await set_cell_values(data_db_transaction, project_id, "test_table", [(0, 0, "a")])
+    await set_cell_values(data_db_transaction, project_id, "shared_table", [(row, 0, "b") for row in range(5)])
+
+    with pytest.raises(ValueError):
+        await delete_table(user_db_transaction, data_db_transaction, "missing_table", project_id)
+
+    # A deleted table is renamed away at once, its name can be used again right away
+    deletion_id = await delete_table(user_db_transaction, data_db_transaction, "test_table", project_id, user_id)
+    assert [deletion["deletion_id"] for deletion in await list_deletions(data_db_transaction, visible_schemas=[], requested_by=user_id)] == [str(deletion_id)]
+    assert await list_deletions(data_db_transaction, visible_schemas=[], requested_by=uuid.uuid4()) == []
+    await create_table(data_db_transaction, "test_table", project_id)
+    assert await get_range(data_db_transaction, project_id, "test_table", 0, 5, 0, 5) == []
+    assert (await get_deletion(data_db_transaction, deletion_id))["status"] == "pending"
+    assert await process_deletion_step(data_db_transaction, deletion_id)
+    deletion = await get_deletion(data_db_transaction, deletion_id)
+    assert deletion["status"] == "done" and deletion["tables_dropped"] == 1
+    assert not await process_deletion_step(data_db_transaction, deletion_id)
+    assert not await data_db_transaction.fetchval('SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = $1)', tombstone_name(deletion_id))
+
+    # Shared cells are removed in batches, until then the name stays taken
+    deletion_id = await delete_table(user_db_transaction, data_db_transaction, "shared_table", project_id)
+    with pytest.raises(ValueError):
+        await create_table(data_db_transaction, "shared_table", project_id, SHARED_STORAGE)
+    steps = 0
+    while await process_deletion_step(data_db_transaction, deletion_id):
+        steps += 1
+    assert steps == 3
+    assert (await get_deletion(data_db_transaction, deletion_id))["status"] == "done"
+    await create_table(data_db_transaction, "shared_table", project_id, SHARED_STORAGE)
+
+    await create_table(data_db_transaction, "third_table", project_id)
+    deletion_id = await delete_project(user_db_transaction, data_db_transaction, project_id)
+    assert not await data_db_transaction.fetchval('SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = $1)', project_id)
+    progress = []
+    while await process_deletion_step(data_db_transaction, deletion_id):
+        progress.append((await get_deletion(data_db_transaction, deletion_id))["tables_dropped"])
+    assert progress == [1, 2, 3]
+    assert not await data_db_transaction.fetchval('SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = $1)', tombstone_name(deletion_id))
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_deletion_retry(user_db_transaction, data_db_transaction, monkeypatch):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction)
+    deletion_id = await delete_table(user_db_transaction, data_db_transaction, "test_table", project_id)
+
+    async def failing_step(data_connection, job):
+        raise RuntimeError("drop failed")
+    monkeypatch.setattr(deletion_queue, "_deletion_step", failing_step)
+    assert await process_deletion_step(data_db_transaction, deletion_id)
+    deletion = await get_deletion(data_db_transaction, deletion_id)
+    assert deletion["status"] == "pending" and deletion["attempts"] == 1 and deletion["last_error"] == "drop failed"
+    # The next attempt is delayed
+    assert not await process_deletion_step(data_db_transaction, deletion_id)
+
+    monkeypatch.undo()
+    await retry_deletion(data_db_transaction, deletion_id)
+    assert await process_deletion_step(data_db_transaction, deletion_id)
+    assert (await get_deletion(data_db_transaction, deletion_id))["status"] == "done"
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_clone_table(user_db_transaction, data_db_transaction):
+    user_id, project_id = await setup_table(user_db_transaction, data_db_transaction, storage_mode=TILE_STORAGE)
+    cells = [(0, 0, "a"), (70, 3, "b"), (5, 90, "=A1")]
+    await set_cell_values(data_db_transaction, project_id, "test_table", cells)
+    await change_table_structure(data_db_transaction, project_id, "test_table", "row", "insert", 0)
+    expected = await get_range(data_db_transaction, project_id, "test_table", 0, 100, 0, 100)
+
+    await clone_table(data_db_transaction, project_id, "test_table", project_id, "copy")
+    assert await get_storage_mode(data_db_transaction, project_id, "copy") == TILE_STORAGE
+    assert await get_range(data_db_transaction, project_id, "copy", 0, 100, 0, 100) == expected
+    with pytest.raises(ValueError):
+        await clone_table(data_db_transaction, project_id, "test_table", project_id, "copy")
+
+    shared_project_id = await create_project(user_db_transaction, data_db_transaction, "Shared Copy", user_id, storage_layout=SHARED_LAYOUT)
+    await clone_table(data_db_transaction, project_id, "copy", shared_project_id, "copy")
+    assert await get_storage_mode(data_db_transaction, shared_project_id, "copy") == SHARED_STORAGE
+    assert await get_range(data_db_transaction, shared_project_id, "copy", 0, 100, 0, 100) == expected
+
+    table_id, copy_id = uuid.uuid4(), uuid.uuid4()
+    await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 5, 0, 5, "write")
+    await clone_table_permissions(user_db_transaction, project_id, table_id, shared_project_id, copy_id)
+    permissions = await get_all_user_permissions(user_db_transaction, shared_project_id, copy_id, user_id)
+    assert [tuple(record) for record in permissions] == [(0, 5, 0, 5, "write")]
+
+
+@pytest.mark.data_db
+@pytest.mark.asyncio
+async def test_clone_project(user_db_transaction, data_db_pool):
+    # The tables are copied on several pooled connections, so the source has to be committed
+    async with data_db_pool.acquire() as connection:
+        user_id, project_id = await setup_table(user_db_transaction, connection)
+        clone_id = None
+        try:
+            await create_table(connection, "tiles", project_id, TILE_STORAGE)
+            await set_cell_values(connection, project_id, "test_table", [(row, col, f"{row}:{col}") for row in range(50) for col in range(20)])
+            await set_cell_values(connection, project_id, "tiles", [(100, 100, "t")])
+            table_id = uuid.uuid4()
+            await set_permission(user_db_transaction, project_id, table_id, user_id, 0, 9, 0, 9, "read")
+
+            clone_id = await clone_project(user_db_transaction, data_db_pool, project_id, "Cloned Project", user_id)
+            assert await get_range(connection, clone_id, "test_table", 0, 100, 0, 100) == await get_range(connection, project_id, "test_table", 0, 100, 0, 100)
+            assert await get_cell_value(connection, clone_id, "tiles", 100, 100) == "t"
+            assert await get_storage_mode(connection, clone_id, "tiles") == TILE_STORAGE
+            permissions = await get_all_user_permissions(user_db_transaction, clone_id, table_id, user_id)
+            assert [tuple(record) for record in permissions] == [(0, 9, 0, 9, "read")]
+        finally:
+            for deleted_project in [project_id, clone_id]:
+                if deleted_project is None:
+                    continue
+                deletion_id = await delete_project(user_db_transaction, connection, deleted_project)
+                while await process_deletion_step(connection, deletion_id):
+                    pass
+                await connection.execute('DELETE FROM pending_deletions WHERE deletion_id = $1', deletion_id)
@@ -7,4 +7,102 @@ async def test_setup_user(user_db_transaction):
 
 
     user_id = await create_user(user_connection=user_db_transaction, userName="testuser", email="test.test@test.test", password="Test1234!", lastName="Test", firstName="User")
-    assert user_id is not None
\ No newline at end of file
+    assert user_id is not None
+@pytest.mark.user_creation
+@pytest.mark.asyncio
+async def test_password_rehash(user_db_transaction, monkeypatch):
+    import bcrypt
+    from backend.user_management import user_handler
+    from backend.user_management.password_hashing import hash_rounds
+
+    user_id = await create_user(user_connection=user_db_transaction, userName="rehashuser", email="rehash@test.test", password="Test1234!", lastName="Test", firstName="Rehash")
+    old_hash = bcrypt.hashpw(b"Test1234!", bcrypt.gensalt(rounds=4)).decode()
+    await user_db_transaction.execute('UPDATE users SET password = $2 WHERE user_id = $1', user_id, old_hash)
+
+    assert not await user_handler.valid_password(user_db_transaction, "rehashuser", "wrong")
+    assert await user_db_transaction.fetchval('SELECT password FROM users WHERE user_id = $1', user_id) == old_hash
+
+    # A successful login replaces the hash made with the old cost
+    assert await user_handler.valid_password(user_db_transaction, "rehashuser", "Test1234!")
+    new_hash = await user_db_transaction.fetchval('SELECT password FROM users WHERE user_id = $1', user_id)
+    assert hash_rounds(new_hash) == user_handler.BCRYPT_ROUNDS
+    assert await user_handler.valid_password(user_db_transaction, "rehash@test.test", "Test1234!")
+
+    # A busy hasher keeps the old hash but still accepts the login
+    await user_db_transaction.execute('UPDATE users SET password = $2 WHERE user_id = $1', user_id, old_hash)
+    real_run = user_handler.password_hasher.run
+
+    async def busy_rehash(func, *args):
+        if func is user_handler.hash_password:
+            raise user_handler.PasswordHashingBusy()
+        return await real_run(func, *args)
+
+    monkeypatch.setattr(user_handler.password_hasher, "run", busy_rehash)
+    assert await user_handler.valid_password(user_db_transaction, "rehashuser", "Test1234!")
+    assert await user_db_transaction.fetchval('SELECT password FROM users WHERE user_id = $1', user_id) == old_hash
+
+@pytest.mark.user_creation
+@pytest.mark.asyncio
+async def test_password_hasher_queue_timeout():
+    import asyncio
+    import time
+    from backend.user_management.password_hashing import PasswordHasher, PasswordHashingBusy
+
+    hasher = PasswordHasher(workers=1, queue_timeout=0.05)
+    try:
+        running = asyncio.ensure_future(hasher.run(time.sleep, 0.3))
+        await asyncio.sleep(0.01)
+        with pytest.raises(PasswordHashingBusy):
+            await hasher.run(time.sleep, 0)
+        await running
+        assert hasher.stats()["rejected"] == 1
+    finally:
+        hasher.shutdown()
+
+@pytest.mark.user_creation
+@pytest.mark.asyncio
+async def test_profile_cache(user_db_pool):
+    from backend.user_management.profile_cache import profile_cache
+    from backend.user_management.user_handler import delete_user, get_user_profile, update_user_profile
+
+    async with user_db_pool.acquire() as conn:
+        user_id = await create_user(user_connection=conn, userName="profileuser", email="profile@test.test", password="Test1234!", lastName="Test", firstName="Profile")
+        try:
+            profile = await get_user_profile(conn, str(user_id))
+            assert profile["firstname"] == "Profile" and "password" not in profile
+            hits = profile_cache.hits
+            assert await get_user_profile(conn, user_id) == profile
+            assert profile_cache.hits == hits + 1
+
+            await update_user_profile(conn, user_id, firstName="Changed")
+            assert (await get_user_profile(conn, user_id))["firstname"] == "Changed"
+        finally:
+            await delete_user(conn, user_id)
+        assert await get_user_profile(conn, user_id) is None
+
+@pytest.mark.user_creation
+def test_login_guard(monkeypatch):
+    from backend.user_management import login_guard as guard_module
+    from backend.user_management.login_guard import LoginGuard, LoginOverloaded, LoginRateLimited, TokenBucketLimiter
+
+    limiter = TokenBucketLimiter(rate=1, burst=2)
+    assert limiter.acquire("a") and limiter.acquire("a")
+    assert not limiter.acquire("a")
+    assert 0 < limiter.retry_after("a") <= 1
+    assert limiter.acquire("b")
+    assert limiter.stats() == {"tracked": 2, "allowed": 3, "limited": 1}
+
+    guard = LoginGuard()
+    guard.by_user = TokenBucketLimiter(rate=0.01, burst=1)
+    guard.enter("127.0.0.1", "Someone")
+    guard.leave()
+    # Usernames are limited regardless of case and client
+    with pytest.raises(LoginRateLimited):
+        guard.enter("10.0.0.1", "someone ")
+
+    monkeypatch.setattr(guard_module, "LOGIN_MAX_IN_FLIGHT", 1)
+    guard.enter("127.0.0.1", "other")
+    with pytest.raises(LoginOverloaded):
+        guard.enter("127.0.0.1", "third")
+    guard.leave()
+    assert guard.stats()["shed"] == 1 and guard.stats()["in_flight"] == 0